@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Admission control cho các lời gọi Ollama.
+
+Mỗi model (TEXT_MODEL, VISION_MODEL) có số slot chạy đồng thời và hàng đợi
+giới hạn riêng, nên vài request llava:7b chậm không chiếm hết chỗ của chat
+text. Request vượt quá sức chứa bị từ chối ngay:
+- 429 khi hàng đợi đầy hoặc thời gian chờ ước tính vượt max_wait
+- 503 khi đã chờ quá max_wait mà vẫn chưa tới lượt
+kèm Retry-After ước tính từ thời gian phục vụ quan sát được (EWMA).
+
+Nhiều worker process: shared_slots (shared_state.SharedSlots) giới hạn tổng số
+lời gọi của mọi worker; request đã có slot trong process chờ thêm slot chung
+(trong phần còn lại của max_wait) trước khi gọi Ollama.
+"""
+from collections import deque
+from contextlib import contextmanager
+import threading
+import asyncio
+import math
+import time
+
+EWMA_ALPHA = 0.2
+
+class Overloaded(Exception):
+    """Request bị từ chối vì model đang quá tải"""
+
+    def __init__(self, model, reason, retry_after, status_code):
+        super().__init__(f"{model}: {reason}")
+        self.model = model
+        self.reason = reason
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+    @property
+    def retry_after_header(self):
+        return str(max(1, math.ceil(self.retry_after)))
+
+class _AdmissionStats:
+    """Phần dùng chung: số liệu, EWMA thời gian phục vụ, ước lượng thời gian chờ"""
+
+    def __init__(self, model, max_concurrent, max_queue, max_wait, initial_service_time, shared_slots=None):
+        self.model = model
+        self.shared_slots = shared_slots
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.service_time = initial_service_time
+        self.active = 0
+        self.completed = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.total_wait = 0.0
+        self.max_observed_wait = 0.0
+        self.last_wait = 0.0
+
+    def estimate_wait(self, position):
+        """Thời gian chờ ước tính cho request đứng thứ `position` trong hàng đợi"""
+        return math.ceil(position / self.max_concurrent) * self.service_time
+
+    def _record_wait(self, wait):
+        self.admitted += 1
+        self.total_wait += wait
+        self.last_wait = wait
+        self.max_observed_wait = max(self.max_observed_wait, wait)
+
+    def _record_service(self, service_time):
+        if self.completed:
+            self.service_time += EWMA_ALPHA * (service_time - self.service_time)
+        else:
+            self.service_time = service_time
+        self.completed += 1
+
+    def _check_queue(self, queued):
+        """Từ chối sớm nếu hàng đợi đầy hoặc (khi đã có số liệu) chắc chắn sẽ chờ quá max_wait"""
+        estimated = self.estimate_wait(queued + 1)
+        if queued >= self.max_queue:
+            self.rejected += 1
+            raise Overloaded(self.model, 'queue full', estimated, 429)
+        if self.completed and estimated > self.max_wait:
+            self.rejected += 1
+            raise Overloaded(self.model, 'estimated wait too long', estimated, 429)
+
+    def _timeout_error(self, queued):
+        self.timed_out += 1
+        return Overloaded(self.model, 'queue wait timeout', self.estimate_wait(queued + 1), 503)
+
+    def _shared_timeout_error(self):
+        self.timed_out += 1
+        return Overloaded(self.model, 'shared slot wait timeout', self.service_time, 503)
+
+    def _snapshot(self, queued):
+        return {
+            'model': self.model,
+            'active': self.active,
+            'max_concurrent': self.max_concurrent,
+            'queue_depth': queued,
+            'max_queue': self.max_queue,
+            'max_wait': self.max_wait,
+            'admitted': self.admitted,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out,
+            'avg_wait': round(self.total_wait / self.admitted, 4) if self.admitted else 0.0,
+            'max_observed_wait': round(self.max_observed_wait, 4),
+            'last_wait': round(self.last_wait, 4),
+            'service_time_ewma': round(self.service_time, 3),
+            'estimated_wait': round(self.estimate_wait(queued + 1), 3) if queued else 0.0,
+            'shared_slots': self.shared_slots.stats() if self.shared_slots else None
+        }
+
+class _Waiter:
+    __slots__ = ('event', 'granted')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.granted = False
+
+class AdmissionController(_AdmissionStats):
+    """Bản đa luồng; slot được trao trực tiếp cho request đợi lâu nhất (FIFO)"""
+
+    def __init__(self, model, max_concurrent, max_queue, max_wait, initial_service_time=10.0,
+                 shared_slots=None):
+        super().__init__(model, max_concurrent, max_queue, max_wait, initial_service_time, shared_slots)
+        self._lock = threading.Lock()
+        self._waiters = deque()
+
+    def acquire(self):
+        """Chiếm một slot; raise Overloaded nếu không thể. Trả về thời điểm được nhận"""
+        start = time.monotonic()
+        with self._lock:
+            if self.active < self.max_concurrent and not self._waiters:
+                self.active += 1
+                waiter = None
+            else:
+                self._check_queue(len(self._waiters))
+                waiter = _Waiter()
+                self._waiters.append(waiter)
+
+        if waiter is not None:
+            waiter.event.wait(self.max_wait)
+            with self._lock:
+                if not waiter.granted:
+                    self._waiters.remove(waiter)
+                    raise self._timeout_error(len(self._waiters))
+
+        if self.shared_slots and not self.shared_slots.acquire(start + self.max_wait - time.monotonic()):
+            with self._lock:
+                self._handoff()
+                raise self._shared_timeout_error()
+
+        with self._lock:
+            admitted_at = time.monotonic()
+            self._record_wait(admitted_at - start)
+            return admitted_at
+
+    def release(self, admitted_at):
+        """Trả slot; slot chuyển thẳng cho người đang đợi (nếu có)"""
+        if self.shared_slots:
+            self.shared_slots.release()
+        with self._lock:
+            self._record_service(time.monotonic() - admitted_at)
+            self._handoff()
+
+    def _handoff(self):
+        if self._waiters:
+            waiter = self._waiters.popleft()
+            waiter.granted = True
+            waiter.event.set()
+        else:
+            self.active -= 1
+
+    @contextmanager
+    def slot(self):
+        admitted_at = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(admitted_at)
+
+    def stats(self):
+        with self._lock:
+            return self._snapshot(len(self._waiters))
+
+class AsyncAdmissionController(_AdmissionStats):
+    """Bản asyncio (asgi_app.py); mọi thao tác chạy trên event loop nên không cần lock"""
+
+    def __init__(self, model, max_concurrent, max_queue, max_wait, initial_service_time=10.0,
+                 shared_slots=None):
+        super().__init__(model, max_concurrent, max_queue, max_wait, initial_service_time, shared_slots)
+        self._waiters = deque()
+
+    async def acquire(self):
+        start = time.monotonic()
+        if self.active < self.max_concurrent and not self._waiters:
+            self.active += 1
+        else:
+            await self._wait_turn()
+
+        if self.shared_slots:
+            try:
+                acquired = await self.shared_slots.acquire_async(start + self.max_wait - time.monotonic())
+            except asyncio.CancelledError:
+                self._handoff()
+                raise
+            if not acquired:
+                self._handoff()
+                raise self._shared_timeout_error()
+
+        admitted_at = time.monotonic()
+        self._record_wait(admitted_at - start)
+        return admitted_at
+
+    async def _wait_turn(self):
+        self._check_queue(len(self._waiters))
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.max_wait)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                self._waiters.remove(waiter)
+                waiter.cancel()
+                raise self._timeout_error(len(self._waiters))
+        except asyncio.CancelledError:
+            # Client bỏ đi khi đang chờ: nếu slot vừa được trao thì trả lại
+            if waiter.done() and not waiter.cancelled():
+                self._handoff()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+                waiter.cancel()
+            raise
+
+    def release(self, admitted_at):
+        if self.shared_slots:
+            self.shared_slots.release()
+        self._record_service(time.monotonic() - admitted_at)
+        self._handoff()
+
+    def _handoff(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                return
+        self.active -= 1
+
+    def stats(self):
+        return self._snapshot(len(self._waiters))
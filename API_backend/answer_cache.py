@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Cache câu trả lời cho TEXT_MODEL.
+
+Hai lớp:
+- Exact: key = câu hỏi đã chuẩn hoá + language + model + options
+- Gần giống (tuỳ chọn, mặc định tắt - similarity_threshold=0): chỉ mục n-gram
+  ký tự, so khớp bằng hệ số Dice với ngưỡng similarity_threshold. Các con số
+  trong câu hỏi (năm, số lượng...) phải trùng khớp tuyệt đối, để "năm 1945"
+  không bao giờ trả lời cho "năm 1954". Một từ khác nhau vẫn có thể đổi hẳn
+  câu trả lời ("nhà Lý" / "nhà Lê", "first" / "last") mà điểm Dice vẫn trên 0.9,
+  nên chỉ bật khi đã chấp nhận rủi ro đó
+
+Giới hạn theo số entry, tổng bytes (ước lượng) và TTL; loại bỏ theo LRU.
+"""
+from collections import OrderedDict
+import unicodedata
+import threading
+import json
+import time
+import re
+
+_WHITESPACE_RE = re.compile(r'\s+')
+_TRAILING_PUNCT_RE = re.compile(r'[\s?？!！.。,，;；:：]+$')
+_NUMBER_RE = re.compile(r'\d+')
+
+# Ước lượng overhead bộ nhớ cho mỗi n-gram được đánh chỉ mục
+_NGRAM_OVERHEAD = 64
+
+def normalize_message(message):
+    """Chuẩn hoá câu hỏi: NFC, chữ thường, gộp khoảng trắng, bỏ dấu câu cuối"""
+    text = unicodedata.normalize('NFC', message).lower()
+    text = _WHITESPACE_RE.sub(' ', text).strip()
+    return _TRAILING_PUNCT_RE.sub('', text)
+
+def char_ngrams(text, n=3):
+    """Tập n-gram ký tự (có padding hai đầu)"""
+    padded = f" {text} "
+    if len(padded) < n:
+        return frozenset()
+    return frozenset(padded[i:i + n] for i in range(len(padded) - n + 1))
+
+class AnswerCache:
+    """LRU + TTL cache, thread-safe, dùng chung cho Flask và ASGI"""
+
+    def __init__(self, max_entries=2000, max_bytes=32 * 1024 * 1024, ttl=24 * 3600,
+                 similarity_threshold=0, ngram_size=3):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.ngram_size = ngram_size
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._ngram_index = {}
+        self._bytes = 0
+
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def _scope(language, model, options):
+        return (language, model, json.dumps(options or {}, sort_keys=True))
+
+    def lookup(self, message, language, model, options=None):
+        """
+        Tìm câu trả lời đã cache.
+        Trả về (value, match) với match là 'exact' / 'similar', hoặc (None, None).
+        """
+        norm = normalize_message(message)
+        scope = self._scope(language, model, options)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get((scope, norm))
+            if entry is not None:
+                if entry['expires_at'] > now:
+                    self._entries.move_to_end((scope, norm))
+                    self.hits += 1
+                    return entry['value'], 'exact'
+                self._remove((scope, norm))
+                self.expirations += 1
+
+            if self.similarity_threshold:
+                key = self._find_similar(scope, norm, now)
+                if key is not None:
+                    self._entries.move_to_end(key)
+                    self.similar_hits += 1
+                    return self._entries[key]['value'], 'similar'
+
+            self.misses += 1
+            return None, None
+
+    def put(self, message, language, model, options, value, ttl=None):
+        """Lưu câu trả lời; ttl=None dùng TTL mặc định"""
+        norm = normalize_message(message)
+        scope = self._scope(language, model, options)
+        key = (scope, norm)
+        grams = char_ngrams(norm, self.ngram_size) if self.similarity_threshold else frozenset()
+        size = (len(json.dumps(value, ensure_ascii=False).encode('utf-8'))
+                + len(norm.encode('utf-8')) + _NGRAM_OVERHEAD * len(grams))
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = {
+                'value': value,
+                'expires_at': time.monotonic() + (self.ttl if ttl is None else ttl),
+                'size': size,
+                'grams': grams,
+                'numbers': _NUMBER_RE.findall(norm)
+            }
+            self._bytes += size
+            for gram in grams:
+                self._ngram_index.setdefault((scope, gram), set()).add(key)
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _find_similar(self, scope, norm, now):
+        grams = char_ngrams(norm, self.ngram_size)
+        if not grams:
+            return None
+
+        overlap = {}
+        for gram in grams:
+            for key in self._ngram_index.get((scope, gram), ()):
+                overlap[key] = overlap.get(key, 0) + 1
+
+        numbers = _NUMBER_RE.findall(norm)
+        best_key, best_score = None, self.similarity_threshold
+        for key, shared in overlap.items():
+            entry = self._entries[key]
+            score = 2 * shared / (len(grams) + len(entry['grams']))
+            if score >= best_score and entry['numbers'] == numbers and entry['expires_at'] > now:
+                best_key, best_score = key, score
+        return best_key
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry['size']
+        scope = key[0]
+        for gram in entry['grams']:
+            keys = self._ngram_index.get((scope, gram))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._ngram_index[(scope, gram)]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._ngram_index.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.similar_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'similar_hits': self.similar_hits,
+                'misses': self.misses,
+                'hit_ratio': round((self.hits + self.similar_hits) / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
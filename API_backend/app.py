@@ -1,16 +1,37 @@
 # -*- coding: utf-8 -*-
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context, make_response, g
 from flask_cors import CORS
 import requests
 import logging
-import socket
-import base64
+import json
 import os
-from googlesearch import search
 from datetime import datetime
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
+from ollama_router import OllamaRouter, parse_backends
+from model_residency import ModelResidency
+from answer_cache import AnswerCache
+from vision_cache import VisionCache
+from retrieval import Retriever
+from web_search import SearchStage, load_backend
+from sessions import SessionStore
+from coalescing import SingleFlight, request_key
+from admission import AdmissionController, Overloaded
+from batching import BatchGate
+from metrics import ChatMetrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+import metrics
+from request_log import RequestLog, configure as configure_logging, request_id
+from language_detect import detect_language, compile_keywords, nfc
+from image_pipeline import preprocess_image, ImageRejected, is_available as image_pipeline_available
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import queue
+import time
 
-logging.basicConfig(level=logging.DEBUG)
+# LOG_FORMAT=json: mỗi dòng log là một JSON; log ghi qua queue, thread riêng ghi ra stderr
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+log_handler = configure_logging(LOG_LEVEL, LOG_FORMAT, int(os.environ.get('LOG_QUEUE_SIZE', 10000)))
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
@@ -18,14 +39,210 @@ CORS(app)
 
 app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024 
 app.config['UPLOAD_FOLDER'] = '/tmp'
+REQUEST_TOO_LARGE_BODY = {
+    'error': 'File too large',
+    'max_size': '10MB',
+    'hint': 'Please upload a smaller image'
+}
+
+OLLAMA_HOST = os.environ.get('OLLAMA_HOST', 'http://localhost:11434').rstrip('/')
+OLLAMA_URL = f"{OLLAMA_HOST}/api/generate"
 
-OLLAMA_URL = "http://localhost:11434/api/generate"
+# Số worker thread của server (run_production.py) = kích thước connection pool tới Ollama
+SERVER_THREADS = int(os.environ.get('SERVER_THREADS', 8))
 
 TEXT_MODEL = "gemma2:9b"      
 VISION_MODEL = "llava:7b"  
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp', 'gif', 'bmp'}
 
+if not image_pipeline_available():
+    logger.warning("Pillow is not installed: images are sent to the vision model without preprocessing")
+
+TEXT_OPTIONS = {
+    "temperature": 0.2,
+    "top_p": 0.9,
+    "top_k": 40,
+    "num_predict": 400
+}
+VISION_OPTIONS = {
+    "temperature": 0.3,
+    "top_p": 0.9,
+    "num_predict": 500
+}
+
+TEXT_TIMEOUT = 120
+VISION_TIMEOUT = 180
+
+# Một hoặc nhiều node Ollama (OLLAMA_BACKENDS="http://gpu1:11434=gemma2:9b,llava:7b http://gpu2:11434")
+OLLAMA_BACKENDS = parse_backends(os.environ.get('OLLAMA_BACKENDS', ''), OLLAMA_HOST)
+OLLAMA_ROUTING = os.environ.get('OLLAMA_ROUTING', 'least_outstanding')
+OLLAMA_PROBE_INTERVAL = int(os.environ.get('OLLAMA_PROBE_INTERVAL', 15))
+
+ollama = OllamaRouter(OLLAMA_BACKENDS, pool_size=SERVER_THREADS, strategy=OLLAMA_ROUTING,
+                      prefer_loaded=[VISION_MODEL])
+if OLLAMA_PROBE_INTERVAL > 0:
+    ollama.start_probing(OLLAMA_PROBE_INTERVAL)
+
+# /health trả kết quả probe gần nhất ngay; cũ hơn HEALTH_MAX_AGE giây thì probe lại ở thread nền
+HEALTH_MAX_AGE = float(os.environ.get('HEALTH_MAX_AGE', 2 * max(OLLAMA_PROBE_INTERVAL, 5)))
+
+# Giữ model nằm sẵn trong Ollama: preload, keep_alive theo traffic, gom request vision khi model chưa nạp
+residency = ModelResidency(
+    ollama, [VISION_MODEL, TEXT_MODEL],
+    min_keep_alive=int(os.environ.get('OLLAMA_MIN_KEEP_ALIVE', 60)),
+    max_keep_alive=int(os.environ.get('OLLAMA_MAX_KEEP_ALIVE', 30 * 60)),
+    hold_models=[VISION_MODEL],
+    hold_seconds=float(os.environ.get('VISION_HOLD_SECONDS', 2.0)),
+    hold_batch=int(os.environ.get('VISION_HOLD_BATCH', 4))
+)
+if os.environ.get('MODEL_PRELOAD', '1') == '1':
+    residency.start_preload()
+
+# Nhiều worker process (run_production.py --workers N): cache câu trả lời, phiên hội thoại và
+# giới hạn số lời gọi Ollama dùng chung qua SQLite + file khoá trong thư mục này (trống = riêng từng process)
+SHARED_STATE_DIR = os.environ.get('SHARED_STATE_DIR', '')
+shared_store = None
+if SHARED_STATE_DIR:
+    # sqlite3 / fcntl chỉ cần khi chạy nhiều worker
+    from shared_state import SharedStore, SharedAnswerCache, SharedSessionStore, SharedSlots
+    os.makedirs(SHARED_STATE_DIR, exist_ok=True)
+    shared_store = SharedStore(os.path.join(SHARED_STATE_DIR, 'state.sqlite3'))
+
+# Cache câu trả lời text; câu hỏi cần search (tin tức, "hiện tại"...) hết hạn sớm hơn.
+# Khớp câu gần giống chỉ bật khi đặt ANSWER_CACHE_SIMILARITY > 0 (vd 0.9), mặc định chỉ khớp exact
+ANSWER_CACHE_TTL = int(os.environ.get('ANSWER_CACHE_TTL', 24 * 3600))
+ANSWER_CACHE_SEARCH_TTL = int(os.environ.get('ANSWER_CACHE_SEARCH_TTL', 10 * 60))
+ANSWER_CACHE_SIMILARITY = float(os.environ.get('ANSWER_CACHE_SIMILARITY', 0))
+
+answer_cache_options = dict(
+    max_entries=int(os.environ.get('ANSWER_CACHE_MAX_ENTRIES', 2000)),
+    max_bytes=int(os.environ.get('ANSWER_CACHE_MAX_BYTES', 32 * 1024 * 1024)),
+    ttl=ANSWER_CACHE_TTL,
+    similarity_threshold=ANSWER_CACHE_SIMILARITY
+)
+answer_cache = (SharedAnswerCache(shared_store, **answer_cache_options) if shared_store
+                else AnswerCache(**answer_cache_options))
+
+# Cache câu trả lời vision theo hash nội dung ảnh; so khớp perceptual hash cho ảnh chụp/nén lại
+# chỉ bật khi đặt VISION_CACHE_MAX_DISTANCE > 0 (vd 6)
+vision_cache = VisionCache(
+    max_entries=int(os.environ.get('VISION_CACHE_MAX_ENTRIES', 500)),
+    max_bytes=int(os.environ.get('VISION_CACHE_MAX_BYTES', 8 * 1024 * 1024)),
+    ttl=int(os.environ.get('VISION_CACHE_TTL', 7 * 24 * 3600)),
+    max_distance=int(os.environ.get('VISION_CACHE_MAX_DISTANCE', 0))
+)
+
+# Chỉ mục tìm kiếm cục bộ (BM25) trên tài liệu lịch sử, build bằng build_index.py
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+INDEX_DIR = os.environ.get('INDEX_DIR', os.path.join(BASE_DIR, 'index'))
+CORPUS_DIR = os.environ.get('CORPUS_DIR', os.path.join(BASE_DIR, 'corpus'))
+RETRIEVAL_TOP_K = int(os.environ.get('RETRIEVAL_TOP_K', 3))
+RETRIEVAL_MIN_SCORE = float(os.environ.get('RETRIEVAL_MIN_SCORE', 2.0))
+RETRIEVAL_MAX_CHARS = int(os.environ.get('RETRIEVAL_MAX_CHARS', 2400))
+RETRIEVAL_REFRESH_INTERVAL = int(os.environ.get('RETRIEVAL_REFRESH_INTERVAL', 60))
+
+retriever = Retriever(INDEX_DIR, CORPUS_DIR, min_score=RETRIEVAL_MIN_SCORE)
+if RETRIEVAL_REFRESH_INTERVAL > 0:
+    # Tài liệu đổi -> câu trả lời đã cache có thể dựa trên nội dung cũ
+    retriever.start_auto_refresh(RETRIEVAL_REFRESH_INTERVAL, on_change=answer_cache.clear)
+
+# Web search cho câu hỏi cần thông tin mới: cache + ngân sách thời gian, backend thay được
+# (WEB_SEARCH_BACKEND=google / stub / module:function)
+web_search = SearchStage(
+    load_backend(os.environ.get('WEB_SEARCH_BACKEND', 'google')),
+    budget=float(os.environ.get('WEB_SEARCH_BUDGET', 2.5)),
+    ttl=int(os.environ.get('WEB_SEARCH_CACHE_TTL', 10 * 60)),
+    max_workers=int(os.environ.get('WEB_SEARCH_WORKERS', 4))
+)
+
+# Gộp các lời gọi Ollama giống hệt nhau đang chạy (cả lớp hỏi cùng một câu)
+coalescer = SingleFlight()
+
+# Phiên hội thoại nhiều lượt (/sessions): mỗi lượt dùng lại context token Ollama trả về ở lượt trước
+session_options = dict(
+    max_sessions=int(os.environ.get('SESSION_MAX_SESSIONS', 1000)),
+    max_bytes=int(os.environ.get('SESSION_MAX_BYTES', 64 * 1024 * 1024)),
+    idle_ttl=int(os.environ.get('SESSION_IDLE_TTL', 30 * 60)),
+    token_budget=int(os.environ.get('SESSION_TOKEN_BUDGET', 1536)),
+    history_tokens=int(os.environ.get('SESSION_HISTORY_TOKENS', 600))
+)
+sessions = (SharedSessionStore(shared_store, **session_options) if shared_store
+            else SessionStore(**session_options))
+
+# Số request mỗi node Ollama chạy song song (nên khớp OLLAMA_NUM_PARALLEL của server Ollama)
+OLLAMA_NUM_PARALLEL = int(os.environ.get('OLLAMA_NUM_PARALLEL', 4))
+
+# Admission control: slot chạy đồng thời + hàng đợi giới hạn riêng cho từng model
+# (mặc định nhân theo số node Ollama phục vụ model đó)
+ADMISSION_MAX_WAIT = float(os.environ.get('ADMISSION_MAX_WAIT', 30))
+ADMISSION_LIMITS = {
+    TEXT_MODEL: {
+        'max_concurrent': int(os.environ.get('TEXT_MAX_CONCURRENT', OLLAMA_NUM_PARALLEL * ollama.capacity(TEXT_MODEL))),
+        'max_queue': int(os.environ.get('TEXT_MAX_QUEUE', 32)),
+        'max_wait': ADMISSION_MAX_WAIT
+    },
+    VISION_MODEL: {
+        'max_concurrent': int(os.environ.get('VISION_MAX_CONCURRENT', 1 * ollama.capacity(VISION_MODEL))),
+        'max_queue': int(os.environ.get('VISION_MAX_QUEUE', 4)),
+        'max_wait': float(os.environ.get('VISION_ADMISSION_MAX_WAIT', ADMISSION_MAX_WAIT * 2))
+    }
+}
+
+# Nhiều worker: max_concurrent là tổng của mọi worker (không nhân số lời gọi Ollama theo số worker)
+shared_slots = {
+    model: SharedSlots(SHARED_STATE_DIR, model, limits['max_concurrent'])
+    for model, limits in ADMISSION_LIMITS.items()
+} if SHARED_STATE_DIR else {}
+
+admission = {
+    model: AdmissionController(model, **limits, shared_slots=shared_slots.get(model))
+    for model, limits in ADMISSION_LIMITS.items()
+}
+
+# Micro-batching request text: gom trong cửa sổ ngắn (TEXT_BATCH_WINDOW_MS, 0 = tắt) hoặc tới khi
+# đủ số slot song song của các node rồi thả cùng lúc, để Ollama chạy chúng trong cùng vòng decode
+TEXT_BATCH_WINDOW_MS = float(os.environ.get('TEXT_BATCH_WINDOW_MS', 20))
+batchers = {
+    TEXT_MODEL: BatchGate(TEXT_BATCH_WINDOW_MS / 1000,
+                          max_batch=OLLAMA_NUM_PARALLEL * ollama.capacity(TEXT_MODEL))
+}
+
+# /chat/batch: số câu tối đa mỗi batch, số câu của một batch chạy song song
+# (mặc định bằng số slot song song của model text) và số thread dùng chung cho mọi batch
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 50))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', OLLAMA_NUM_PARALLEL * ollama.capacity(TEXT_MODEL)))
+batch_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('BATCH_WORKERS', 16)),
+                                    thread_name_prefix='chat-batch')
+
+# /metrics: số request, độ trễ theo từng bước, tốc độ sinh token của Ollama
+chat_metrics = ChatMetrics()
+METRIC_ENDPOINTS = {'chat', 'session_chat', 'chat_batch'}
+
+# Một bản ghi mỗi request chat; request thành công ghi theo tỉ lệ LOG_SAMPLE_RATE,
+# lỗi và request chậm hơn LOG_SLOW_SECONDS luôn được ghi
+request_log = RequestLog(logging.getLogger('request'),
+                         sample_rate=float(os.environ.get('LOG_SAMPLE_RATE', 1.0)),
+                         slow_seconds=float(os.environ.get('LOG_SLOW_SECONDS', 10.0)),
+                         handler=log_handler, log_format=LOG_FORMAT)
+
+def finish_request(timer, status):
+    """Request chat kết thúc: metrics + bản ghi request log"""
+    if timer.finished:
+        return
+    chat_metrics.finish(timer, status)
+    request_log.record(timer, status)
+
+# Streaming: 'sse' (text/event-stream) hoặc 'ndjson' (application/x-ndjson)
+STREAM_FORMATS = {
+    'sse': 'text/event-stream',
+    'ndjson': 'application/x-ndjson'
+}
+STREAM_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no'
+}
+
 LANGUAGES = {
     'vi': {
         'name': 'Tiếng Việt',
@@ -46,6 +263,11 @@ Trả lời bằng tiếng Việt:""",
 Câu hỏi: {message}
 
 Hãy mô tả chi tiết những gì bạn nhìn thấy trong hình và trả lời câu hỏi bằng tiếng Việt:""",
+        'followup_prompt': """{search_context}
+
+Câu hỏi tiếp theo: {message}
+
+Trả lời ngắn gọn (2-5 câu) bằng tiếng Việt, dựa trên cuộc hội thoại ở trên:""",
         'search_keywords': ['mới nhất', 'hiện tại', 'hôm nay', 'năm nay', 'tin tức', 
                            'thời tiết', 'giá', 'bao nhiêu tỉnh', '2025', '2024', 
                            'cập nhật', 'sáp nhập', 'thay đổi', 'ai là', 'là ai']
@@ -69,6 +291,11 @@ Answer in English:""",
 Question: {message}
 
 Describe in detail what you see in the image and answer the question in English:""",
+        'followup_prompt': """{search_context}
+
+Follow-up question: {message}
+
+Answer concisely (2-5 sentences) in English, based on the conversation above:""",
         'search_keywords': ['latest', 'current', 'today', 'this year', 'news', 
                            'weather', 'price', 'how many', '2025', '2024', 
                            'update', 'merger', 'changes', 'who is']
@@ -92,6 +319,11 @@ Describe in detail what you see in the image and answer the question in English:
 问题：{message}
 
 详细描述你在图片中看到的内容，并用中文回答问题：""",
+        'followup_prompt': """{search_context}
+
+追问：{message}
+
+根据上面的对话，用中文简洁回答（2-5句话）：""",
         'search_keywords': ['最新', '当前', '今天', '今年', '新闻', 
                            '天气', '价格', '多少', '2025', '2024', 
                            '更新', '合并', '变化', '是谁']
@@ -100,52 +332,480 @@ Describe in detail what you see in the image and answer the question in English:
 
 DEFAULT_LANGUAGE = 'vi'
 
+# Regex từ khoá cần search của từng ngôn ngữ, biên dịch một lần
+SEARCH_KEYWORDS = {code: compile_keywords(config['search_keywords']) for code, config in LANGUAGES.items()}
+
 def allowed_file(filename):
     """Kiểm tra file extension hợp lệ"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def detect_language(text):
-    """Tự động phát hiện ngôn ngữ"""
-    if not text:
-        return DEFAULT_LANGUAGE
-    
-    vietnamese_chars = ['ă', 'â', 'đ', 'ê', 'ô', 'ơ', 'ư', 'á', 'à', 'ả', 'ã', 'ạ']
-    if any(char in text.lower() for char in vietnamese_chars):
-        return 'vi'
-    
-    for char in text:
-        if '\u4e00' <= char <= '\u9fff':
-            return 'zh'
-    
-    return 'en'
+def get_stream_format(stream_field, accept=''):
+    """Xác định chế độ streaming từ field 'stream' hoặc Accept header"""
+    if isinstance(stream_field, str):
+        value = stream_field.strip().lower()
+        if value in STREAM_FORMATS:
+            return value
+        stream_field = value in ('1', 'true', 'yes', 'on') if value else None
+
+    if stream_field is False:
+        return None
+
+    if 'text/event-stream' in accept:
+        return 'sse'
+    if 'application/x-ndjson' in accept:
+        return 'ndjson'
+    return 'ndjson' if stream_field else None
+
+def format_stream_frame(event, data, stream_format):
+    """Đóng gói một frame SSE hoặc NDJSON"""
+    payload = json.dumps(data, ensure_ascii=False)
+    if stream_format == 'sse':
+        return f"event: {event}\ndata: {payload}\n\n"
+    return json.dumps({'event': event, **data}, ensure_ascii=False) + "\n"
+
+def new_stream_state():
+    """Trạng thái tích lũy trong lúc stream"""
+    return {'parts': [], 'time_to_first_token': None, 'eval_count': None, 'eval_duration': None,
+            'load_duration': None, 'prompt_eval_count': None, 'prompt_eval_duration': None,
+            'context': None, 'timer': None, 'error': None, 'done': False}
+
+def note_stream_error(state, error):
+    """Lỗi giữa luồng (HTTP status đã gửi là 200) -> request log vẫn ghi như request lỗi"""
+    if state['timer']:
+        state['timer'].note(error=error)
+
+def read_stream_line(line, state, start_time, stream_format):
+    """
+    Xử lý một dòng NDJSON từ Ollama (stream=True).
+    Trả về (frames, done): frames là các frame cần gửi cho client.
+    """
+    chunk = json.loads(line)
+    if chunk.get('error'):
+        state['error'] = chunk['error']
+        note_stream_error(state, chunk['error'])
+        return [format_stream_frame('error', {
+            'error': 'AI service error',
+            'details': chunk['error']
+        }, stream_format)], True
+
+    frames = []
+    token = chunk.get('response', '')
+    if token:
+        if state['time_to_first_token'] is None:
+            state['time_to_first_token'] = (datetime.now() - start_time).total_seconds()
+            if state['timer']:
+                state['timer'].lap('time_to_first_token')
+            logger.debug("Time to first token: %.2fs", state['time_to_first_token'])
+        state['parts'].append(token)
+        frames.append(format_stream_frame('token', {'token': token}, stream_format))
+
+    if chunk.get('done'):
+        state['done'] = True
+        for field in ('eval_count', 'eval_duration', 'load_duration', 'prompt_eval_count',
+                      'prompt_eval_duration', 'context'):
+            state[field] = chunk.get(field)
+        if state['timer']:
+            state['timer'].lap('generation')
+            state['timer'].note(prompt_eval_count=state['prompt_eval_count'], eval_count=state['eval_count'])
+        return frames, True
+    return frames, False
+
+def stream_end_frames(state, meta, start_time, stream_format, on_done=None):
+    """Frame kết thúc sau vòng lặp đọc upstream: 'done', hoặc 'error' nếu luồng bị cắt ngang"""
+    if state['error']:
+        return []
+    if not state['done']:
+        logger.error("Stream ended before Ollama finished")
+        note_stream_error(state, 'Stream interrupted')
+        return [format_stream_frame('error', {
+            'error': 'AI service error',
+            'details': 'Stream interrupted'
+        }, stream_format)]
+
+    frames = [stream_done_frame(state, meta, start_time, stream_format)]
+    if on_done:
+        on_done({'reply': ''.join(state['parts']).strip(), **meta})
+    return frames
+
+def stream_done_frame(state, meta, start_time, stream_format):
+    """Frame cuối: reply đầy đủ + metadata giống response JSON thường"""
+    processing_time = (datetime.now() - start_time).total_seconds()
+    time_to_first_token = state['time_to_first_token']
+    logger.debug("Stream finished (%s) in %.2fs", meta['mode'], processing_time)
+
+    return format_stream_frame('done', {
+        'reply': ''.join(state['parts']).strip(),
+        **meta,
+        'eval_count': state['eval_count'],
+        'time_to_first_token': round(time_to_first_token, 2) if time_to_first_token is not None else None,
+        'processing_time': round(processing_time, 2)
+    }, stream_format)
+
+def wait_for_batch(model):
+    """Chờ đợt micro-batch của model (nếu model có batching); model rảnh thì đi ngay"""
+    gate = batchers.get(model)
+    if gate is not None:
+        gate.wait(busy=admission[model].active > 0)
+
+def generate_admitted(payload, timeout, affinity=None):
+    """Gọi Ollama (không stream) trong một slot admission của model"""
+    wait_for_batch(payload['model'])
+    with admission[payload['model']].slot():
+        metrics.lap('ollama_queue')
+        response = ollama.generate(payload, timeout=timeout, affinity=affinity)
+    if response.status_code == 200:
+        data = response.json()
+        residency.observe(payload['model'], data)
+        chat_metrics.observe_ollama(payload['model'], data)
+        metrics.note(prompt_eval_count=data.get('prompt_eval_count'), eval_count=data.get('eval_count'))
+    return response
+
+def open_generate_stream(payload, timeout, affinity=None):
+    """
+    Mở luồng /api/generate trong một slot admission.
+    Slot được giữ tới khi luồng kết thúc (on_close do SharedStream gọi).
+    """
+    wait_for_batch(payload['model'])
+    controller = admission[payload['model']]
+    admitted_at = controller.acquire()
+    metrics.lap('ollama_queue')
+    try:
+        response, release_backend = ollama.open_stream(payload, timeout=timeout, affinity=affinity)
+    except Exception:
+        controller.release(admitted_at)
+        raise
+
+    def on_close():
+        release_backend()
+        controller.release(admitted_at)
+    return response, on_close
+
+def overloaded_body(error):
+    """Nội dung JSON trả về khi request bị admission control từ chối"""
+    return {
+        'error': 'Server busy',
+        'reason': error.reason,
+        'model': error.model,
+        'retry_after': round(error.retry_after, 1),
+        'hint': 'Too many requests for this model right now. Please retry later.'
+    }
+
+def cached_reply_frames(result, start_time, stream_format):
+    """Frame trả về cho client streaming khi câu trả lời lấy từ cache"""
+    processing_time = round((datetime.now() - start_time).total_seconds(), 2)
+    return [
+        format_stream_frame('token', {'token': result['reply']}, stream_format),
+        format_stream_frame('done', {
+            **result,
+            'cached': True,
+            'time_to_first_token': processing_time,
+            'processing_time': processing_time
+        }, stream_format)
+    ]
+
+def stream_chat_response(payload, timeout, meta, start_time, stream_format, on_done=None,
+                         stream_state=None, affinity=None):
+    """
+    Gửi request streaming tới Ollama và chuyển tiếp từng token cho client.
+
+    Kết nối tới Ollama được mở trước khi trả Response để lỗi kết nối/timeout
+    vẫn đi qua các nhánh except của chat(). Các request giống hệt nhau dùng
+    chung một luồng upstream (coalescer); khi client cuối cùng ngắt kết nối,
+    upstream bị đóng -> Ollama dừng sinh token. Chỗ trong luồng chung được trả khi
+    response đóng (call_on_close), kể cả khi client đi trước khi generator chạy.
+    on_done(result) được gọi khi stream hoàn tất (ví dụ để ghi cache); caller cần
+    các field của chunk cuối (context của phiên) thì truyền stream_state của mình.
+    """
+    flight, shared = coalescer.stream(
+        request_key(payload),
+        lambda: open_generate_stream(payload, timeout, affinity)
+    )
+    if shared:
+        logger.debug("Joined identical in-flight stream")
+        metrics.note(shared=True)
+    timer = metrics.current_timer()
+
+    if flight.status_code != 200:
+        logger.error("Ollama stream error %s: %s", flight.status_code, flight.error_text)
+        return jsonify({
+            'error': 'AI service error',
+            'details': flight.error_text
+        }), 500
+
+    def generate():
+        state = stream_state if stream_state is not None else new_stream_state()
+        state['timer'] = timer
+        lines = flight.lines()
+        try:
+            for line in lines:
+                if not line:
+                    continue
+                frames, done = read_stream_line(line, state, start_time, stream_format)
+                yield from frames
+                if done:
+                    break
+
+            if not shared:
+                residency.observe(payload['model'], state)
+                chat_metrics.observe_ollama(payload['model'], state)
+            yield from stream_end_frames(state, meta, start_time, stream_format, on_done)
+
+        except requests.exceptions.Timeout:
+            logger.error("Stream timeout")
+            note_stream_error(state, 'Request timeout')
+            yield format_stream_frame('error', {
+                'error': 'Request timeout',
+                'hint': 'The AI model took too long to respond. Try a shorter message.'
+            }, stream_format)
+
+        except requests.exceptions.RequestException as e:
+            logger.error("Stream interrupted: %s", e)
+            note_stream_error(state, str(e))
+            yield format_stream_frame('error', {
+                'error': 'AI service error',
+                'details': str(e)
+            }, stream_format)
+
+        except GeneratorExit:
+            logger.debug("Client disconnected")
+            if timer:
+                timer.note(disconnected=True)
+            raise
+
+        finally:
+            lines.close()
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype=STREAM_FORMATS[stream_format],
+        headers=STREAM_HEADERS
+    )
+    response.call_on_close(flight.close)
+    return response
 
 def should_search(message, language):
     """Kiểm tra có cần search Google không"""
     if not message:
         return False
-    message_lower = message.lower()
-    keywords = LANGUAGES[language]['search_keywords']
-    return any(keyword in message_lower for keyword in keywords)
+    return SEARCH_KEYWORDS[language].search(nfc(message).lower()) is not None
 
-def google_search_info(query, num_results=3):
-    """Tìm kiếm Google và lấy URLs"""
-    try:
-        logger.info(f"🔍 Searching Google for: {query}")
-        results = []
-        for url in search(query, num_results=num_results, lang='vi'):
-            results.append(url)
-            if len(results) >= num_results:
-                break
-        logger.info(f"✅ Found {len(results)} results")
-        return results
-    except Exception as e:
-        logger.error(f"❌ Search error: {e}")
-        return []
+def default_image_question(language):
+    """Câu hỏi mặc định khi chỉ gửi ảnh mà không có tin nhắn"""
+    if language == "vi":
+        return "Mô tả chi tiết nội dung bức ảnh này."
+    elif language == "en":
+        return "Describe in detail what is shown in this image."
+    return "详细描述这张图片的内容。"
 
-@app.route('/', methods=['GET'])
-def home():
-    """API info endpoint"""
-    return jsonify({
+def resolve_language(user_message, language):
+    """Dùng ngôn ngữ client gửi lên, nếu không có thì tự phát hiện"""
+    if not language:
+        language = detect_language(user_message, DEFAULT_LANGUAGE)
+        logger.debug("Auto-detected language: %s", language)
+
+    if language not in LANGUAGES:
+        logger.warning("Unknown language %r, using default: %s", language, DEFAULT_LANGUAGE)
+        language = DEFAULT_LANGUAGE
+    return language
+
+def build_search_context(search_results, language):
+    """Tạo đoạn context từ kết quả search để chèn vào system prompt"""
+    if not search_results:
+        return ""
+    if language == 'vi':
+        search_context = f"\n\nThông tin tham khảo từ web (ngày {datetime.now().strftime('%d/%m/%Y')}):\n"
+    elif language == 'en':
+        search_context = f"\n\nReference information from web ({datetime.now().strftime('%m/%d/%Y')}):\n"
+    else:
+        search_context = f"\n\n网络参考信息 ({datetime.now().strftime('%Y/%m/%d')}):\n"
+
+    search_context += "\n".join([f"- {url}" for url in search_results])
+    search_context += "\n\nHãy dựa vào thông tin trên để trả lời chính xác."
+    return search_context
+
+def retrieve_passages(user_message):
+    """Tìm các đoạn tài liệu liên quan trong chỉ mục cục bộ"""
+    passages = retriever.search(user_message, top_k=RETRIEVAL_TOP_K)
+    if passages:
+        logger.debug("Retrieved %d passages: %s", len(passages), [p['source'] for p in passages])
+        metrics.note(passages=len(passages))
+    return passages
+
+def build_passage_context(passages, language):
+    """Tạo đoạn context từ các đoạn tài liệu cục bộ (giới hạn RETRIEVAL_MAX_CHARS ký tự)"""
+    if language == 'vi':
+        header = "\n\nThông tin tham khảo từ tài liệu lịch sử:\n"
+        footer = "\n\nHãy dựa vào thông tin trên để trả lời chính xác."
+    elif language == 'en':
+        header = "\n\nReference information from history documents:\n"
+        footer = "\n\nUse the information above to answer accurately."
+    else:
+        header = "\n\n历史资料参考信息：\n"
+        footer = "\n\n请根据以上信息准确回答。"
+
+    blocks, budget = [], RETRIEVAL_MAX_CHARS
+    for passage in passages:
+        text = passage['text'][:budget]
+        if not text:
+            break
+        blocks.append(f"[{passage['title']}] {text}")
+        budget -= len(text)
+    return header + "\n".join(f"- {block}" for block in blocks) + footer
+
+def passage_sources(passages):
+    """Tên tài liệu nguồn (không trùng, giữ thứ tự) cho field search_results"""
+    return list(dict.fromkeys(p['title'] for p in passages))
+
+def build_context(passages, web_results, language):
+    """Ghép context từ tài liệu cục bộ và web -> (search_context, search_results, context_source)"""
+    search_context, search_results, sources = "", [], []
+    if passages:
+        search_context += build_passage_context(passages, language)
+        search_results += passage_sources(passages)
+        sources.append('local')
+    if web_results:
+        logger.debug("Added %d search results to context", len(web_results))
+        search_context += build_search_context(web_results, language)
+        search_results += web_results
+        sources.append('web')
+    return search_context, search_results, '+'.join(sources) or None
+
+def gather_context(user_message, language, search_needed, retrieval_query=None):
+    """
+    Web search (chạy nền) song song với tìm tài liệu cục bộ.
+    Trả về (search_context, search_results, context_source, web_results).
+    """
+    search_future = None
+    if search_needed:
+        logger.debug("Search is needed for this query")
+        search_future = web_search.submit(user_message, language)
+        search_deadline = web_search.deadline()
+
+    passages = retrieve_passages(retrieval_query or user_message)
+    metrics.lap('retrieval')
+    web_results = web_search.result(search_future, search_deadline) if search_future else []
+    metrics.lap('search')
+    return (*build_context(passages, web_results, language), web_results)
+
+def cache_text_answer(user_message, language, search_needed, web_results, result):
+    """Ghi câu trả lời text vào answer cache"""
+    # Search quá hạn -> không cache câu trả lời thiếu context; lần sau search đã có trong cache
+    if result['reply'] and not (search_needed and not web_results):
+        answer_cache.put(user_message, language, TEXT_MODEL, TEXT_OPTIONS, result,
+                         ttl=ANSWER_CACHE_SEARCH_TTL if search_needed else None)
+
+def build_text_payload(user_message, language, search_context=""):
+    """Tạo payload /api/generate cho TEXT_MODEL"""
+    full_prompt = LANGUAGES[language]['system_prompt'].format(
+        message=user_message,
+        search_context=search_context
+    )
+    return residency.prepare({
+        "model": TEXT_MODEL,
+        "prompt": full_prompt,
+        "stream": False,
+        "options": dict(TEXT_OPTIONS)
+    })
+
+def build_vision_payload(user_message, language, image):
+    """Tạo payload /api/generate cho VISION_MODEL (image: PreparedImage, base64 lúc gửi)"""
+    full_prompt = LANGUAGES[language]['vision_prompt'].format(message=user_message)
+    return residency.prepare({
+        "model": VISION_MODEL,
+        "prompt": full_prompt,
+        "images": [image],
+        "stream": False,
+        "options": dict(VISION_OPTIONS)
+    })
+
+def build_chat_meta(mode, language, searched=False, search_results=None, image_filename=None,
+                    image_stats=None, context_source=None):
+    """Metadata chung của response /chat (JSON thường và frame cuối khi stream)"""
+    meta = {
+        'model': VISION_MODEL if mode == 'vision' else TEXT_MODEL,
+        'mode': mode,
+        'language': language,
+        'language_name': LANGUAGES[language]['name'],
+        'searched': searched,
+        'search_results': search_results or [],
+        'has_image': mode == 'vision'
+    }
+    if mode == 'text':
+        meta['context_source'] = context_source
+    if mode == 'vision':
+        meta['image_filename'] = image_filename
+        meta['image_stats'] = image_stats
+    return meta
+
+def build_history_context(history, language):
+    """Các lượt trước của phiên, dùng khi phải dựng lại prompt vì không còn context"""
+    if not history:
+        return ""
+    if language == 'vi':
+        header, user, assistant = "\n\nCuộc hội thoại trước đó:\n", "Học sinh", "Trợ lý"
+    elif language == 'en':
+        header, user, assistant = "\n\nPrevious conversation:\n", "Student", "Assistant"
+    else:
+        header, user, assistant = "\n\n之前的对话：\n", "学生", "助手"
+    return header + "\n".join(f"{user}: {message}\n{assistant}: {reply}" for message, reply in history)
+
+def build_session_payload(user_message, language, context, history, search_context=""):
+    """
+    Payload cho một lượt trong phiên: còn context thì chỉ gửi câu hỏi mới kèm context
+    (Ollama không phải đánh giá lại phần đầu), không thì dựng lại prompt từ history.
+    """
+    if context:
+        full_prompt = LANGUAGES[language]['followup_prompt'].format(
+            message=user_message,
+            search_context=search_context
+        )
+    else:
+        full_prompt = LANGUAGES[language]['system_prompt'].format(
+            message=user_message,
+            search_context=build_history_context(history, language) + search_context
+        )
+    payload = {
+        "model": TEXT_MODEL,
+        "prompt": full_prompt,
+        "stream": False,
+        "options": dict(TEXT_OPTIONS)
+    }
+    if context:
+        payload['context'] = context
+    return residency.prepare(payload)
+
+def session_retrieval_query(session, user_message):
+    """Câu hỏi tiếp theo thường thiếu chủ ngữ ("còn trận đó thì sao?") -> tìm kèm câu hỏi trước"""
+    history = session.history()
+    return f"{history[-1][0]} {user_message}" if history else user_message
+
+def build_session_meta(session, language, context, search_results=None, context_source=None):
+    """Metadata của một lượt trong phiên: như /chat + session_id, số lượt, context có được dùng lại"""
+    return {
+        **build_chat_meta('text', language, searched=bool(search_results),
+                          search_results=search_results, context_source=context_source),
+        'session_id': session.id,
+        'turn': session.turn_count + 1,
+        'context_reused': context is not None
+    }
+
+def session_not_found_body(session_id):
+    return {
+        'error': 'Session not found',
+        'session_id': session_id,
+        'hint': 'The session ended or expired. Create a new one with POST /sessions.'
+    }
+
+def session_busy_body(session_id):
+    return {
+        'error': 'Session busy',
+        'session_id': session_id,
+        'hint': 'Wait for the previous answer before sending the next message.'
+    }
+
+def get_api_info():
+    """Thông tin API (dùng chung cho Flask và ASGI)"""
+    return {
         'status': 'online',
         'message': 'AI Chat API with Dual-Model System',
         'version': '2.0',
@@ -156,16 +816,29 @@ def home():
         'supported_languages': list(LANGUAGES.keys()),
         'features': [
             'Multi-language support',
+            'Local history document retrieval (BM25)',
             'Google Search integration',
             'Image Understanding (Vision AI)',
             'Auto language detection',
-            'Dual-model system (fast text + smart vision)'
+            'Dual-model system (fast text + smart vision)',
+            'Token streaming (SSE / NDJSON)',
+            'Answer cache for repeated questions',
+            'Vision answer cache for repeated images',
+            'Multi-turn sessions with server-side context',
+            'Batch chat for quiz and flashcard generation'
         ],
         'endpoints': {
             'GET /': 'API information',
             'GET /health': 'Health check',
+            'GET /health/live': 'Liveness probe (process is serving)',
+            'GET /health/ready': 'Readiness probe (Ollama reachable, text model available; 503 otherwise)',
             'GET /languages': 'Supported languages',
-            'POST /chat': 'Send message (JSON for text, FormData for image)'
+            'GET /metrics': 'Prometheus metrics',
+            'POST /chat': 'Send message (JSON for text, FormData for image; "stream" for SSE/NDJSON)',
+            'POST /chat/batch': 'Send up to BATCH_MAX_ITEMS text messages at once (quiz / flashcards)',
+            'POST /sessions': 'Create a conversation session',
+            'POST /sessions/<id>/chat': 'Send the next message of a session (JSON, "stream" supported)',
+            'DELETE /sessions/<id>': 'End a session'
         },
         'image_support': {
             'enabled': True,
@@ -173,61 +846,165 @@ def home():
             'max_size': '10MB',
             'usage': 'Send as FormData with fields: message, language (optional), image (file)'
         }
-    })
+    }
 
-@app.route('/languages', methods=['GET'])
-def get_languages():
-    """Get supported languages"""
-    return jsonify({
+def get_languages_info():
+    """Danh sách ngôn ngữ hỗ trợ"""
+    return {
         'languages': {
             code: {'name': lang['name']} 
             for code, lang in LANGUAGES.items()
         },
         'default': DEFAULT_LANGUAGE
-    })
+    }
 
-@app.route('/health', methods=['GET'])
-def health():
-    """Health check endpoint"""
-    try:
-        test_response = requests.get("http://localhost:11434/api/tags", timeout=5)
-        if test_response.status_code == 200:
-            ollama_status = "running"
-            models_data = test_response.json()
-            available_models = [m['name'] for m in models_data.get('models', [])]
-        else:
-            ollama_status = "error"
-            available_models = []
-    except Exception as e:
-        logger.error(f"Health check error: {e}")
-        ollama_status = "not running"
-        available_models = []
-    
-    return jsonify({
+def ollama_snapshot():
+    """Trạng thái Ollama theo lượt probe gần nhất (không gọi Ollama), probe lại nền nếu đã cũ"""
+    age = ollama.refresh_if_stale(HEALTH_MAX_AGE)
+    return {
+        'status': ollama.status() if age is not None else 'unknown',
+        'checked_at': datetime.fromtimestamp(ollama.probed_at).isoformat() if age is not None else None,
+        'age': round(age, 1) if age is not None else None,
+        'stale': age is None or age > HEALTH_MAX_AGE
+    }
+
+def build_readiness():
+    """(body, status) của /health/ready: sẵn sàng khi Ollama đã probe, còn node khoẻ và có model text"""
+    snapshot = ollama_snapshot()
+    checks = {
+        'ollama_probed': snapshot['age'] is not None,
+        'ollama_reachable': snapshot['status'] in ('running', 'degraded'),
+        'text_model_available': ollama.has_model(TEXT_MODEL)
+    }
+    ready = all(checks.values())
+    return {
+        'status': 'ready' if ready else 'not ready',
+        'checks': checks,
+        'vision_model_available': ollama.has_model(VISION_MODEL),
+        'age': snapshot['age']
+    }, 200 if ready else 503
+
+def build_health_status(client_stats=None, **sections):
+    """Nội dung /health từ kết quả probe nền gần nhất (+ các mục thống kê riêng của server)"""
+    return {
         'status': 'ok',
         'timestamp': datetime.now().isoformat(),
         'ollama': {
-            'status': ollama_status,
-            'url': OLLAMA_URL
+            **ollama_snapshot(),
+            'url': OLLAMA_URL,
+            'client': client_stats
         },
         'models': {
             'text': {
                 'name': TEXT_MODEL,
-                'available': TEXT_MODEL in ' '.join(available_models)
+                'available': ollama.has_model(TEXT_MODEL),
+                'loaded': residency.is_loaded(TEXT_MODEL)
             },
             'vision': {
                 'name': VISION_MODEL,
-                'available': VISION_MODEL in ' '.join(available_models)
+                'available': ollama.has_model(VISION_MODEL),
+                'loaded': residency.is_loaded(VISION_MODEL)
             }
         },
-        'available_models': available_models,
+        'residency': residency.stats(),
+        'batching': {'text': batchers[TEXT_MODEL].stats()},
+        'available_models': ollama.available_models(),
+        'answer_cache': answer_cache.stats(),
+        'vision_cache': vision_cache.stats(),
+        'retrieval': retriever.stats(),
+        'web_search': web_search.stats(),
+        'sessions': sessions.stats(),
+        'logging': request_log.stats(),
+        **sections,
         'languages': list(LANGUAGES.keys()),
         'features': {
+            'local_retrieval': True,
             'google_search': True,
             'vision': True,
             'multi_language': True
         }
-    })
+    }
+
+@app.route('/', methods=['GET'])
+def home():
+    """API info endpoint"""
+    return jsonify(get_api_info())
+
+@app.route('/languages', methods=['GET'])
+def get_languages():
+    """Get supported languages"""
+    return jsonify(get_languages_info())
+
+@app.route('/health', methods=['GET'])
+def health():
+    """Health check endpoint (đọc trạng thái prober nền, không chờ Ollama)"""
+    return jsonify(build_health_status(ollama.stats(),
+                                       coalescing=coalescer.stats(),
+                                       admission={
+                                           'text': admission[TEXT_MODEL].stats(),
+                                           'vision': admission[VISION_MODEL].stats()
+                                       }))
+
+@app.route('/health/live', methods=['GET'])
+def health_live():
+    """Liveness: process còn phục vụ request (không phụ thuộc Ollama)"""
+    return jsonify({'status': 'alive', 'timestamp': datetime.now().isoformat()})
+
+@app.route('/health/ready', methods=['GET'])
+def health_ready():
+    """Readiness: 503 khi chưa probe được Ollama, không còn node khoẻ hoặc thiếu model text"""
+    body, status = build_readiness()
+    return jsonify(body), status
+
+def server_metric_families(admission_controllers):
+    """Metric đọc từ stats() của các thành phần lúc scrape (admission truyền vào: Flask hoặc ASGI)"""
+    caches = {'answer': answer_cache.stats(), 'vision': vision_cache.stats(), 'web_search': web_search.stats()}
+    admissions = {name: controller.stats() for name, controller in admission_controllers.items()}
+    backends = ollama.stats()['backends']
+    session_stats = sessions.stats()
+    return [
+        ('cache_hit_ratio', 'gauge', 'Hit ratio of server-side caches',
+         [('cache_hit_ratio', {'cache': name}, stats['hit_ratio']) for name, stats in caches.items()]),
+        ('cache_entries', 'gauge', 'Entries held by server-side caches',
+         [('cache_entries', {'cache': name}, stats['entries']) for name, stats in caches.items()]),
+        ('admission_active', 'gauge', 'Ollama calls holding an admission slot',
+         [('admission_active', {'model': model}, stats['active']) for model, stats in admissions.items()]),
+        ('admission_queue_depth', 'gauge', 'Requests waiting for an admission slot',
+         [('admission_queue_depth', {'model': model}, stats['queue_depth']) for model, stats in admissions.items()]),
+        ('admission_rejected_total', 'counter', 'Requests rejected by admission control',
+         [('admission_rejected_total', {'model': model}, stats['rejected'] + stats['timed_out'])
+          for model, stats in admissions.items()]),
+        ('ollama_backend_healthy', 'gauge', 'Whether an Ollama backend passes health probes',
+         [('ollama_backend_healthy', {'host': b['host']}, int(b['healthy'])) for b in backends]),
+        ('ollama_backend_outstanding', 'gauge', 'Requests in flight on an Ollama backend',
+         [('ollama_backend_outstanding', {'host': b['host']}, b['outstanding']) for b in backends]),
+        ('sessions_active', 'gauge', 'Conversation sessions held in memory',
+         [('sessions_active', {}, session_stats['sessions'])])
+    ]
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus metrics"""
+    return Response(chat_metrics.render(server_metric_families(admission)), content_type=METRICS_CONTENT_TYPE)
+
+@app.before_request
+def start_request_timer():
+    if request.endpoint in METRIC_ENDPOINTS:
+        g.request_timer = timer = chat_metrics.begin(request.endpoint)
+        timer.note(request_id=request_id(request.headers.get('X-Request-ID')),
+                   request_bytes=request.content_length)
+
+@app.after_request
+def finish_request_timer(response):
+    timer = g.pop('request_timer', None)
+    if timer is not None:
+        response.headers['X-Request-ID'] = timer.fields['request_id']
+        if not response.is_streamed:
+            timer.lap('serialization')
+            timer.note(response_bytes=response.content_length)
+        # Stream: kết thúc khi response đóng (gửi xong hoặc client ngắt)
+        response.call_on_close(lambda: finish_request(timer, response.status_code))
+    return response
 
 @app.route('/chat', methods=['POST'])
 def chat():
@@ -237,29 +1014,37 @@ def chat():
     TEXT MODE (JSON):
     {
         "message": "Your question",
-        "language": "vi" (optional)
+        "language": "vi" (optional),
+        "stream": true / "sse" / "ndjson" (optional)
     }
     
     IMAGE MODE (FormData):
     - message: Your question
     - language: vi/en/zh (optional)
+    - stream: true/sse/ndjson (optional)
     - image: Image file
+
+    STREAMING: bật bằng field "stream" hoặc Accept: text/event-stream /
+    application/x-ndjson. Server gửi các frame "token", frame cuối "done"
+    chứa reply + metadata (model, language, searched, time_to_first_token,
+    processing_time), hoặc frame "error".
     """
     
     start_time = datetime.now()
-    logger.info(f"\n{'='*60}")
-    logger.info(f"📨 NEW REQUEST - {start_time.strftime('%H:%M:%S')}")
-    logger.info(f"Content-Type: {request.content_type}")
+    logger.debug("New chat request (Content-Type: %s)", request.content_type)
     
     try:
         has_image = False
-        image_base64 = None
+        prepared = None
         image_filename = None
+        image_stats = None
+        image_hashes = None
         
         if request.content_type and 'multipart/form-data' in request.content_type:
-            logger.info("Request type: FormData (may contain image)")
+            logger.debug("Request type: FormData (may contain image)")
             user_message = request.form.get('message', '')
             language = request.form.get('language', None)
+            stream_field = request.form.get('stream', None)
             
             # Check for image
             if 'image' in request.files:
@@ -268,202 +1053,479 @@ def chat():
                     if allowed_file(image_file.filename):
                         has_image = True
                         image_filename = secure_filename(image_file.filename)
-                        image_bytes = image_file.read()
-                        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-                        logger.info(f"Image received: {image_filename}")
-                        logger.info(f"Image size: {len(image_bytes) / 1024:.2f} KB")
+                        metrics.lap('parse')
+                        try:
+                            prepared = preprocess_image(image_file.stream)
+                        except ImageRejected as e:
+                            return jsonify({
+                                'error': 'Invalid image',
+                                'details': str(e)
+                            }), 400
+                        image_stats = prepared.stats()
+                        image_hashes = (prepared.digest(), prepared.phash)
+                        metrics.lap('image_encode')
+                        metrics.note(image_bytes=prepared.bytes_before, image_bytes_sent=prepared.bytes_after)
+                        logger.debug("Image received: %s (%.2f KB -> %.2f KB)", image_filename,
+                                     prepared.bytes_before / 1024, prepared.bytes_after / 1024)
                     else:
                         return jsonify({
                             'error': 'Invalid file format',
                             'allowed_formats': list(ALLOWED_EXTENSIONS)
                         }), 400
         else:
-            logger.info("Request type: JSON (text only)")
+            logger.debug("Request type: JSON (text only)")
             data = request.json
             if not data:
                 return jsonify({'error': 'No data provided'}), 400
             user_message = data.get('message', '')
             language = data.get('language', None)
+            stream_field = data.get('stream', None)
         
         # ====== HANDLE EMPTY MESSAGE ======
         if not user_message or not user_message.strip():
             if has_image:
                 # Nếu có ảnh mà không có câu hỏi → tự tạo prompt mặc định
-                if language == "vi":
-                    user_message = "Mô tả chi tiết nội dung bức ảnh này."
-                elif language == "en":
-                    user_message = "Describe in detail what is shown in this image."
-                else:  # zh
-                    user_message = "详细描述这张图片的内容。"
+                user_message = default_image_question(language)
             else:
                 return jsonify({"error": "Message is required"}), 400
 
         user_message = user_message.strip()
-        logger.info(f"Message: {user_message[:100]}...")
+        logger.debug("Message: %.100s", user_message)
+        metrics.note(message_chars=len(user_message))
 
-        
-        if not language:
-            language = detect_language(user_message)
-            logger.info(f"Auto-detected language: {language} ({LANGUAGES[language]['name']})")
-        
-        if language not in LANGUAGES:
-            logger.warning(f"Unknown language '{language}', using default: {DEFAULT_LANGUAGE}")
-            language = DEFAULT_LANGUAGE
+        language = resolve_language(user_message, language)
+
+        stream_format = get_stream_format(stream_field, request.headers.get('Accept', ''))
+        if stream_format:
+            metrics.note(stream=stream_format)
+        metrics.label(mode='vision' if has_image else 'text', language=language)
+        # Vision: 'parse' đã đo trước khi xử lý ảnh, phần sau image_encode tính riêng
+        metrics.lap('image' if has_image else 'parse')
 
         if has_image:
-            model = VISION_MODEL
-            logger.info(f"MODE: VISION")
-            logger.info(f"Using model: {model}")
+            logger.debug("Mode: vision (%s)", VISION_MODEL)
+
+            payload = build_vision_payload(user_message, language, prepared)
+            meta = build_chat_meta('vision', language, image_filename=image_filename,
+                                   image_stats=image_stats)
+            metrics.lap('prompt_build')
+
+            cached, match = vision_cache.lookup(*image_hashes, user_message, language,
+                                                VISION_MODEL, VISION_OPTIONS)
+            metrics.lap('cache')
+            if cached:
+                logger.debug("Vision cache hit (%s)", match)
+                metrics.note(cache=match)
+                # reply từ cache, metadata (tên file, image_stats) của request hiện tại
+                cached = {**cached, **meta}
+                if stream_format:
+                    return Response(cached_reply_frames(cached, start_time, stream_format),
+                                    mimetype=STREAM_FORMATS[stream_format], headers=STREAM_HEADERS)
+                return jsonify({
+                    **cached,
+                    'cached': True,
+                    'processing_time': round((datetime.now() - start_time).total_seconds(), 2)
+                })
 
-            prompt_template = LANGUAGES[language]['vision_prompt']
-            full_prompt = prompt_template.format(message=user_message)
+            def cache_vision_answer(result):
+                if result['reply']:
+                    vision_cache.put(*image_hashes, user_message, language, VISION_MODEL,
+                                     VISION_OPTIONS, result)
             
-            logger.info(f"Sending to Ollama (Vision)...")
-
-            response = requests.post(OLLAMA_URL, json={
-                "model": model,
-                "prompt": full_prompt,
-                "images": [image_base64],
-                "stream": False,
-                "options": {
-                    "temperature": 0.3,
-                    "top_p": 0.9,
-                    "num_predict": 500
-                }
-            }, timeout=180)  
+            # Model vision chưa nạp -> chờ ngắn để các request vision cùng đi một đợt
+            residency.hold(VISION_MODEL)
+
+            if stream_format:
+                streamed = stream_chat_response(payload, VISION_TIMEOUT, meta, start_time, stream_format,
+                                                on_done=cache_vision_answer)
+                # Body gửi Ollama đã đi hết khi mở luồng -> đỉnh bộ nhớ của request đã đủ
+                image_stats['peak_memory'] = prepared.meter.peak
+                metrics.note(peak_memory=prepared.meter.peak)
+                return streamed
+
+            response, shared = coalescer.do(
+                request_key(payload),
+                lambda: generate_admitted(payload, VISION_TIMEOUT)
+            )
+            metrics.lap('generation')
+            image_stats['peak_memory'] = prepared.meter.peak
+            metrics.note(peak_memory=prepared.meter.peak)
+            if shared:
+                logger.debug("Shared result of identical in-flight request")
+                metrics.note(shared=True)
             
             if response.status_code == 200:
                 ai_response = response.json().get('response', '').strip()
                 processing_time = (datetime.now() - start_time).total_seconds()
                 
-                logger.info(f"Vision response received")
-                logger.info(f"Processing time: {processing_time:.2f}s")
-                logger.info(f"Response preview: {ai_response[:100]}...")
-                logger.info(f"{'='*60}\n")
+                logger.debug("Vision response in %.2fs: %.100s", processing_time, ai_response)
+                cache_vision_answer({'reply': ai_response, **meta})
                 
                 return jsonify({
                     'reply': ai_response,
-                    'model': model,
-                    'mode': 'vision',
-                    'language': language,
-                    'language_name': LANGUAGES[language]['name'],
-                    'searched': False,
-                    'search_results': [],
-                    'has_image': True,
-                    'image_filename': image_filename,
+                    **meta,
                     'processing_time': round(processing_time, 2)
                 })
             else:
-                logger.error(f"Ollama vision error: {response.status_code}")
-                logger.error(f"Response: {response.text}")
+                logger.error("Ollama vision error %s: %s", response.status_code, response.text)
                 return jsonify({
                     'error': 'Vision AI service error',
                     'details': response.text
                 }), 500
 
         else:
-            model = TEXT_MODEL
-            logger.info(f"MODE: TEXT")
-            logger.info(f"Using model: {model}")
+            logger.debug("Mode: text (%s)", TEXT_MODEL)
 
-            search_context = ""
-            searched = False
-            search_results = []
-            
-            if should_search(user_message, language):
-                logger.info("Search is needed for this query")
-                search_results = google_search_info(user_message, num_results=3)
-                
-                if search_results:
-                    searched = True
-                    if language == 'vi':
-                        search_context = f"\n\nThông tin tham khảo từ web (ngày {datetime.now().strftime('%d/%m/%Y')}):\n"
-                    elif language == 'en':
-                        search_context = f"\n\nReference information from web ({datetime.now().strftime('%m/%d/%Y')}):\n"
-                    else:
-                        search_context = f"\n\n网络参考信息 ({datetime.now().strftime('%Y/%m/%d')}):\n"
-                    
-                    search_context += "\n".join([f"- {url}" for url in search_results])
-                    search_context += "\n\nHãy dựa vào thông tin trên để trả lời chính xác."
-                    logger.info(f"Added {len(search_results)} search results to context")
-
-            system_prompt = LANGUAGES[language]['system_prompt']
-            full_prompt = system_prompt.format(
-                message=user_message,
-                search_context=search_context
+            search_needed = should_search(user_message, language)
+            cached, match = answer_cache.lookup(user_message, language, TEXT_MODEL, TEXT_OPTIONS)
+            metrics.lap('cache')
+            if cached:
+                logger.debug("Answer cache hit (%s)", match)
+                metrics.note(cache=match)
+                if stream_format:
+                    return Response(cached_reply_frames(cached, start_time, stream_format),
+                                    mimetype=STREAM_FORMATS[stream_format], headers=STREAM_HEADERS)
+                return jsonify({
+                    **cached,
+                    'cached': True,
+                    'processing_time': round((datetime.now() - start_time).total_seconds(), 2)
+                })
+
+            search_context, search_results, context_source, web_results = gather_context(
+                user_message, language, search_needed)
+
+            def cache_answer(result):
+                cache_text_answer(user_message, language, search_needed, web_results, result)
+
+            payload = build_text_payload(user_message, language, search_context)
+            meta = build_chat_meta('text', language, searched=bool(search_results),
+                                   search_results=search_results, context_source=context_source)
+            metrics.lap('prompt_build')
+
+            if stream_format:
+                return stream_chat_response(payload, TEXT_TIMEOUT, meta, start_time, stream_format,
+                                            on_done=cache_answer)
+
+            response, shared = coalescer.do(
+                request_key(payload),
+                lambda: generate_admitted(payload, TEXT_TIMEOUT)
             )
-            
-            logger.info(f"Sending to Ollama (Text)...")
-
-            response = requests.post(OLLAMA_URL, json={
-                "model": model,
-                "prompt": full_prompt,
-                "stream": False,
-                "options": {
-                    "temperature": 0.2,
-                    "top_p": 0.9,
-                    "top_k": 40,
-                    "num_predict": 400
-                }
-            }, timeout=120)
+            metrics.lap('generation')
+            if shared:
+                logger.debug("Shared result of identical in-flight request")
+                metrics.note(shared=True)
             
             if response.status_code == 200:
                 ai_response = response.json().get('response', '').strip()
                 processing_time = (datetime.now() - start_time).total_seconds()
                 
-                logger.info(f"Text response received")
-                logger.info(f"Processing time: {processing_time:.2f}s")
-                logger.info(f"Response preview: {ai_response[:100]}...")
-                logger.info(f"{'='*60}\n")
+                logger.debug("Text response in %.2fs: %.100s", processing_time, ai_response)
+
+                cache_answer({'reply': ai_response, **meta})
                 
                 return jsonify({
                     'reply': ai_response,
-                    'model': model,
-                    'mode': 'text',
-                    'language': language,
-                    'language_name': LANGUAGES[language]['name'],
-                    'searched': searched,
-                    'search_results': search_results,
-                    'has_image': False,
+                    **meta,
                     'processing_time': round(processing_time, 2)
                 })
             else:
-                logger.error(f"Ollama error: {response.status_code}")
-                logger.error(f"Response: {response.text}")
+                logger.error("Ollama error %s: %s", response.status_code, response.text)
                 return jsonify({
                     'error': 'AI service error',
                     'details': response.text
                 }), 500
             
-    except requests.exceptions.Timeout:
+    except Exception as e:
+        return chat_error_response(e)
+
+def chat_error_body(error):
+    """(body, status, headers) cho một exception khi xử lý chat"""
+    if isinstance(error, Overloaded):
+        logger.warning("Request rejected by admission control: %s", error)
+        return overloaded_body(error), error.status_code, {'Retry-After': error.retry_after_header}
+
+    if isinstance(error, RequestEntityTooLarge):
+        # Werkzeug dừng đọc form khi body vượt MAX_CONTENT_LENGTH
+        return REQUEST_TOO_LARGE_BODY, 413, {}
+
+    if isinstance(error, requests.exceptions.Timeout):
         logger.error("Request timeout")
-        return jsonify({
+        return {
             'error': 'Request timeout',
             'hint': 'The AI model took too long to respond. Try a shorter message.'
-        }), 504
-        
-    except requests.exceptions.ConnectionError:
+        }, 504, {}
+
+    if isinstance(error, requests.exceptions.ConnectionError):
         logger.error("Cannot connect to Ollama")
-        return jsonify({
+        return {
             'error': 'Cannot connect to Ollama',
             'hint': 'Make sure Ollama is running: ollama serve'
-        }), 503
-        
+        }, 503, {}
+
+    logger.error("Unexpected error: %s", error, exc_info=True)
+    return {
+        'error': 'Internal server error',
+        'details': str(error)
+    }, 500, {}
+
+def chat_error_response(error):
+    """Response lỗi của /chat và /sessions/<id>/chat (gọi trong khối except)"""
+    body, status, headers = chat_error_body(error)
+    return jsonify(body), status, headers
+
+def answer_text(user_message, language, start_time):
+    """
+    Một câu hỏi text, không stream: answer cache -> retrieval/search -> Ollama.
+    Trả về (body, status) như response của /chat.
+    """
+    search_needed = should_search(user_message, language)
+    cached, match = answer_cache.lookup(user_message, language, TEXT_MODEL, TEXT_OPTIONS)
+    if cached:
+        return {
+            **cached,
+            'cached': True,
+            'processing_time': round((datetime.now() - start_time).total_seconds(), 2)
+        }, 200
+
+    search_context, search_results, context_source, web_results = gather_context(
+        user_message, language, search_needed)
+    payload = build_text_payload(user_message, language, search_context)
+    meta = build_chat_meta('text', language, searched=bool(search_results),
+                           search_results=search_results, context_source=context_source)
+
+    response, shared = coalescer.do(
+        request_key(payload),
+        lambda: generate_admitted(payload, TEXT_TIMEOUT)
+    )
+    if response.status_code != 200:
+        logger.error("Ollama error %s", response.status_code)
+        return {'error': 'AI service error', 'details': response.text}, 500
+
+    result = {'reply': response.json().get('response', '').strip(), **meta}
+    cache_text_answer(user_message, language, search_needed, web_results, result)
+    return {
+        **result,
+        'processing_time': round((datetime.now() - start_time).total_seconds(), 2)
+    }, 200
+
+def parse_batch_items(data):
+    """Câu hỏi của /chat/batch -> ([{'message', 'language'}], None) hoặc (None, body lỗi)"""
+    messages = data.get('messages')
+    if not isinstance(messages, list) or not messages:
+        return None, {'error': 'messages must be a non-empty list'}
+    if len(messages) > BATCH_MAX_ITEMS:
+        return None, {'error': 'Too many messages', 'max_items': BATCH_MAX_ITEMS}
+
+    shared_language = data.get('language')
+    items = []
+    for entry in messages:
+        if isinstance(entry, dict):
+            message, language = entry.get('message'), entry.get('language') or shared_language
+        else:
+            message, language = entry, shared_language
+        items.append({
+            'message': message.strip() if isinstance(message, str) else '',
+            'language': language
+        })
+    return items, None
+
+def batch_summary(results, start_time):
+    """Phần tổng kết của response /chat/batch (và frame 'done' khi stream)"""
+    succeeded = sum(1 for result in results if result['status'] == 200)
+    return {
+        'count': len(results),
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded,
+        'processing_time': round((datetime.now() - start_time).total_seconds(), 2)
+    }
+
+def answer_batch_item(index, item):
+    """Kết quả một câu của batch; lỗi của câu này không làm hỏng cả batch"""
+    if not item['message']:
+        return {'index': index, 'status': 400, 'error': 'Message is required'}
+    start_time = datetime.now()
+    language = resolve_language(item['message'], item['language'])
+    try:
+        body, status = answer_text(item['message'], language, start_time)
     except Exception as e:
-        logger.error(f"Unexpected error: {str(e)}", exc_info=True)
+        body, status, _ = chat_error_body(e)
+    return {'index': index, 'status': status, **body}
+
+def run_batch(items):
+    """
+    Chạy các câu của batch trên batch_executor, tối đa BATCH_CONCURRENCY câu cùng lúc;
+    yield kết quả theo thứ tự xong. Đóng generator (client ngắt) -> các câu chưa chạy bị bỏ.
+    """
+    results = queue.SimpleQueue()
+    pending = iter(enumerate(items))
+    lock = threading.Lock()
+    cancelled = threading.Event()
+
+    def worker():
+        while not cancelled.is_set():
+            with lock:
+                entry = next(pending, None)
+            if entry is None:
+                return
+            results.put(answer_batch_item(*entry))
+
+    for _ in range(min(BATCH_CONCURRENCY, len(items))):
+        batch_executor.submit(worker)
+    try:
+        for _ in range(len(items)):
+            yield results.get()
+    finally:
+        cancelled.set()
+
+@app.route('/sessions', methods=['POST'])
+def create_session():
+    """
+    Tạo phiên hội thoại nhiều lượt.
+
+    {"language": "vi" (optional, mặc định tự phát hiện ở lượt đầu)}
+    """
+    data = request.get_json(silent=True) or {}
+    language = data.get('language')
+    session = sessions.create(resolve_language('', language) if language else None)
+    logger.info("Session created: %s", session.id)
+    return jsonify({**session.info(), 'idle_ttl': sessions.idle_ttl}), 201
+
+@app.route('/sessions/<session_id>', methods=['DELETE'])
+def end_session(session_id):
+    """Kết thúc phiên, giải phóng context đã lưu"""
+    if not sessions.end(session_id):
+        return jsonify(session_not_found_body(session_id)), 404
+    logger.info("Session ended: %s", session_id)
+    return jsonify({'session_id': session_id, 'ended': True})
+
+@app.route('/sessions/<session_id>/chat', methods=['POST'])
+def session_chat(session_id):
+    """
+    Một lượt hỏi trong phiên: {"message": "...", "stream": ... (optional)}
+
+    Response giống /chat, thêm session_id, turn, context_reused và
+    prompt_eval_count (số token Ollama phải đánh giá cho lượt này).
+    """
+    start_time = datetime.now()
+    session = sessions.get(session_id)
+    if session is None:
+        return jsonify(session_not_found_body(session_id)), 404
+
+    data = request.get_json(silent=True)
+    if not data:
+        return jsonify({'error': 'No data provided'}), 400
+    user_message = (data.get('message') or '').strip()
+    if not user_message:
+        return jsonify({"error": "Message is required"}), 400
+
+    if not sessions.begin(session):
+        return jsonify(session_busy_body(session_id)), 409
+    response = make_response(session_turn(session, user_message, data.get('stream'), start_time))
+    # Lượt kết thúc khi response đóng (kể cả stream bị client ngắt giữa chừng)
+    response.call_on_close(lambda: sessions.finish(session))
+    return response
+
+@app.route('/chat/batch', methods=['POST'])
+def chat_batch():
+    """
+    Nhiều câu hỏi text trong một request (tạo quiz / flashcard):
+    {
+        "messages": ["Câu 1", {"message": "Question 2", "language": "en"}],
+        "language": "vi" (optional, dùng cho các câu không ghi language),
+        "stream": true / "sse" / "ndjson" (optional)
+    }
+
+    Các câu chạy song song (tối đa BATCH_CONCURRENCY), qua answer cache,
+    retrieval và search như /chat. Không stream: "results" đúng thứ tự gửi lên;
+    stream: mỗi câu xong là một frame "item", frame cuối "done" chứa tổng kết.
+    Mỗi kết quả có "index" và "status"; câu lỗi có "error", các câu khác vẫn chạy.
+    """
+    start_time = datetime.now()
+    data = request.get_json(silent=True)
+    if not data:
+        return jsonify({'error': 'No data provided'}), 400
+    items, error = parse_batch_items(data)
+    if error:
+        return jsonify(error), 400
+
+    stream_format = get_stream_format(data.get('stream'), request.headers.get('Accept', ''))
+    metrics.label(mode='batch', language=data.get('language') or 'mixed')
+    metrics.note(items=len(items), stream=stream_format)
+
+    if stream_format:
+        def generate():
+            results = []
+            for result in run_batch(items):
+                results.append(result)
+                yield format_stream_frame('item', result, stream_format)
+            yield format_stream_frame('done', batch_summary(results, start_time), stream_format)
+        return Response(generate(), mimetype=STREAM_FORMATS[stream_format], headers=STREAM_HEADERS)
+
+    results = sorted(run_batch(items), key=lambda result: result['index'])
+    metrics.lap('generation')
+    return jsonify({'results': results, **batch_summary(results, start_time)})
+
+def session_turn(session, user_message, stream_field, start_time):
+    """Chạy một lượt của phiên (đã được sessions.begin giữ chỗ)"""
+    logger.debug("Session turn %s #%d: %.100s", session.id, session.turn_count + 1, user_message)
+    metrics.note(session_id=session.id, message_chars=len(user_message))
+    try:
+        if session.language is None:
+            session.language = resolve_language(user_message, None)
+        language = session.language
+        stream_format = get_stream_format(stream_field, request.headers.get('Accept', ''))
+        metrics.label(mode='text', language=language)
+        metrics.lap('parse')
+
+        search_context, search_results, context_source, _ = gather_context(
+            user_message, language, should_search(user_message, language),
+            retrieval_query=session_retrieval_query(session, user_message))
+
+        context = sessions.context_for(session)
+        metrics.note(context_reused=context is not None)
+        payload = build_session_payload(user_message, language, context, session.history(), search_context)
+        meta = build_session_meta(session, language, context, search_results, context_source)
+        metrics.lap('prompt_build')
+
+        if stream_format:
+            state = new_stream_state()
+
+            def record_turn(result):
+                sessions.record(session, user_message, result['reply'], state['context'],
+                                state['prompt_eval_count'], state['eval_count'])
+            return stream_chat_response(payload, TEXT_TIMEOUT, meta, start_time, stream_format,
+                                        on_done=record_turn, stream_state=state, affinity=session.id)
+
+        response = generate_admitted(payload, TEXT_TIMEOUT, affinity=session.id)
+        metrics.lap('generation')
+        if response.status_code != 200:
+            logger.error("Ollama error %s: %s", response.status_code, response.text)
+            return jsonify({
+                'error': 'AI service error',
+                'details': response.text
+            }), 500
+
+        result = response.json()
+        ai_response = result.get('response', '').strip()
+        sessions.record(session, user_message, ai_response, result.get('context'),
+                        result.get('prompt_eval_count'), result.get('eval_count'))
+        processing_time = (datetime.now() - start_time).total_seconds()
+        logger.debug("Session turn answered in %.2fs (context reused: %s)", processing_time, context is not None)
+
         return jsonify({
-            'error': 'Internal server error',
-            'details': str(e)
-        }), 500
+            'reply': ai_response,
+            **meta,
+            'prompt_eval_count': result.get('prompt_eval_count'),
+            'processing_time': round(processing_time, 2)
+        })
+
+    except Exception as e:
+        return chat_error_response(e)
 
 @app.errorhandler(413)
 def request_entity_too_large(error):
     """Handle file too large error"""
-    return jsonify({
-        'error': 'File too large',
-        'max_size': '10MB',
-        'hint': 'Please upload a smaller image'
-    }), 413
+    return jsonify(REQUEST_TOO_LARGE_BODY), 413
 
 @app.errorhandler(404)
 def not_found(error):
@@ -474,82 +1536,91 @@ def not_found(error):
             'GET /': 'API information',
             'GET /health': 'Health check',
             'GET /languages': 'Supported languages',
-            'POST /chat': 'Send message'
+            'POST /chat': 'Send message',
+            'POST /chat/batch': 'Send several text messages',
+            'POST /sessions': 'Create a conversation session'
         }
     }), 404
 
 @app.errorhandler(500)
 def internal_error(error):
     """Handle 500 errors"""
-    logger.error(f"Internal server error: {error}")
+    logger.error("Internal server error: %s", error)
     return jsonify({
         'error': 'Internal server error',
         'hint': 'Please check server logs'
     }), 500
 
+def report_ollama(timeout=10):
+    """
+    In trạng thái Ollama và các model lúc khởi động (chạy ở thread nền), theo
+    lượt probe đầu tiên của prober - cùng cách so tên model với /health.
+    """
+    deadline = time.monotonic() + timeout
+    while ollama_snapshot()['age'] is None and time.monotonic() < deadline:
+        time.sleep(0.1)
+    if ollama_snapshot()['status'] in ('running', 'degraded'):
+        available = ollama.available_models()
+        print(f"Ollama is running ({ollama.status()}, {len(ollama.backends)} backend(s))")
+        print(f"Available models: {len(available)}")
+
+        text_available = ollama.has_model(TEXT_MODEL)
+        vision_available = ollama.has_model(VISION_MODEL)
+        
+        if text_available:
+            print(f"  {TEXT_MODEL} - Ready for text chat "
+                  f"({'loaded' if residency.is_loaded(TEXT_MODEL) else 'not loaded, preloading'})")
+        else:
+            print(f"  {TEXT_MODEL} - NOT FOUND!")
+            print(f"      Run: ollama pull {TEXT_MODEL}")
+        
+        if vision_available:
+            print(f"  {VISION_MODEL} - Ready for image analysis "
+                  f"({'loaded' if residency.is_loaded(VISION_MODEL) else 'not loaded, preloading'})")
+        else:
+            print(f"  {VISION_MODEL} - NOT FOUND!")
+            print(f"      Run: ollama pull {VISION_MODEL}")
+        
+        if not text_available or not vision_available:
+            print("\nWARNING: Some models are missing!")
+            print("   The server will start but features may be limited.")
+    else:
+        print("Ollama is NOT running!")
+        print("  Please start Ollama first: ollama serve")
+        print("  Then pull required models:")
+        print(f"     ollama pull {TEXT_MODEL}")
+        print(f"     ollama pull {VISION_MODEL}")
+
 if __name__ == '__main__':
-    hostname = socket.gethostname()
-    local_ip = socket.gethostbyname(hostname)
-    
+    from run_production import local_ip
+
     print("\n" + "="*70)
     print("AI CHAT API SERVER - DUAL MODEL SYSTEM")
     print("="*70)
     print(f"Text Model:   {TEXT_MODEL} (fast)")
     print(f"Vision Model: {VISION_MODEL} (smart)")
     print(f"Languages:    {', '.join([f'{code} ({LANGUAGES[code]['name']})' for code in LANGUAGES])}")
-    print(f"Features:     Multi-language, Google Search, Image Understanding")
-    print(f"\nServer URLs:")
-    print(f"   Local:   http://localhost:5000")
-    print(f"   Network: http://{local_ip}:5000")
-    print(f"\nEndpoints:")
-    print(f"   GET  /          - API information")
-    print(f"   GET  /health    - Health check")
-    print(f"   GET  /languages - Supported languages")
-    print(f"   POST /chat      - Send message")
-    print(f"\nImage Support:")
+    print("Features:     Multi-language, Google Search, Image Understanding")
+    print("\nServer URLs:")
+    print("   Local:   http://localhost:5000")
+    print(f"   Network: http://{local_ip()}:5000")
+    print("\nEndpoints:")
+    print("   GET  /          - API information")
+    print("   GET  /health    - Health check (/health/live, /health/ready)")
+    print("   GET  /languages - Supported languages")
+    print("   GET  /metrics   - Prometheus metrics")
+    print("   POST /chat      - Send message")
+    print("   POST /chat/batch - Send several text messages (quiz / flashcards)")
+    print("   POST /sessions  - Multi-turn conversation (POST /sessions/<id>/chat, DELETE /sessions/<id>)")
+    print("\nImage Support:")
     print(f"   Formats:  {', '.join(sorted(ALLOWED_EXTENSIONS))}")
-    print(f"   Max size: 10MB")
-    print(f"   Usage:    Send as FormData with 'image' field")
+    print("   Max size: 10MB")
+    print("   Usage:    Send as FormData with 'image' field")
     print("="*70 + "\n")
 
-    try:
-        test = requests.get("http://localhost:11434/api/tags", timeout=5)
-        if test.status_code == 200:
-            print("Ollama is running")
-            models = test.json().get('models', [])
-            available = [m['name'] for m in models]
-            print(f"Available models: {len(available)}")
-
-            text_available = any(TEXT_MODEL in m for m in available)
-            vision_available = any(VISION_MODEL in m for m in available)
-            
-            if text_available:
-                print(f"  {TEXT_MODEL} - Ready for text chat")
-            else:
-                print(f"  {TEXT_MODEL} - NOT FOUND!")
-                print(f"      Run: ollama pull {TEXT_MODEL}")
-            
-            if vision_available:
-                print(f"  {VISION_MODEL} - Ready for image analysis")
-            else:
-                print(f"  {VISION_MODEL} - NOT FOUND!")
-                print(f"      Run: ollama pull {VISION_MODEL}")
-            
-            if not text_available or not vision_available:
-                print(f"\nWARNING: Some models are missing!")
-                print(f"   The server will start but features may be limited.")
-        else:
-            print("Cannot connect to Ollama (unexpected response)")
-    except requests.exceptions.ConnectionError:
-        print("Ollama is NOT running!")
-        print("  Please start Ollama first: ollama serve")
-        print("  Then pull required models:")
-        print(f"     ollama pull {TEXT_MODEL}")
-        print(f"     ollama pull {VISION_MODEL}")
-    except Exception as e:
-        print(f"Error checking Ollama: {e}")
-    
     print("\n" + "="*70)
     print("Server starting...")
     print("="*70 + "\n")
+    # Kiểm tra Ollama / model chạy nền, không chặn việc mở cổng
+    threading.Thread(target=report_ollama, name='startup-report', daemon=True).start()
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,807 @@
+# -*- coding: utf-8 -*-
+"""
+ASGI entry point (asyncio) cho AI Chat API.
+
+Chạy:
+    python asgi_app.py
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5000
+
+Giữ nguyên routes và JSON của app.py (/, /health, /languages, /chat, /chat/batch, /sessions) để app
+mobile trong PJ/ không cần đổi gì. Khác biệt duy nhất là cách phục vụ: lời gọi
+Ollama dùng httpx.AsyncClient, Google search chạy trong thread pool, nên một
+process giữ được hàng trăm chat đang chờ model thay vì bị giới hạn bởi số
+thread của Waitress.
+"""
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, StreamingResponse, Response
+from starlette.routing import Route
+from starlette.background import BackgroundTask, BackgroundTasks
+from starlette.exceptions import HTTPException
+from werkzeug.utils import secure_filename
+from ollama_router import AsyncOllamaRouter
+from coalescing import AsyncSingleFlight, request_key
+from admission import AsyncAdmissionController, Overloaded
+from image_pipeline import preprocess_image, ImageRejected
+from contextlib import asynccontextmanager
+from datetime import datetime
+import contextvars
+import asyncio
+import logging
+import metrics
+import httpx
+import re
+
+from app import (
+    app as flask_app, ollama as ollama_router, residency,
+    TEXT_MODEL, VISION_MODEL, TEXT_TIMEOUT, VISION_TIMEOUT,
+    ALLOWED_EXTENSIONS, STREAM_FORMATS, STREAM_HEADERS,
+    allowed_file, should_search, default_image_question,
+    resolve_language, build_text_payload, build_vision_payload,
+    build_chat_meta, get_stream_format, format_stream_frame, new_stream_state,
+    read_stream_line, stream_end_frames, note_stream_error, get_api_info, get_languages_info,
+    build_health_status, build_readiness, cached_reply_frames, answer_cache, vision_cache,
+    retrieve_passages, build_context, web_search, sessions, build_session_payload,
+    build_session_meta, session_retrieval_query, session_not_found_body, session_busy_body,
+    chat_metrics, server_metric_families, METRICS_CONTENT_TYPE, finish_request, request_id,
+    TEXT_OPTIONS, VISION_OPTIONS, ADMISSION_LIMITS, batchers, overloaded_body, cache_text_answer,
+    parse_batch_items, batch_summary, BATCH_CONCURRENCY, shared_slots, shared_store,
+    REQUEST_TOO_LARGE_BODY
+)
+
+logger = logging.getLogger(__name__)
+
+MAX_CONTENT_LENGTH = flask_app.config['MAX_CONTENT_LENGTH']
+
+# Số kết nối đồng thời tới Ollama; giới hạn thật nằm ở năng lực model
+OLLAMA_MAX_CONNECTIONS = 256
+
+ollama = None
+coalescer = AsyncSingleFlight()
+admission = {
+    model: AsyncAdmissionController(model, **limits, shared_slots=shared_slots.get(model))
+    for model, limits in ADMISSION_LIMITS.items()
+}
+
+async def off_loop(fn, *args):
+    """
+    Gọi cache / session store. Bản dùng chung (SHARED_STATE_DIR) là SQLite có thể chờ
+    khoá tới vài giây -> chạy trong thread pool để không chặn event loop; bản trong
+    RAM chỉ mất vài µs nên gọi thẳng.
+    """
+    if shared_store is None:
+        return fn(*args)
+    return await asyncio.to_thread(fn, *args)
+
+@asynccontextmanager
+async def lifespan(_app):
+    """Tạo/đóng Ollama client dùng chung cho toàn bộ process"""
+    global ollama
+    # Trạng thái node (sức khoẻ, tải) và prober nền dùng chung với router của app.py
+    ollama = AsyncOllamaRouter(ollama_router, max_connections=OLLAMA_MAX_CONNECTIONS)
+    try:
+        yield
+    finally:
+        await ollama.close()
+
+async def home(request):
+    """API info endpoint"""
+    return JSONResponse(get_api_info())
+
+async def get_languages(request):
+    """Get supported languages"""
+    return JSONResponse(get_languages_info())
+
+async def health(request):
+    """Health check endpoint"""
+    return JSONResponse(build_health_status(ollama.stats(),
+                                            coalescing=coalescer.stats(),
+                                            admission={
+                                                'text': admission[TEXT_MODEL].stats(),
+                                                'vision': admission[VISION_MODEL].stats()
+                                            }))
+
+async def health_live(request):
+    """Liveness: event loop còn phục vụ request"""
+    return JSONResponse({'status': 'alive', 'timestamp': datetime.now().isoformat()})
+
+async def health_ready(request):
+    """Readiness: như app.health_ready"""
+    body, status = build_readiness()
+    return JSONResponse(body, status_code=status)
+
+async def wait_for_batch(model):
+    """Chờ đợt micro-batch của model (nếu model có batching); model rảnh thì đi ngay"""
+    gate = batchers.get(model)
+    if gate is not None:
+        await gate.wait_async(busy=admission[model].active > 0)
+
+async def metrics_endpoint(request):
+    """Prometheus metrics"""
+    return Response(chat_metrics.render(server_metric_families(admission)), media_type=METRICS_CONTENT_TYPE)
+
+async def generate_admitted(payload, timeout, affinity=None):
+    """Gọi Ollama (không stream) trong một slot admission của model"""
+    await wait_for_batch(payload['model'])
+    controller = admission[payload['model']]
+    admitted_at = await controller.acquire()
+    metrics.lap('ollama_queue')
+    try:
+        response = await ollama.generate(payload, timeout=timeout, affinity=affinity)
+    finally:
+        controller.release(admitted_at)
+    if response.status_code == 200:
+        data = response.json()
+        residency.observe(payload['model'], data)
+        chat_metrics.observe_ollama(payload['model'], data)
+        metrics.note(prompt_eval_count=data.get('prompt_eval_count'), eval_count=data.get('eval_count'))
+    return response
+
+async def open_generate_stream(payload, timeout, affinity=None):
+    """Mở luồng /api/generate; slot admission được giữ tới khi luồng kết thúc"""
+    await wait_for_batch(payload['model'])
+    controller = admission[payload['model']]
+    admitted_at = await controller.acquire()
+    metrics.lap('ollama_queue')
+    try:
+        response, release_backend = await ollama.open_stream(payload, timeout=timeout, affinity=affinity)
+    except BaseException:
+        controller.release(admitted_at)
+        raise
+
+    def on_close():
+        release_backend()
+        controller.release(admitted_at)
+    return response, on_close
+
+def cached_response(result, start_time, stream_format):
+    """Response cho câu trả lời lấy từ cache (JSON hoặc stream)"""
+    if stream_format:
+        return StreamingResponse(iter(cached_reply_frames(result, start_time, stream_format)),
+                                 media_type=STREAM_FORMATS[stream_format],
+                                 headers=STREAM_HEADERS)
+    return JSONResponse({
+        **result,
+        'cached': True,
+        'processing_time': round((datetime.now() - start_time).total_seconds(), 2)
+    })
+
+async def stream_chat_response(payload, timeout, meta, start_time, stream_format, on_done=None,
+                               stream_state=None, affinity=None):
+    """Bản async của app.stream_chat_response"""
+    flight, shared = await coalescer.stream(
+        request_key(payload),
+        lambda: open_generate_stream(payload, timeout, affinity)
+    )
+    if shared:
+        logger.debug("Joined identical in-flight stream")
+        metrics.note(shared=True)
+    timer = metrics.current_timer()
+
+    if flight.status_code != 200:
+        logger.error("Ollama stream error %s: %s", flight.status_code, flight.error_text)
+        return JSONResponse({
+            'error': 'AI service error',
+            'details': flight.error_text
+        }, status_code=500)
+
+    async def generate():
+        state = stream_state if stream_state is not None else new_stream_state()
+        state['timer'] = timer
+        lines = flight.lines()
+        try:
+            async for line in lines:
+                if not line:
+                    continue
+                frames, done = read_stream_line(line, state, start_time, stream_format)
+                for frame in frames:
+                    yield frame
+                if done:
+                    break
+
+            if not shared:
+                residency.observe(payload['model'], state)
+                chat_metrics.observe_ollama(payload['model'], state)
+            # on_done (ghi cache / lượt của phiên) chạy ngoài event loop, trước frame cuối
+            results = []
+            frames = stream_end_frames(state, meta, start_time, stream_format,
+                                       results.append if on_done else None)
+            if results:
+                await off_loop(on_done, results[0])
+            for frame in frames:
+                yield frame
+
+        except httpx.TimeoutException:
+            logger.error("Stream timeout")
+            note_stream_error(state, 'Request timeout')
+            yield format_stream_frame('error', {
+                'error': 'Request timeout',
+                'hint': 'The AI model took too long to respond. Try a shorter message.'
+            }, stream_format)
+
+        except httpx.HTTPError as e:
+            logger.error("Stream interrupted: %s", e)
+            note_stream_error(state, str(e))
+            yield format_stream_frame('error', {
+                'error': 'AI service error',
+                'details': str(e)
+            }, stream_format)
+
+        finally:
+            # Client ngắt kết nối -> generator bị huỷ -> rời luồng chung
+            # (upstream đóng khi không còn ai nghe)
+            await lines.aclose()
+
+    # Chạy cả khi client ngắt kết nối trước khi generator kịp bắt đầu
+    return StreamingResponse(
+        generate(),
+        media_type=STREAM_FORMATS[stream_format],
+        headers=STREAM_HEADERS,
+        background=BackgroundTask(flight.close)
+    )
+
+async def gather_context(user_message, language, search_needed, retrieval_query=None):
+    """Bản async của app.gather_context"""
+    # Web search chạy trong thread pool của SearchStage, song song với bước dưới
+    search_future = web_search.submit(user_message, language) if search_needed else None
+    search_deadline = web_search.deadline()
+
+    # BM25 trên chỉ mục cục bộ chỉ mất vài ms nhưng vẫn là CPU -> thread pool
+    passages = await asyncio.to_thread(retrieve_passages, retrieval_query or user_message)
+    metrics.lap('retrieval')
+    web_results = await web_search.result_async(search_future, search_deadline) if search_future else []
+    metrics.lap('search')
+    return (*build_context(passages, web_results, language), web_results)
+
+async def chat(request):
+    """Main chat endpoint - cùng format request/response với app.chat()"""
+    start_time = datetime.now()
+    content_type = request.headers.get('content-type', '')
+    logger.debug("New chat request (Content-Type: %s)", content_type)
+
+    try:
+        has_image = False
+        prepared = None
+        image_filename = None
+        image_stats = None
+        image_hashes = None
+
+        if 'multipart/form-data' in content_type:
+            form = await request.form()
+            user_message = form.get('message', '')
+            language = form.get('language', None)
+            stream_field = form.get('stream', None)
+
+            image_file = form.get('image')
+            if image_file is not None and getattr(image_file, 'filename', None):
+                if allowed_file(image_file.filename):
+                    has_image = True
+                    image_filename = secure_filename(image_file.filename)
+                    metrics.lap('parse')
+                    try:
+                        # Decode/resize tốn CPU -> chạy ngoài event loop
+                        prepared = await asyncio.to_thread(preprocess_image, image_file.file)
+                    except ImageRejected as e:
+                        return JSONResponse({
+                            'error': 'Invalid image',
+                            'details': str(e)
+                        }, status_code=400)
+                    image_stats = prepared.stats()
+                    image_hashes = (prepared.digest(), prepared.phash)
+                    metrics.lap('image_encode')
+                    metrics.note(image_bytes=prepared.bytes_before, image_bytes_sent=prepared.bytes_after)
+                    logger.debug("Image received: %s (%.2f KB -> %.2f KB)", image_filename,
+                                 prepared.bytes_before / 1024, prepared.bytes_after / 1024)
+                else:
+                    return JSONResponse({
+                        'error': 'Invalid file format',
+                        'allowed_formats': list(ALLOWED_EXTENSIONS)
+                    }, status_code=400)
+        else:
+            try:
+                data = await request.json()
+            except ValueError:
+                data = None
+            if not data:
+                return JSONResponse({'error': 'No data provided'}, status_code=400)
+            user_message = data.get('message', '')
+            language = data.get('language', None)
+            stream_field = data.get('stream', None)
+
+        if not user_message or not user_message.strip():
+            if has_image:
+                user_message = default_image_question(language)
+            else:
+                return JSONResponse({"error": "Message is required"}, status_code=400)
+
+        user_message = user_message.strip()
+        metrics.note(message_chars=len(user_message))
+        language = resolve_language(user_message, language)
+        stream_format = get_stream_format(stream_field, request.headers.get('accept', ''))
+        if stream_format:
+            metrics.note(stream=stream_format)
+        metrics.label(mode='vision' if has_image else 'text', language=language)
+        metrics.lap('image' if has_image else 'parse')
+
+        if has_image:
+            payload = build_vision_payload(user_message, language, prepared)
+            meta = build_chat_meta('vision', language, image_filename=image_filename,
+                                   image_stats=image_stats)
+            timeout = VISION_TIMEOUT
+            error_message = 'Vision AI service error'
+            metrics.lap('prompt_build')
+
+            cached, match = vision_cache.lookup(*image_hashes, user_message, language,
+                                                VISION_MODEL, VISION_OPTIONS)
+            metrics.lap('cache')
+            if cached:
+                logger.debug("Vision cache hit (%s)", match)
+                metrics.note(cache=match)
+                return cached_response({**cached, **meta}, start_time, stream_format)
+
+            def cache_answer(result):
+                if result['reply']:
+                    vision_cache.put(*image_hashes, user_message, language, VISION_MODEL,
+                                     VISION_OPTIONS, result)
+
+            # Model vision chưa nạp -> chờ ngắn để các request vision cùng đi một đợt
+            await residency.hold_async(VISION_MODEL)
+        else:
+            search_needed = should_search(user_message, language)
+            cached, match = await off_loop(answer_cache.lookup, user_message, language, TEXT_MODEL, TEXT_OPTIONS)
+            metrics.lap('cache')
+            if cached:
+                logger.debug("Answer cache hit (%s)", match)
+                metrics.note(cache=match)
+                return cached_response(cached, start_time, stream_format)
+
+            search_context, search_results, context_source, web_results = await gather_context(
+                user_message, language, search_needed)
+
+            def cache_answer(result):
+                cache_text_answer(user_message, language, search_needed, web_results, result)
+
+            payload = build_text_payload(user_message, language, search_context)
+            meta = build_chat_meta('text', language, searched=bool(search_results),
+                                   search_results=search_results, context_source=context_source)
+            timeout = TEXT_TIMEOUT
+            error_message = 'AI service error'
+            metrics.lap('prompt_build')
+
+        if stream_format:
+            streamed = await stream_chat_response(payload, timeout, meta, start_time, stream_format,
+                                                  on_done=cache_answer)
+            if prepared is not None:
+                # Body gửi Ollama đã đi hết khi mở luồng -> đỉnh bộ nhớ của request đã đủ
+                image_stats['peak_memory'] = prepared.meter.peak
+                metrics.note(peak_memory=prepared.meter.peak)
+            return streamed
+
+        response, shared = await coalescer.do(
+            request_key(payload),
+            lambda: generate_admitted(payload, timeout)
+        )
+        metrics.lap('generation')
+        if prepared is not None:
+            image_stats['peak_memory'] = prepared.meter.peak
+            metrics.note(peak_memory=prepared.meter.peak)
+        if shared:
+            logger.debug("Shared result of identical in-flight request")
+            metrics.note(shared=True)
+
+        if response.status_code == 200:
+            ai_response = response.json().get('response', '').strip()
+            processing_time = (datetime.now() - start_time).total_seconds()
+            logger.debug("%s response in %.2fs: %.100s", meta['mode'].capitalize(), processing_time, ai_response)
+            await off_loop(cache_answer, {'reply': ai_response, **meta})
+
+            return JSONResponse({
+                'reply': ai_response,
+                **meta,
+                'processing_time': round(processing_time, 2)
+            })
+        else:
+            logger.error("Ollama error %s: %s", response.status_code, response.text)
+            return JSONResponse({
+                'error': error_message,
+                'details': response.text
+            }, status_code=500)
+
+    except Exception as e:
+        return chat_error_response(e)
+
+def chat_error_body(error):
+    """(body, status, headers) cho một exception khi xử lý chat"""
+    if isinstance(error, Overloaded):
+        logger.warning("Request rejected by admission control: %s", error)
+        return overloaded_body(error), error.status_code, {'Retry-After': error.retry_after_header}
+
+    if isinstance(error, HTTPException) and error.status_code == 413:
+        # Body vượt MAX_CONTENT_LENGTH khi đang đọc (BodySizeLimitMiddleware)
+        return REQUEST_TOO_LARGE_BODY, 413, {}
+
+    if isinstance(error, httpx.TimeoutException):
+        logger.error("Request timeout")
+        return {
+            'error': 'Request timeout',
+            'hint': 'The AI model took too long to respond. Try a shorter message.'
+        }, 504, {}
+
+    if isinstance(error, httpx.ConnectError):
+        logger.error("Cannot connect to Ollama")
+        return {
+            'error': 'Cannot connect to Ollama',
+            'hint': 'Make sure Ollama is running: ollama serve'
+        }, 503, {}
+
+    logger.error("Unexpected error: %s", error, exc_info=True)
+    return {
+        'error': 'Internal server error',
+        'details': str(error)
+    }, 500, {}
+
+def chat_error_response(error):
+    """Response lỗi của /chat và /sessions/{id}/chat (gọi trong khối except)"""
+    body, status, headers = chat_error_body(error)
+    return JSONResponse(body, status_code=status, headers=headers)
+
+async def answer_text(user_message, language, start_time):
+    """Bản async của app.answer_text"""
+    search_needed = should_search(user_message, language)
+    cached, match = await off_loop(answer_cache.lookup, user_message, language, TEXT_MODEL, TEXT_OPTIONS)
+    if cached:
+        return {
+            **cached,
+            'cached': True,
+            'processing_time': round((datetime.now() - start_time).total_seconds(), 2)
+        }, 200
+
+    search_context, search_results, context_source, web_results = await gather_context(
+        user_message, language, search_needed)
+    payload = build_text_payload(user_message, language, search_context)
+    meta = build_chat_meta('text', language, searched=bool(search_results),
+                           search_results=search_results, context_source=context_source)
+
+    response, shared = await coalescer.do(
+        request_key(payload),
+        lambda: generate_admitted(payload, TEXT_TIMEOUT)
+    )
+    if response.status_code != 200:
+        logger.error("Ollama error %s", response.status_code)
+        return {'error': 'AI service error', 'details': response.text}, 500
+
+    result = {'reply': response.json().get('response', '').strip(), **meta}
+    await off_loop(cache_text_answer, user_message, language, search_needed, web_results, result)
+    return {
+        **result,
+        'processing_time': round((datetime.now() - start_time).total_seconds(), 2)
+    }, 200
+
+async def answer_batch_item(index, item):
+    """Kết quả một câu của batch; lỗi của câu này không làm hỏng cả batch"""
+    if not item['message']:
+        return {'index': index, 'status': 400, 'error': 'Message is required'}
+    start_time = datetime.now()
+    language = resolve_language(item['message'], item['language'])
+    try:
+        body, status = await answer_text(item['message'], language, start_time)
+    except Exception as e:
+        body, status, _ = chat_error_body(e)
+    return {'index': index, 'status': status, **body}
+
+async def run_batch(items):
+    """Bản async của app.run_batch: task cho mỗi câu, Semaphore giới hạn số câu chạy cùng lúc"""
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def run(index, item):
+        async with semaphore:
+            return await answer_batch_item(index, item)
+
+    # Context riêng cho mỗi task: các bước của từng câu không cộng vào timer của request batch
+    tasks = [asyncio.create_task(run(index, item), context=contextvars.Context())
+             for index, item in enumerate(items)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def chat_batch(request):
+    """POST /chat/batch - giống app.chat_batch"""
+    start_time = datetime.now()
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not data:
+        return JSONResponse({'error': 'No data provided'}, status_code=400)
+    items, error = parse_batch_items(data)
+    if error:
+        return JSONResponse(error, status_code=400)
+
+    stream_format = get_stream_format(data.get('stream'), request.headers.get('accept', ''))
+    metrics.label(mode='batch', language=data.get('language') or 'mixed')
+    metrics.note(items=len(items), stream=stream_format)
+
+    if stream_format:
+        async def generate():
+            results = []
+            async for result in run_batch(items):
+                results.append(result)
+                yield format_stream_frame('item', result, stream_format)
+            yield format_stream_frame('done', batch_summary(results, start_time), stream_format)
+        return StreamingResponse(generate(), media_type=STREAM_FORMATS[stream_format], headers=STREAM_HEADERS)
+
+    results = sorted([result async for result in run_batch(items)], key=lambda result: result['index'])
+    metrics.lap('generation')
+    return JSONResponse({'results': results, **batch_summary(results, start_time)})
+
+async def create_session(request):
+    """Tạo phiên hội thoại nhiều lượt - giống app.create_session()"""
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    language = (data or {}).get('language')
+    session = await off_loop(sessions.create, resolve_language('', language) if language else None)
+    logger.info("Session created: %s", session.id)
+    return JSONResponse({**session.info(), 'idle_ttl': sessions.idle_ttl}, status_code=201)
+
+async def end_session(request):
+    """Kết thúc phiên, giải phóng context đã lưu"""
+    session_id = request.path_params['session_id']
+    if not await off_loop(sessions.end, session_id):
+        return JSONResponse(session_not_found_body(session_id), status_code=404)
+    logger.info("Session ended: %s", session_id)
+    return JSONResponse({'session_id': session_id, 'ended': True})
+
+def finish_after(response, session):
+    """Lượt kết thúc khi stream xong hoặc client ngắt (kể cả trước khi body kịp chạy)"""
+    tasks = BackgroundTasks()
+    if response.background is not None:
+        tasks.add_task(response.background)
+    tasks.add_task(sessions.finish, session)
+    response.background = tasks
+
+async def session_chat(request):
+    """Một lượt hỏi trong phiên - giống app.session_chat()"""
+    start_time = datetime.now()
+    session_id = request.path_params['session_id']
+    session = await off_loop(sessions.get, session_id)
+    if session is None:
+        return JSONResponse(session_not_found_body(session_id), status_code=404)
+
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not data:
+        return JSONResponse({'error': 'No data provided'}, status_code=400)
+    user_message = (data.get('message') or '').strip()
+    if not user_message:
+        return JSONResponse({"error": "Message is required"}, status_code=400)
+
+    if not await off_loop(sessions.begin, session):
+        return JSONResponse(session_busy_body(session_id), status_code=409)
+    response = None
+    try:
+        response = await session_turn(session, user_message, data.get('stream'),
+                                      request.headers.get('accept', ''), start_time)
+    finally:
+        if isinstance(response, StreamingResponse):
+            finish_after(response, session)
+        else:
+            await off_loop(sessions.finish, session)
+    return response
+
+async def session_turn(session, user_message, stream_field, accept, start_time):
+    """Chạy một lượt của phiên (đã được sessions.begin giữ chỗ)"""
+    logger.debug("Session turn %s #%d: %.100s", session.id, session.turn_count + 1, user_message)
+    metrics.note(session_id=session.id, message_chars=len(user_message))
+    try:
+        if session.language is None:
+            session.language = resolve_language(user_message, None)
+        language = session.language
+        stream_format = get_stream_format(stream_field, accept)
+        metrics.label(mode='text', language=language)
+        metrics.lap('parse')
+
+        search_context, search_results, context_source, _ = await gather_context(
+            user_message, language, should_search(user_message, language),
+            retrieval_query=session_retrieval_query(session, user_message))
+
+        context = await off_loop(sessions.context_for, session)
+        metrics.note(context_reused=context is not None)
+        payload = build_session_payload(user_message, language, context, session.history(), search_context)
+        meta = build_session_meta(session, language, context, search_results, context_source)
+        metrics.lap('prompt_build')
+
+        if stream_format:
+            state = new_stream_state()
+
+            def record_turn(result):
+                sessions.record(session, user_message, result['reply'], state['context'],
+                                state['prompt_eval_count'], state['eval_count'])
+            return await stream_chat_response(payload, TEXT_TIMEOUT, meta, start_time, stream_format,
+                                              on_done=record_turn, stream_state=state, affinity=session.id)
+
+        response = await generate_admitted(payload, TEXT_TIMEOUT, affinity=session.id)
+        metrics.lap('generation')
+        if response.status_code != 200:
+            logger.error("Ollama error %s: %s", response.status_code, response.text)
+            return JSONResponse({
+                'error': 'AI service error',
+                'details': response.text
+            }, status_code=500)
+
+        result = response.json()
+        ai_response = result.get('response', '').strip()
+        await off_loop(sessions.record, session, user_message, ai_response, result.get('context'),
+                       result.get('prompt_eval_count'), result.get('eval_count'))
+        processing_time = (datetime.now() - start_time).total_seconds()
+        logger.debug("Session turn answered in %.2fs (context reused: %s)", processing_time, context is not None)
+
+        return JSONResponse({
+            'reply': ai_response,
+            **meta,
+            'prompt_eval_count': result.get('prompt_eval_count'),
+            'processing_time': round(processing_time, 2)
+        })
+
+    except Exception as e:
+        return chat_error_response(e)
+
+METRIC_PATHS = [
+    (re.compile(r'^/chat$'), 'chat'),
+    (re.compile(r'^/chat/batch$'), 'chat_batch'),
+    (re.compile(r'^/sessions/[^/]+/chat$'), 'session_chat')
+]
+
+class BodySizeLimitMiddleware:
+    """
+    Giới hạn body như MAX_CONTENT_LENGTH của Flask: Content-Length vượt giới hạn -> 413
+    ngay; body không có Content-Length (chunked) được đếm khi đọc, vượt giới hạn thì
+    receive() raise HTTPException(413) nên request.form() / json() dừng đọc
+    """
+
+    def __init__(self, app, max_length):
+        self.app = app
+        self.max_length = max_length
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not self.max_length:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope['headers']).get(b'content-length', b'')
+        if content_length.isdigit() and int(content_length) > self.max_length:
+            await request_entity_too_large(None, None)(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > self.max_length:
+                    raise HTTPException(status_code=413)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+class RequestMetricsMiddleware:
+    """ASGI middleware đo các request chat (giống before/after_request của app.py)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        endpoint = None
+        if scope['type'] == 'http':
+            endpoint = next((name for pattern, name in METRIC_PATHS if pattern.match(scope['path'])), None)
+        if endpoint is None:
+            await self.app(scope, receive, send)
+            return
+
+        timer = chat_metrics.begin(endpoint)
+        request_headers = dict(scope['headers'])
+        timer.note(request_id=request_id(request_headers.get(b'x-request-id', b'').decode('latin-1')),
+                   request_bytes=int(request_headers.get(b'content-length') or 0) or None)
+        status = 500
+
+        async def send_with_metrics(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                headers = dict(message.get('headers', []))
+                content_type = headers.get(b'content-type', b'').decode()
+                if not any(content_type.startswith(mime) for mime in STREAM_FORMATS.values()):
+                    timer.lap('serialization')
+                    timer.note(response_bytes=int(headers.get(b'content-length') or 0))
+                message['headers'] = [*message.get('headers', []),
+                                      (b'x-request-id', timer.fields['request_id'].encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            # Stream: chạy tới đây khi gửi xong hoặc client ngắt
+            finish_request(timer, status)
+
+def request_entity_too_large(request, exc):
+    """Handle file too large error"""
+    return JSONResponse(REQUEST_TOO_LARGE_BODY, status_code=413)
+
+async def not_found(request, exc):
+    """Handle 404 errors"""
+    return JSONResponse({
+        'error': 'Endpoint not found',
+        'available_endpoints': {
+            'GET /': 'API information',
+            'GET /health': 'Health check',
+            'GET /languages': 'Supported languages',
+            'POST /chat': 'Send message',
+            'POST /chat/batch': 'Send several text messages',
+            'POST /sessions': 'Create a conversation session'
+        }
+    }, status_code=404)
+
+async def internal_error(request, exc):
+    """Handle 500 errors"""
+    logger.error("Internal server error: %s", exc)
+    return JSONResponse({
+        'error': 'Internal server error',
+        'hint': 'Please check server logs'
+    }, status_code=500)
+
+app = Starlette(
+    routes=[
+        Route('/', home, methods=['GET']),
+        Route('/languages', get_languages, methods=['GET']),
+        Route('/health', health, methods=['GET']),
+        Route('/health/live', health_live, methods=['GET']),
+        Route('/health/ready', health_ready, methods=['GET']),
+        Route('/metrics', metrics_endpoint, methods=['GET']),
+        Route('/chat', chat, methods=['POST']),
+        Route('/chat/batch', chat_batch, methods=['POST']),
+        Route('/sessions', create_session, methods=['POST']),
+        Route('/sessions/{session_id}', end_session, methods=['DELETE']),
+        Route('/sessions/{session_id}/chat', session_chat, methods=['POST'])
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*']),
+        Middleware(RequestMetricsMiddleware),
+        Middleware(BodySizeLimitMiddleware, max_length=MAX_CONTENT_LENGTH)
+    ],
+    exception_handlers={
+        404: not_found,
+        413: request_entity_too_large,
+        500: internal_error
+    },
+    lifespan=lifespan
+)
+
+if __name__ == '__main__':
+    from run_production import local_ip
+    import uvicorn
+
+    print("\n" + "="*60)
+    print("AI Chat API Server (ASYNC MODE)")
+    print("="*60)
+    print("Using uvicorn ASGI Server (asyncio)")
+    print("Local:  http://localhost:5000")
+    print(f"Network: http://{local_ip()}:5000")
+    print(f"Text Model:   {TEXT_MODEL}")
+    print(f"Vision Model: {VISION_MODEL}")
+    print(f"Max Ollama connections: {OLLAMA_MAX_CONNECTIONS}")
+    print("="*60 + "\n")
+    uvicorn.run(
+        app,
+        host='0.0.0.0',
+        port=5000,
+        timeout_keep_alive=120
+    )
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Gom request thành từng đợt trước khi gửi Ollama (micro-batching).
+
+Ollama không có API batch, nhưng mỗi node chạy song song tối đa
+OLLAMA_NUM_PARALLEL request trong cùng một vòng decode. Khi cả lớp gửi câu hỏi
+gần như cùng lúc, BatchGate giữ các request text trong một cửa sổ ngắn
+(10-50 ms) hoặc tới khi đủ max_batch rồi thả cùng lúc, để chúng vào các slot
+song song cùng nhau thay vì lệch pha từng request. Request đến một mình
+(không có ai đang chờ, model không có lời gọi nào đang chạy) được thả ngay,
+cửa sổ chỉ mở khi thực sự có request đồng thời. Mỗi caller tự gửi request
+của mình sau khi được thả nên kết quả/lỗi về đúng người gọi.
+
+Độ trễ thêm vào bị chặn bởi window và được đo (avg/max wait, kích thước đợt).
+"""
+import threading
+import asyncio
+import time
+
+class _Batch:
+    __slots__ = ('deadline', 'count', 'event', 'async_event', 'full')
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.count = 0
+        self.event = threading.Event()
+        self.async_event = None
+        self.full = False
+
+    def open(self):
+        self.event.set()
+        if self.async_event is not None:
+            self.async_event.set()
+
+class BatchGate:
+    """Thả các caller theo đợt: sau `window` giây kể từ caller đầu tiên, hoặc khi đủ max_batch"""
+
+    def __init__(self, window, max_batch):
+        self.window = window
+        self.max_batch = max_batch
+
+        self._lock = threading.Lock()
+        self._batches = {}
+
+        self.batches = 0
+        self.full_batches = 0
+        self.immediate = 0
+        self.waiters = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _join(self, key, busy):
+        """Vào đợt đang mở (hoặc mở đợt mới); None nếu caller đi một mình và được thả ngay"""
+        with self._lock:
+            batch = self._batches.get(key)
+            if batch is None and not busy:
+                self.batches += 1
+                self.immediate += 1
+                self.waiters += 1
+                return None
+            if batch is None:
+                batch = _Batch(time.monotonic() + self.window)
+                self._batches[key] = batch
+            batch.count += 1
+            if batch.count >= self.max_batch:
+                batch.full = True
+                self._close(key, batch)
+            return batch
+
+    def _close(self, key, batch):
+        if self._batches.get(key) is batch:
+            del self._batches[key]
+            self.batches += 1
+            if batch.full:
+                self.full_batches += 1
+        batch.open()
+
+    def _done(self, key, batch, start):
+        waited = time.monotonic() - start
+        with self._lock:
+            self._close(key, batch)
+            self.waiters += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        return waited
+
+    def wait(self, key=None, busy=True):
+        """
+        Chờ tới lượt đợt của mình được thả; trả về thời gian đã chờ.
+        busy=False: model không có lời gọi nào đang chạy, nếu cũng không có ai
+        đang chờ thì không mở cửa sổ mà thả ngay.
+        """
+        if not self.window or self.max_batch <= 1:
+            return 0.0
+        batch = self._join(key, busy)
+        if batch is None:
+            return 0.0
+        start = time.monotonic()
+        batch.event.wait(max(0.0, batch.deadline - start))
+        return self._done(key, batch, start)
+
+    async def wait_async(self, key=None, busy=True):
+        """Bản asyncio của wait() (chỉ dùng trên một event loop)"""
+        if not self.window or self.max_batch <= 1:
+            return 0.0
+        batch = self._join(key, busy)
+        if batch is None:
+            return 0.0
+        start = time.monotonic()
+        with self._lock:
+            if batch.async_event is None:
+                batch.async_event = asyncio.Event()
+                if batch.event.is_set():
+                    batch.async_event.set()
+        try:
+            await asyncio.wait_for(batch.async_event.wait(), max(0.0, batch.deadline - start))
+        except asyncio.TimeoutError:
+            pass
+        return self._done(key, batch, start)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'window': self.window,
+                'max_batch': self.max_batch,
+                'batches': self.batches,
+                'full_batches': self.full_batches,
+                'immediate': self.immediate,
+                'requests': self.waiters,
+                'avg_batch_size': round(self.waiters / self.batches, 2) if self.batches else 0.0,
+                'avg_wait': round(self.total_wait / self.waiters, 4) if self.waiters else 0.0,
+                'max_wait': round(self.max_wait, 4)
+            }
@@ -0,0 +1,599 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark backend với Ollama giả (fake_ollama.py) và web search giả, không cần GPU/Google.
+
+    python benchmark.py
+    python benchmark.py --targets flask,waitress,asgi --concurrency 1,8,32 --duration 20 --output bench.json
+    python benchmark.py --targets waitress --env TEXT_BATCH_WINDOW_MS=0     # so sánh một thay đổi cấu hình
+    python benchmark.py --micro                                            # micro-benchmark detect_language / should_search
+    python benchmark.py --startup --targets waitress,asgi --max-import-ms 1500     # thời gian khởi động (chạy trong CI)
+
+- Mỗi target chạy trong process riêng: 'flask' (app.run, threaded), 'waitress'
+  (run_production.serve_production), 'workers' (run_production.serve_workers,
+  BENCH_WORKERS process, mặc định số CPU), 'asgi' (uvicorn asgi_app:app)
+- Tải closed-loop ở từng mức concurrency: /chat text tiếng Việt/Anh/Trung,
+  ảnh multipart, một phần stream NDJSON, một phần câu hỏi lặp lại (như cả lớp
+  hỏi cùng một câu), một phần câu hỏi cần web search
+- Kết quả JSON (stdout hoặc --output): throughput, p50/p95/p99 latency,
+  time-to-first-token của stream, tỉ lệ lỗi, cache hit ratio phía server
+- --micro: thời gian mỗi lần gọi và độ chính xác của detect_language /
+  should_search trên bộ câu có nhãn, so với cách quét tuần tự cũ
+- --startup: thời gian `import app` (process mới, median) và thời gian từ lúc
+  start server tới response đầu tiên / tới khi /health/ready; exit 1 nếu
+  dependency tuỳ chọn (Pillow, googlesearch, pypdf...) bị import lúc khởi động
+  hoặc import vượt --max-import-ms
+"""
+from concurrent.futures import ThreadPoolExecutor
+from web_search import stub_backend
+import subprocess
+import argparse
+import requests
+import random
+import socket
+import unicodedata
+import struct
+import timeit
+import statistics
+import json
+import time
+import zlib
+import sys
+import os
+
+import fake_ollama
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TARGETS = ('flask', 'waitress', 'workers', 'asgi')
+SEARCH_LATENCY = float(os.environ.get('BENCH_SEARCH_LATENCY', 0.3))
+
+QUESTIONS = {
+    'vi': [
+        "Chiến thắng Điện Biên Phủ diễn ra năm nào?",
+        "Ai là người lãnh đạo khởi nghĩa Lam Sơn?",
+        "Nhà Trần đã mấy lần đánh thắng quân Nguyên Mông?",
+        "Cách mạng tháng Tám năm 1945 có ý nghĩa gì?",
+        "Vua Quang Trung đại phá quân Thanh vào năm nào?",
+        "Hiệp định Genève năm 1954 quy định những gì?",
+        "Kinh đô của nhà Lý đặt ở đâu?",
+        "Hai Bà Trưng khởi nghĩa chống lại ai?"
+    ],
+    'en': [
+        "When did the Battle of Dien Bien Phu take place?",
+        "Who led the Lam Son uprising?",
+        "What was the significance of the August Revolution of 1945?",
+        "Who was Emperor Quang Trung?",
+        "What did the 1954 Geneva Accords decide about Vietnam?"
+    ],
+    'zh': [
+        "奠边府战役发生在哪一年？",
+        "谁领导了蓝山起义？",
+        "1945年八月革命有什么意义？",
+        "光中皇帝是谁？"
+    ]
+}
+# Câu hỏi chứa từ khoá should_search -> đi qua bước web search
+SEARCH_QUESTIONS = {
+    'vi': ["Việt Nam hiện tại có bao nhiêu tỉnh sau sáp nhập?"],
+    'en': ["What is the latest news about Vietnamese history research?"],
+    'zh': ["越南今天有多少个省？"]
+}
+IMAGE_QUESTIONS = {
+    'vi': "Bức ảnh này chụp di tích lịch sử nào?",
+    'en': "What historical site is shown in this picture?",
+    'zh': "这张照片展示的是哪个历史遗迹？"
+}
+
+# (câu, ngôn ngữ đúng) - gồm các trường hợp cách quét cũ nhận sai
+LANGUAGE_SAMPLES = [(q, lang) for lang, questions in QUESTIONS.items() for q in questions] + [
+    ("Bộ sử ký nổi tiếng nhất thời Lê?", 'vi'),
+    ("Người đứng đầu triều Nguyễn cuối cùng?", 'vi'),
+    (unicodedata.normalize('NFD', "Chiến thắng Bạch Đằng năm 938"), 'vi'),
+    ("Nguyen Trai la ai", 'vi'),
+    ("Chien tranh Dien Bien Phu dien ra nam nao", 'vi'),
+    ("nha Nguyen do ai lap ra", 'vi'),
+    ("to chuc nao lanh dao", 'vi'),
+    ("an duong vuong la ai", 'vi'),
+    ("Who was Trần Hưng Đạo?", 'en'),
+    ("Tell me about the Battle of Điện Biên Phủ", 'en'),
+    ("What is a café in Hanoi history?", 'en'),
+    ("越南的首都河内是什么时候建立的？", 'zh'),
+    ("胡志明是谁？", 'zh'),
+    ("Hồ Chí Minh 是谁？", 'zh'),
+    ("The August Revolution of 1945 began in Hanoi and spread across the country, " * 6, 'en')
+]
+# (câu, ngôn ngữ, có cần search)
+SEARCH_SAMPLES = [
+    ("Giá vàng hôm nay là bao nhiêu?", 'vi', True),
+    ("Việt Nam hiện tại có bao nhiêu tỉnh?", 'vi', True),
+    ("Giáo dục thời Lý có gì đặc biệt?", 'vi', False),
+    (unicodedata.normalize('NFD', "Tin tức lịch sử mới nhất"), 'vi', True),
+    ("Chiến thắng Điện Biên Phủ diễn ra năm nào?", 'vi', False),
+    ("What is the latest news about Hue?", 'en', True),
+    ("Who was Emperor Gia Long?", 'en', False),
+    ("Describe the newspapers of colonial Saigon", 'en', False),
+    ("今天越南有什么新闻？", 'zh', True),
+    ("谁领导了蓝山起义？", 'zh', False)
+]
+
+def legacy_detect_language(text):
+    """Cách phát hiện cũ (12 ký tự Việt, quét CJK từng ký tự) - chỉ để so sánh"""
+    vietnamese_chars = ['ă', 'â', 'đ', 'ê', 'ô', 'ơ', 'ư', 'á', 'à', 'ả', 'ã', 'ạ']
+    if any(char in text.lower() for char in vietnamese_chars):
+        return 'vi'
+    for char in text:
+        if '\u4e00' <= char <= '\u9fff':
+            return 'zh'
+    return 'en'
+
+def legacy_should_search(message, keywords):
+    message_lower = message.lower()
+    return any(keyword in message_lower for keyword in keywords)
+
+def time_per_call(fn, samples, repeat=5):
+    """Thời gian trung bình (ns) mỗi lần gọi fn trên samples, lấy lần chạy nhanh nhất"""
+    def run():
+        for args in samples:
+            fn(*args)
+    number = max(1, 20000 // len(samples))
+    return round(min(timeit.repeat(run, number=number, repeat=repeat)) / (number * len(samples)) * 1e9, 1)
+
+def micro_benchmarks():
+    from language_detect import detect_language
+    from app import LANGUAGES, should_search
+
+    texts = [(text,) for text, _ in LANGUAGE_SAMPLES]
+    detected = [detect_language(text) for text, _ in LANGUAGE_SAMPLES]
+    legacy = [legacy_detect_language(text) for text, _ in LANGUAGE_SAMPLES]
+    searches = [should_search(message, lang) for message, lang, _ in SEARCH_SAMPLES]
+    legacy_searches = [legacy_should_search(message, LANGUAGES[lang]['search_keywords'])
+                       for message, lang, _ in SEARCH_SAMPLES]
+
+    def accuracy(results, expected):
+        return round(sum(r == e for r, e in zip(results, expected)) / len(expected), 4)
+
+    expected_languages = [lang for _, lang in LANGUAGE_SAMPLES]
+    expected_searches = [needed for _, _, needed in SEARCH_SAMPLES]
+    return {
+        'detect_language': {
+            'samples': len(LANGUAGE_SAMPLES),
+            'ns_per_call': time_per_call(detect_language, texts),
+            'legacy_ns_per_call': time_per_call(legacy_detect_language, texts),
+            'accuracy': accuracy(detected, expected_languages),
+            'legacy_accuracy': accuracy(legacy, expected_languages),
+            'misdetected': [text[:60] for (text, lang), got in zip(LANGUAGE_SAMPLES, detected) if got != lang]
+        },
+        'should_search': {
+            'samples': len(SEARCH_SAMPLES),
+            'ns_per_call': time_per_call(should_search, [(m, lang) for m, lang, _ in SEARCH_SAMPLES]),
+            'legacy_ns_per_call': time_per_call(
+                legacy_should_search, [(m, LANGUAGES[lang]['search_keywords']) for m, lang, _ in SEARCH_SAMPLES]),
+            'accuracy': accuracy(searches, expected_searches),
+            'legacy_accuracy': accuracy(legacy_searches, expected_searches)
+        }
+    }
+
+def stub_search(query, num_results, lang, timeout):
+    """Web search giả có độ trễ BENCH_SEARCH_LATENCY (WEB_SEARCH_BACKEND=benchmark:stub_search)"""
+    time.sleep(min(SEARCH_LATENCY, timeout))
+    return stub_backend(query, num_results, lang, timeout)
+
+def make_png(width, height, seed):
+    """Ảnh PNG RGB (gradient + nhiễu) tạo bằng thư viện chuẩn, giống ảnh chụp về kích thước/độ nén"""
+    rng = random.Random(seed)
+    rows = []
+    for y in range(height):
+        noise = rng.randbytes(width)
+        row = bytearray(b'\x00')
+        for x in range(width):
+            n = noise[x] >> 3
+            row += bytes(((x * 255 // width + n) & 255, (y * 255 // height + n) & 255, (seed * 40 + n) & 255))
+        rows.append(bytes(row))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header)
+            + chunk(b'IDAT', zlib.compress(b''.join(rows), 6)) + chunk(b'IEND', b''))
+
+class Workload:
+    """Sinh request ngẫu nhiên (có seed) theo tỉ lệ ngôn ngữ / ảnh / stream / lặp lại / search"""
+
+    def __init__(self, seed, languages, image_ratio, stream_ratio, repeat_ratio, search_ratio, images):
+        self.rng = random.Random(seed)
+        self.languages = languages
+        self.image_ratio = image_ratio
+        self.stream_ratio = stream_ratio
+        self.repeat_ratio = repeat_ratio
+        self.search_ratio = search_ratio
+        self.images = images
+
+    def next(self):
+        rng = self.rng
+        language = rng.choices(list(self.languages), weights=list(self.languages.values()))[0]
+        image = rng.random() < self.image_ratio
+        if image:
+            message = IMAGE_QUESTIONS[language]
+        elif rng.random() < self.search_ratio:
+            message = rng.choice(SEARCH_QUESTIONS[language])
+        else:
+            message = rng.choice(QUESTIONS[language])
+        if rng.random() >= self.repeat_ratio:
+            # Câu hỏi "mới": thêm mã ngẫu nhiên để không trúng answer/vision cache
+            message = f"{message} [{rng.getrandbits(48):012x}]"
+        return {
+            'kind': 'image' if image else 'text',
+            'language': language,
+            'message': message,
+            'stream': rng.random() < self.stream_ratio,
+            'image': rng.choice(self.images) if image else None
+        }
+
+def send(session, base_url, item, timeout):
+    """Gửi một request /chat, trả về kết quả đo"""
+    result = {'kind': item['kind'], 'language': item['language'], 'stream': item['stream'],
+              'status': None, 'ok': False, 'latency': None, 'ttft': None}
+    start = time.perf_counter()
+    try:
+        stream = 'ndjson' if item['stream'] else None
+        if item['image'] is not None:
+            form = {'message': item['message'], 'language': item['language']}
+            if stream:
+                form['stream'] = stream
+            response = session.post(f"{base_url}/chat", data=form,
+                                    files={'image': ('photo.png', item['image'], 'image/png')},
+                                    stream=bool(stream), timeout=timeout)
+        else:
+            response = session.post(f"{base_url}/chat", json={'message': item['message'], 'stream': stream},
+                                    stream=bool(stream), timeout=timeout)
+        result['status'] = response.status_code
+        ok = response.status_code == 200
+        if stream and ok:
+            ok = False
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line).get('event')
+                if event == 'token' and result['ttft'] is None:
+                    result['ttft'] = time.perf_counter() - start
+                elif event == 'done':
+                    ok = True
+                    break
+                elif event == 'error':
+                    break
+        else:
+            response.content
+        response.close()
+        result['ok'] = ok
+    except requests.RequestException as e:
+        result['status'] = type(e).__name__
+    result['latency'] = time.perf_counter() - start
+    return result
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def rank(p):
+        return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+    return {
+        'p50': round(rank(50), 4),
+        'p95': round(rank(95), 4),
+        'p99': round(rank(99), 4),
+        'mean': round(sum(values) / len(values), 4),
+        'max': round(values[-1], 4)
+    }
+
+def summarize(results, elapsed):
+    ok = [r for r in results if r['ok']]
+    status_counts = {}
+    for r in results:
+        status_counts[str(r['status'])] = status_counts.get(str(r['status']), 0) + 1
+    by_kind = {}
+    for kind in ('text', 'image', 'stream'):
+        selected = [r for r in ok if (r['stream'] if kind == 'stream' else r['kind'] == kind)]
+        if selected:
+            by_kind[kind] = {'requests': len(selected), 'latency': percentiles([r['latency'] for r in selected])}
+    return {
+        'requests': len(results),
+        'ok': len(ok),
+        'errors': len(results) - len(ok),
+        'error_rate': round((len(results) - len(ok)) / len(results), 4) if results else 0.0,
+        'elapsed': round(elapsed, 3),
+        'throughput_rps': round(len(ok) / elapsed, 3) if elapsed else 0.0,
+        'latency': percentiles([r['latency'] for r in ok]),
+        'time_to_first_token': percentiles([r['ttft'] for r in ok if r['ttft'] is not None]),
+        'by_kind': by_kind,
+        'status_counts': status_counts
+    }
+
+def run_level(base_url, workload, concurrency, duration, max_requests, timeout):
+    """Closed-loop: `concurrency` worker, mỗi worker gửi request kế tiếp ngay khi xong request trước"""
+    deadline = time.monotonic() + duration
+    results, budget = [], [max_requests or float('inf')]
+
+    def worker():
+        session = requests.Session()
+        while time.monotonic() < deadline:
+            # list.append / so sánh trên list là thread-safe trong CPython
+            if budget[0] <= 0:
+                break
+            budget[0] -= 1
+            results.append(send(session, base_url, workload.next(), timeout))
+        session.close()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    return summarize(results, time.perf_counter() - start)
+
+def server_snapshot(base_url):
+    """Một vài số liệu phía server từ /metrics (cache hit ratio, request bị admission từ chối)"""
+    snapshot = {}
+    try:
+        text = requests.get(f"{base_url}/metrics", timeout=5).text
+    except requests.RequestException:
+        return snapshot
+    for line in text.splitlines():
+        if line.startswith(('cache_hit_ratio', 'admission_rejected_total')):
+            name, value = line.rsplit(' ', 1)
+            snapshot[name] = float(value)
+    return snapshot
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(target, port, env, log_path):
+    log = open(log_path, 'ab') if log_path else subprocess.DEVNULL
+    process = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, 'benchmark.py'),
+                                '--serve', target, '--port', str(port)],
+                               cwd=BASE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{target} server exited with code {process.returncode}")
+        try:
+            if requests.get(f"{base_url}/languages", timeout=1).status_code == 200:
+                return process, base_url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"{target} server did not become ready")
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+# Dependency tuỳ chọn chỉ được import khi dùng tới: có trong sys.modules ngay sau import là hồi quy
+LAZY_MODULES = ('PIL', 'googlesearch', 'bs4', 'pypdf', 'sqlite3')
+
+IMPORT_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{'seconds': time.perf_counter() - start,
+                   'eager': [m for m in {lazy!r} if m in sys.modules]}}))
+"""
+
+def measure_import(module, env, runs):
+    """Thời gian `import module` trong process mới + các LAZY_MODULES bị import theo"""
+    samples, eager = [], set()
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-c', IMPORT_PROBE.format(module=module, lazy=LAZY_MODULES)],
+                                cwd=BASE_DIR, env=env, capture_output=True, text=True, check=True)
+        probe = json.loads(result.stdout.strip().splitlines()[-1])
+        samples.append(probe['seconds'] * 1000)
+        eager.update(probe['eager'])
+    return {
+        'median_ms': round(statistics.median(samples), 1),
+        'min_ms': round(min(samples), 1),
+        'max_ms': round(max(samples), 1),
+        'eager_optional': sorted(eager)
+    }
+
+def measure_first_request(target, env, timeout=60):
+    """Từ lúc start process tới response 200 đầu tiên (/health/live) và tới khi /health/ready 200"""
+    base_url = f"http://127.0.0.1:{free_port()}"
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, 'benchmark.py'),
+                                '--serve', target, '--port', base_url.rsplit(':', 1)[1]],
+                               cwd=BASE_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    first = ready = None
+    try:
+        deadline = time.monotonic() + timeout
+        while ready is None and time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"{target} server exited with code {process.returncode}")
+            try:
+                status = requests.get(f"{base_url}/health/{'ready' if first else 'live'}", timeout=1).status_code
+            except requests.RequestException:
+                status = None
+            if status == 200:
+                if first is None:
+                    first = time.perf_counter() - start
+                else:
+                    ready = time.perf_counter() - start
+                continue
+            time.sleep(0.01)
+    finally:
+        stop_server(process)
+    if first is None:
+        raise RuntimeError(f"{target} server did not answer within {timeout}s")
+    return first * 1000, ready * 1000 if ready is not None else None
+
+def startup_benchmarks(targets, env, runs):
+    """Import time của app / asgi_app và time-to-first-request của từng target (median của runs lần)"""
+    modules = ['app'] + (['asgi_app'] if 'asgi' in targets else [])
+    report = {'import': {module: measure_import(module, env, runs) for module in modules}, 'targets': {}}
+    for target in targets:
+        samples = [measure_first_request(target, env) for _ in range(runs)]
+        ready = [r for _, r in samples if r is not None]
+        report['targets'][target] = {
+            'first_request_ms': round(statistics.median(f for f, _ in samples), 1),
+            'ready_ms': round(statistics.median(ready), 1) if ready else None
+        }
+        print(f"[{target}] first request {report['targets'][target]['first_request_ms']:.0f} ms, "
+              f"ready {report['targets'][target]['ready_ms']} ms", file=sys.stderr)
+    return report
+
+def serve(target, port):
+    """Chạy một target trong process hiện tại (được start_server gọi qua --serve)"""
+    if target == 'flask':
+        from app import app
+        app.run(host='127.0.0.1', port=port, threaded=True, debug=False, use_reloader=False)
+    elif target == 'waitress':
+        from run_production import serve_production
+        serve_production(host='127.0.0.1', port=port)
+    elif target == 'workers':
+        from run_production import serve_workers
+        workers = int(os.environ.get('BENCH_WORKERS', 0)) or os.cpu_count() or 1
+        serve_workers(host='127.0.0.1', port=port, workers=workers)
+    else:
+        import uvicorn
+        uvicorn.run('asgi_app:app', host='127.0.0.1', port=port, timeout_keep_alive=120, log_level='warning')
+
+def parse_languages(spec):
+    languages = {}
+    for item in spec.split(','):
+        code, _, weight = item.partition('=')
+        if code not in QUESTIONS:
+            raise argparse.ArgumentTypeError(f"Unknown language: {code}")
+        languages[code] = float(weight or 1)
+    return languages
+
+def write_output(report, path):
+    """JSON kết quả ra file path, hoặc stdout nếu không có"""
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if path:
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+def server_env(args, fake):
+    """Env cho process server: Ollama giả, không preload model, web search giả"""
+    env = {
+        **os.environ,
+        'OLLAMA_HOST': fake.url,
+        'OLLAMA_BACKENDS': '',
+        'OLLAMA_NUM_PARALLEL': str(args.num_parallel),
+        'MODEL_PRELOAD': '0',
+        'WEB_SEARCH_BACKEND': 'benchmark:stub_search',
+        'BENCH_SEARCH_LATENCY': str(args.search_latency),
+        'PYTHONIOENCODING': 'utf-8'
+    }
+    env.update(item.split('=', 1) for item in args.env)
+    return env
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the chat backend against a fake Ollama')
+    parser.add_argument('--targets', default='flask,waitress', help=f"Comma-separated: {', '.join(TARGETS)}")
+    parser.add_argument('--concurrency', default='1,8,32', help='Comma-separated concurrency levels')
+    parser.add_argument('--duration', type=float, default=15, help='Seconds per concurrency level')
+    parser.add_argument('--requests', type=int, default=0, help='Max requests per level (0 = no limit)')
+    parser.add_argument('--warmup', type=int, default=4, help='Warm-up requests before each target')
+    parser.add_argument('--timeout', type=float, default=300, help='Client timeout per request')
+    parser.add_argument('--languages', type=parse_languages, default='vi=0.6,en=0.25,zh=0.15',
+                        help='Language mix, e.g. vi=0.6,en=0.25,zh=0.15')
+    parser.add_argument('--image-ratio', type=float, default=0.1, help='Share of multipart image requests')
+    parser.add_argument('--stream-ratio', type=float, default=0.5, help='Share of streaming requests')
+    parser.add_argument('--repeat-ratio', type=float, default=0.3, help='Share of repeated (cacheable) questions')
+    parser.add_argument('--search-ratio', type=float, default=0.1, help='Share of questions that need web search')
+    parser.add_argument('--search-latency', type=float, default=SEARCH_LATENCY, help='Fake web search latency')
+    parser.add_argument('--image-size', default='1024x768', help='Test image size WxH')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--env', action='append', default=[], help='Extra server env KEY=VALUE (repeatable)')
+    parser.add_argument('--log', help='Append server logs to this file')
+    parser.add_argument('--output', help='Write JSON results to this file (default: stdout)')
+    parser.add_argument('--micro', action='store_true', help='Run in-process micro-benchmarks only')
+    parser.add_argument('--startup', action='store_true',
+                        help='Measure import time and time-to-first-request of each target only')
+    parser.add_argument('--startup-runs', type=int, default=5, help='Runs per startup measurement')
+    parser.add_argument('--max-import-ms', type=float, default=0,
+                        help='With --startup: exit 1 if median import of app exceeds this (0 = no limit)')
+    parser.add_argument('--serve', choices=TARGETS, help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    fake_ollama.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port)
+        return
+    if args.micro:
+        write_output(micro_benchmarks(), args.output)
+        return
+
+    targets = [t for t in args.targets.split(',') if t]
+    for target in targets:
+        if target not in TARGETS:
+            parser.error(f"Unknown target: {target}")
+
+    if args.startup:
+        fake = fake_ollama.from_arguments(args).start()
+        try:
+            report = startup_benchmarks(targets, server_env(args, fake), args.startup_runs)
+        finally:
+            fake.stop()
+        write_output(report, args.output)
+        # Chạy trong CI: dependency tuỳ chọn bị import sớm hoặc import quá ngân sách -> lỗi
+        app_import = report['import']['app']
+        failed = [f"{module} imports {', '.join(result['eager_optional'])} at startup"
+                  for module, result in report['import'].items() if result['eager_optional']]
+        if args.max_import_ms and app_import['median_ms'] > args.max_import_ms:
+            failed.append(f"import app took {app_import['median_ms']} ms (budget {args.max_import_ms:.0f} ms)")
+        for reason in failed:
+            print(f"STARTUP REGRESSION: {reason}", file=sys.stderr)
+        sys.exit(1 if failed else 0)
+    levels = [int(c) for c in args.concurrency.split(',') if c]
+    width, height = (int(v) for v in args.image_size.lower().split('x'))
+    images = [make_png(width, height, seed) for seed in range(4)] if args.image_ratio > 0 else []
+
+    report = {
+        'config': {
+            key: value for key, value in vars(args).items()
+            if key not in ('serve', 'port', 'output', 'log')
+        },
+        'python': sys.version.split()[0],
+        'targets': {}
+    }
+
+    for target in targets:
+        fake = fake_ollama.from_arguments(args).start()
+        env = server_env(args, fake)
+
+        process, base_url = start_server(target, free_port(), env, args.log)
+        print(f"[{target}] server ready at {base_url}", file=sys.stderr)
+        try:
+            workload = Workload(args.seed, args.languages, args.image_ratio, args.stream_ratio,
+                                args.repeat_ratio, args.search_ratio, images)
+            run_level(base_url, workload, 1, args.duration, args.warmup, args.timeout)
+
+            results = []
+            for concurrency in levels:
+                before = fake.calls
+                level = run_level(base_url, workload, concurrency, args.duration, args.requests, args.timeout)
+                level = {'concurrency': concurrency, **level, 'ollama_calls': fake.calls - before,
+                         'server': server_snapshot(base_url)}
+                results.append(level)
+                latency = level['latency'] or {}
+                print(f"[{target}] c={concurrency:<4} {level['throughput_rps']:>8.2f} req/s  "
+                      f"p50={latency.get('p50', 0):.3f}s p95={latency.get('p95', 0):.3f}s "
+                      f"p99={latency.get('p99', 0):.3f}s  errors={level['error_rate']:.2%}", file=sys.stderr)
+            report['targets'][target] = results
+        finally:
+            stop_server(process)
+            fake.stop()
+
+    write_output(report, args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+Build chỉ mục tìm kiếm cục bộ (retrieval.py) từ thư mục tài liệu lịch sử.
+
+    python build_index.py
+    python build_index.py --corpus corpus --index index
+
+Tài liệu: .txt / .md (UTF-8), .pdf nếu đã cài pypdf. Server đang chạy tự nạp
+bản mới ở lần refresh kế tiếp, không cần restart.
+"""
+import argparse
+import logging
+import time
+import os
+
+from retrieval import build_index
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the local retrieval index')
+    parser.add_argument('--corpus', default=os.environ.get('CORPUS_DIR', os.path.join(BASE_DIR, 'corpus')),
+                        help='Directory with history documents')
+    parser.add_argument('--index', default=os.environ.get('INDEX_DIR', os.path.join(BASE_DIR, 'index')),
+                        help='Output index directory')
+    parser.add_argument('--keep', type=int, default=2,
+                        help='Number of index generations to keep')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if not os.path.isdir(args.corpus):
+        parser.error(f"Corpus directory not found: {args.corpus}")
+
+    start = time.perf_counter()
+    generation, files, passages = build_index(args.corpus, args.index, keep=args.keep)
+    print(f"Index {generation}: {files} files, {passages} passages "
+          f"in {time.perf_counter() - start:.2f}s -> {args.index}")
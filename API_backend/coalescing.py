@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+"""
+Gộp các request giống hệt nhau đang chạy (single-flight).
+
+Khi 40 học sinh gửi cùng một câu hỏi cùng lúc, chỉ một lời gọi Ollama được
+thực hiện; các request còn lại chờ và dùng chung kết quả. Với streaming, các
+client dùng chung một luồng token (client vào sau nhận lại các token đã có).
+
+Key = hash của payload gửi Ollama (model + prompt + options + images), không
+tính field "stream".
+"""
+import threading
+import hashlib
+import logging
+import asyncio
+import json
+
+logger = logging.getLogger(__name__)
+
+def request_key(payload):
+    """Hash payload /api/generate (bỏ qua 'stream')"""
+    digest = hashlib.sha256()
+    digest.update(payload.get('model', '').encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(payload.get('prompt', '').encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(json.dumps(payload.get('options', {}), sort_keys=True).encode('utf-8'))
+    for image in payload.get('images', ()):
+        digest.update(b'\0')
+        if isinstance(image, str):
+            digest.update(image.encode('ascii'))
+        elif isinstance(image, bytes):
+            digest.update(image)
+        else:
+            # PreparedImage: sha256 của ảnh, không cần base64 cả ảnh chỉ để tính key
+            digest.update(image.digest().encode('ascii'))
+    return digest.hexdigest()
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class SharedStream:
+    """
+    Một luồng NDJSON từ Ollama được chia cho nhiều subscriber.
+
+    Không có thread nền: subscriber nào cần dòng tiếp theo mà chưa có thì tự
+    đọc từ upstream (chỉ một subscriber đọc tại một thời điểm), nên client đầu
+    tiên ngắt kết nối thì client khác vẫn tiếp tục nhận token. Khi subscriber
+    cuối cùng rời đi trước khi xong, upstream bị đóng để Ollama dừng sinh token.
+
+    Thứ tự khoá: lock của SingleFlight rồi mới tới _cond của luồng.
+    """
+
+    def __init__(self, owner, key, response, on_close=None):
+        self._owner = owner
+        self._key = key
+        self.response = response
+        self.status_code = response.status_code
+        self.error_text = None
+        self._on_close = on_close
+        self._iter = response.iter_lines()
+        self._lines = []
+        self._done = False
+        self._cancelled = False
+        self._error = None
+        self._pumping = False
+        self._subscribers = 0
+        self._cond = threading.Condition()
+
+    def _join(self):
+        """Thêm một subscriber; False nếu luồng đã bị huỷ (mọi subscriber đã rời đi)"""
+        with self._cond:
+            if self._cancelled:
+                return False
+            self._subscribers += 1
+            return True
+
+    def _lines_from_start(self):
+        index = 0
+        while True:
+            pump = False
+            with self._cond:
+                while index >= len(self._lines) and not self._done and self._pumping:
+                    self._cond.wait()
+                if index < len(self._lines):
+                    line = self._lines[index]
+                    index += 1
+                elif self._done:
+                    if self._error is not None:
+                        raise self._error
+                    return
+                else:
+                    self._pumping = True
+                    pump = True
+
+            if pump:
+                self._pump()
+                continue
+            yield line
+
+    def _pump(self):
+        try:
+            line = next(self._iter, None)
+            error = None
+        except Exception as e:
+            line, error = None, e
+
+        with self._owner._lock, self._cond:
+            finished = not self._done
+            if error is not None:
+                self._error = error
+                self._done = True
+            elif line is None:
+                self._done = True
+            elif not self._done:
+                self._lines.append(line)
+            finished = finished and self._done
+            if finished:
+                self._owner._release_stream(self._key, self)
+            self._pumping = False
+            self._cond.notify_all()
+        if finished:
+            self._finish()
+
+    def _finish(self):
+        """Gọi đúng một lần khi luồng kết thúc (hết dữ liệu, lỗi hoặc bị huỷ)"""
+        self.response.close()
+        on_close, self._on_close = self._on_close, None
+        if on_close:
+            on_close()
+
+    def _leave(self, subscription):
+        # Rời luồng và gỡ luồng khỏi SingleFlight trong cùng một lần giữ khoá:
+        # không subscriber mới nào tham gia được luồng vừa bị huỷ
+        with self._owner._lock, self._cond:
+            if subscription.left:
+                return
+            subscription.left = True
+            self._subscribers -= 1
+            cancel = self._subscribers == 0 and not self._done
+            if cancel:
+                self._done = self._cancelled = True
+                self._owner._release_stream(self._key, self)
+                self._cond.notify_all()
+        if cancel:
+            logger.debug("All subscribers left, closing upstream stream")
+            self._finish()
+
+class StreamSubscription:
+    """
+    Chỗ của một request trong SharedStream. close() trả chỗ (gọi nhiều lần
+    không sao); caller gắn close() vào việc đóng response để chỗ được trả cả
+    khi client ngắt kết nối trước khi generator của lines() kịp chạy.
+    """
+
+    __slots__ = ('flight', 'joined', 'left')
+
+    def __init__(self, flight, joined=True):
+        self.flight = flight
+        self.joined = joined
+        self.left = not joined
+
+    @property
+    def status_code(self):
+        return self.flight.status_code
+
+    @property
+    def error_text(self):
+        return self.flight.error_text
+
+    def lines(self):
+        """Generator trả từng dòng (bytes) từ đầu luồng"""
+        try:
+            yield from self.flight._lines_from_start()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.joined:
+            self.flight._leave(self)
+
+class SingleFlight:
+    """Single-flight cho server đa luồng (Flask/Waitress)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._streams = {}
+        self.leader_calls = 0
+        self.shared_calls = 0
+
+    def do(self, key, fn):
+        """
+        Chạy fn() một lần cho mỗi key đang in-flight.
+        Trả về (result, shared) - shared=True nếu dùng lại kết quả của request khác.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self.leader_calls += 1
+            else:
+                self.shared_calls += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result, False
+
+    def stream(self, key, open_fn):
+        """
+        Mở (hoặc tham gia) một luồng streaming.
+        open_fn() trả về (requests.Response với stream=True, on_close); on_close (có thể
+        None) được gọi khi luồng kết thúc, ví dụ để trả slot admission.
+        Trả về (StreamSubscription, shared); caller phải gọi subscription.close() khi
+        response đóng. Nếu upstream trả lỗi (status != 200), status_code cho biết và
+        luồng không được dùng lại cho request sau.
+        """
+        while True:
+            with self._lock:
+                flight = self._streams.get(key)
+                if flight is not None and flight._join():
+                    self.shared_calls += 1
+                    return StreamSubscription(flight), True
+
+            flight, shared = self.do(('open', key), lambda: self._open(key, open_fn))
+            if flight.status_code != 200:
+                return StreamSubscription(flight, joined=False), shared
+            # Người mở đã được tính là subscriber trong _open
+            if not shared:
+                return StreamSubscription(flight), False
+            if flight._join():
+                return StreamSubscription(flight), True
+            # Luồng vừa mở đã bị huỷ trước khi kịp tham gia -> mở lại
+
+    def _open(self, key, open_fn):
+        response, on_close = open_fn()
+        flight = SharedStream(self, key, response, on_close)
+        if response.status_code == 200:
+            flight._subscribers = 1
+            with self._lock:
+                self._streams[key] = flight
+        else:
+            flight.error_text = response.text
+            flight._finish()
+        return flight
+
+    def _release_stream(self, key, flight):
+        # Gọi khi đang giữ self._lock
+        if self._streams.get(key) is flight:
+            del self._streams[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._calls),
+                'streams': len(self._streams),
+                'leader_calls': self.leader_calls,
+                'shared_calls': self.shared_calls
+            }
+
+class AsyncSharedStream:
+    """Bản asyncio của SharedStream; việc đọc upstream chạy trong task riêng (shield)"""
+
+    def __init__(self, owner, key, response, on_close=None):
+        self._owner = owner
+        self._key = key
+        self.response = response
+        self.status_code = response.status_code
+        self.error_text = None
+        self._on_close = on_close
+        self._iter = response.aiter_lines()
+        self._lines = []
+        self._done = False
+        self._cancelled = False
+        self._error = None
+        self._reader = None
+        self._subscribers = 0
+
+    def _join(self):
+        if self._cancelled:
+            return False
+        self._subscribers += 1
+        return True
+
+    async def _lines_from_start(self):
+        index = 0
+        while True:
+            if index < len(self._lines):
+                index += 1
+                yield self._lines[index - 1]
+                continue
+            if self._done:
+                if self._error is not None:
+                    raise self._error
+                return
+            if self._reader is None:
+                self._reader = asyncio.ensure_future(self._read_next())
+            await asyncio.shield(self._reader)
+
+    async def _read_next(self):
+        try:
+            self._lines.append(await self._iter.__anext__())
+        except StopAsyncIteration:
+            self._done = True
+        except Exception as e:
+            self._error = e
+            self._done = True
+        finally:
+            self._reader = None
+        if self._done and not self._cancelled:
+            await self._finish()
+
+    async def _finish(self):
+        self._owner._release_stream(self._key, self)
+        await self.response.aclose()
+        on_close, self._on_close = self._on_close, None
+        if on_close:
+            on_close()
+
+    async def _leave(self, subscription):
+        if subscription.left:
+            return
+        subscription.left = True
+        self._subscribers -= 1
+        await self._cancel_if_unused()
+
+    async def _cancel_if_unused(self):
+        if self._subscribers == 0 and not self._done:
+            logger.debug("All subscribers left, closing upstream stream")
+            self._done = self._cancelled = True
+            # Gỡ khỏi owner trước lần await đầu tiên: không ai tham gia luồng đang bị huỷ
+            self._owner._release_stream(self._key, self)
+            if self._reader is not None:
+                self._reader.cancel()
+            await self._finish()
+
+class AsyncStreamSubscription:
+    """Bản asyncio của StreamSubscription"""
+
+    __slots__ = ('flight', 'joined', 'left')
+
+    def __init__(self, flight, joined=True):
+        self.flight = flight
+        self.joined = joined
+        self.left = not joined
+
+    @property
+    def status_code(self):
+        return self.flight.status_code
+
+    @property
+    def error_text(self):
+        return self.flight.error_text
+
+    async def lines(self):
+        """Async generator trả từng dòng từ đầu luồng"""
+        try:
+            async for line in self.flight._lines_from_start():
+                yield line
+        finally:
+            await self.close()
+
+    async def close(self):
+        if self.joined:
+            await self.flight._leave(self)
+
+class AsyncSingleFlight:
+    """Single-flight cho asyncio; lời gọi chạy trong task riêng nên client đầu tiên
+    ngắt kết nối không làm huỷ kết quả của các client khác"""
+
+    def __init__(self):
+        self._calls = {}
+        self._streams = {}
+        # Số request đang chờ luồng của key được mở (chưa tham gia)
+        self._opening = {}
+        self.leader_calls = 0
+        self.shared_calls = 0
+
+    async def do(self, key, fn):
+        task = self._calls.get(key)
+        shared = task is not None
+        if shared:
+            self.shared_calls += 1
+        else:
+            self.leader_calls += 1
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda _t: self._calls.pop(key, None))
+        return await asyncio.shield(task), shared
+
+    async def stream(self, key, open_fn):
+        """Bản async của SingleFlight.stream; trả về (AsyncStreamSubscription, shared)"""
+        while True:
+            flight = self._streams.get(key)
+            if flight is not None and flight._join():
+                self.shared_calls += 1
+                return AsyncStreamSubscription(flight), True
+
+            open_key = ('open', key)
+            self._opening[key] = self._opening.get(key, 0) + 1
+            cancelled = False
+            try:
+                flight, shared = await self.do(open_key, lambda: self._open(key, open_fn))
+                if flight.status_code != 200:
+                    return AsyncStreamSubscription(flight, joined=False), shared
+                if flight._join():
+                    return AsyncStreamSubscription(flight), shared
+            except asyncio.CancelledError:
+                cancelled = True
+                raise
+            finally:
+                self._opening[key] -= 1
+                if not self._opening[key]:
+                    del self._opening[key]
+                if cancelled:
+                    # Task mở luồng vẫn chạy tiếp (shield): nếu không còn ai chờ thì luồng
+                    # mở xong phải được đóng, không thì slot admission và kết nối bị giữ mãi
+                    task = self._calls.get(open_key)
+                    if task is not None:
+                        task.add_done_callback(lambda t: self._close_unclaimed(key, t))
+                    else:
+                        self._close_unclaimed(key, None)
+
+    def _close_unclaimed(self, key, task):
+        if task is not None and (task.cancelled() or task.exception() is not None):
+            return
+        flight = self._streams.get(key)
+        if flight is not None and not self._opening.get(key):
+            asyncio.ensure_future(flight._cancel_if_unused())
+
+    async def _open(self, key, open_fn):
+        response, on_close = await open_fn()
+        flight = AsyncSharedStream(self, key, response, on_close)
+        if response.status_code == 200:
+            self._streams[key] = flight
+        else:
+            flight.error_text = (await response.aread()).decode('utf-8', errors='replace')
+            await flight._finish()
+        return flight
+
+    def _release_stream(self, key, flight):
+        if self._streams.get(key) is flight:
+            del self._streams[key]
+
+    def stats(self):
+        return {
+            'in_flight': len(self._calls),
+            'streams': len(self._streams),
+            'leader_calls': self.leader_calls,
+            'shared_calls': self.shared_calls
+        }
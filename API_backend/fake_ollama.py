@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Ollama giả để benchmark/test backend khi không có GPU.
+
+    python fake_ollama.py --port 11434 --token-latency 0.02 --tokens 60
+
+- /api/tags, /api/ps, /api/generate (stream NDJSON và không stream)
+- Độ trễ mô phỏng: prompt eval theo số token prompt, mỗi token sinh ra,
+  thêm cho request có ảnh, nạp model ở lần gọi đầu (load_duration)
+- num_parallel request chạy cùng lúc như OLLAMA_NUM_PARALLEL, còn lại xếp hàng
+- Trả về eval_count / eval_duration / prompt_eval_* / context như Ollama thật
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+import argparse
+import json
+import time
+
+REPLY_WORDS = ("Năm 1945 Chủ tịch Hồ Chí Minh đọc bản Tuyên ngôn độc lập tại quảng trường "
+               "Ba Đình khai sinh nước Việt Nam Dân chủ Cộng hòa").split()
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Client đóng kết nối keep-alive -> không in traceback
+        pass
+
+class FakeOllama:
+    """Server Ollama giả chạy trong thread nền (start/stop) hoặc từ dòng lệnh"""
+
+    def __init__(self, host='127.0.0.1', port=0, models=('gemma2:9b', 'llava:7b'), tokens=40,
+                 token_latency=0.02, prompt_latency=0.0005, image_latency=0.5, load_latency=0.0,
+                 num_parallel=4):
+        self.models = list(models)
+        self.tokens = tokens
+        self.token_latency = token_latency
+        self.prompt_latency = prompt_latency
+        self.image_latency = image_latency
+        self.load_latency = load_latency
+        self.num_parallel = num_parallel
+
+        self._slots = threading.BoundedSemaphore(num_parallel)
+        self._lock = threading.Lock()
+        self._loaded = set()
+        self.calls = 0
+
+        owner = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                owner._handle_get(self)
+
+            def do_POST(self):
+                owner._handle_post(self)
+
+        self.server = _Server((host, port), Handler)
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='fake-ollama', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # ---- HTTP ----
+
+    def _send_json(self, handler, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def _handle_get(self, handler):
+        if handler.path == '/api/tags':
+            self._send_json(handler, {'models': [{'name': m} for m in self.models]})
+        elif handler.path == '/api/ps':
+            with self._lock:
+                self._send_json(handler, {'models': [{'name': m} for m in sorted(self._loaded)]})
+        else:
+            self._send_json(handler, {'error': 'not found'}, 404)
+
+    def _read_body(self, handler):
+        if handler.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = b''
+            while True:
+                size = int(handler.rfile.readline().strip(), 16)
+                if size == 0:
+                    handler.rfile.readline()
+                    return body
+                body += handler.rfile.read(size)
+                handler.rfile.readline()
+        return handler.rfile.read(int(handler.headers.get('Content-Length') or 0))
+
+    def _handle_post(self, handler):
+        if handler.path != '/api/generate':
+            self._send_json(handler, {'error': 'not found'}, 404)
+            return
+        try:
+            request = json.loads(self._read_body(handler))
+        except ValueError:
+            self._send_json(handler, {'error': 'invalid JSON'}, 400)
+            return
+        model = request.get('model')
+        if model not in self.models:
+            self._send_json(handler, {'error': f"model '{model}' not found"}, 404)
+            return
+        with self._lock:
+            self.calls += 1
+
+        with self._slots:
+            self._generate(handler, request, model)
+
+    def _generate(self, handler, request, model):
+        start = time.perf_counter()
+        load_duration = 0.0
+        with self._lock:
+            cold = model not in self._loaded
+            self._loaded.add(model)
+        if cold and self.load_latency:
+            time.sleep(self.load_latency)
+            load_duration = self.load_latency
+
+        prompt_tokens = max(1, len(request.get('prompt', '').split()))
+        prompt_seconds = prompt_tokens * self.prompt_latency
+        if request.get('images'):
+            prompt_seconds += self.image_latency
+        time.sleep(prompt_seconds)
+
+        num_predict = (request.get('options') or {}).get('num_predict') or self.tokens
+        tokens = [REPLY_WORDS[i % len(REPLY_WORDS)] + ' ' for i in range(min(self.tokens, num_predict))]
+        done = {
+            'model': model,
+            'response': '',
+            'done': True,
+            'total_duration': 0,
+            'load_duration': int(load_duration * 1e9),
+            'prompt_eval_count': prompt_tokens,
+            'prompt_eval_duration': int(prompt_seconds * 1e9),
+            'eval_count': len(tokens),
+            'eval_duration': int(len(tokens) * self.token_latency * 1e9),
+            'context': list(request.get('context') or []) + list(range(prompt_tokens + len(tokens)))
+        }
+
+        if not request.get('stream', True):
+            time.sleep(len(tokens) * self.token_latency)
+            done['response'] = ''.join(tokens)
+            done['total_duration'] = int((time.perf_counter() - start) * 1e9)
+            self._send_json(handler, done)
+            return
+
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/x-ndjson')
+        handler.send_header('Transfer-Encoding', 'chunked')
+        handler.end_headers()
+        try:
+            for token in tokens:
+                time.sleep(self.token_latency)
+                self._write_chunk(handler, {'model': model, 'response': token, 'done': False})
+            done['total_duration'] = int((time.perf_counter() - start) * 1e9)
+            self._write_chunk(handler, done)
+            handler.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # Client (backend) đóng luồng giữa chừng -> dừng sinh token như Ollama thật
+            handler.close_connection = True
+
+    def _write_chunk(self, handler, data):
+        line = (json.dumps(data, ensure_ascii=False) + '\n').encode('utf-8')
+        handler.wfile.write(b'%x\r\n%s\r\n' % (len(line), line))
+        handler.wfile.flush()
+
+def add_arguments(parser):
+    """Tham số cấu hình FakeOllama (dùng chung với benchmark.py)"""
+    parser.add_argument('--tokens', type=int, default=40, help='Tokens generated per answer')
+    parser.add_argument('--token-latency', type=float, default=0.02, help='Seconds per generated token')
+    parser.add_argument('--prompt-latency', type=float, default=0.0005, help='Seconds per prompt token')
+    parser.add_argument('--image-latency', type=float, default=0.5, help='Extra seconds for image requests')
+    parser.add_argument('--load-latency', type=float, default=0.0, help='Seconds to "load" a model on first use')
+    parser.add_argument('--num-parallel', type=int, default=4, help='Concurrent generations (OLLAMA_NUM_PARALLEL)')
+
+def from_arguments(args, host='127.0.0.1', port=0):
+    return FakeOllama(host=host, port=port, tokens=args.tokens, token_latency=args.token_latency,
+                      prompt_latency=args.prompt_latency, image_latency=args.image_latency,
+                      load_latency=args.load_latency, num_parallel=args.num_parallel)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Ollama server for benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11434)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    fake = from_arguments(args, args.host, args.port)
+    print(f"Fake Ollama listening on {fake.url} (models: {', '.join(fake.models)})")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Tiền xử lý ảnh trước khi gửi cho VISION_MODEL.
+
+Ảnh chụp trang sách bằng điện thoại thường 4-8 MB, 12+ megapixel, trong khi
+llava chỉ nhìn ở độ phân giải ~672px. Pipeline:
+- Đọc header trước, từ chối ảnh "decompression bomb" (quá nhiều pixel)
+- Decode đúng một lần; với JPEG dùng draft() để decode thẳng ở độ phân giải nhỏ
+- Xoay theo EXIF orientation rồi bỏ toàn bộ metadata (EXIF, GPS...)
+- Thu nhỏ về cạnh dài VISION_MAX_SIDE, lấy frame đầu của GIF động
+- Xuất JPEG (ảnh chụp) hoặc PNG (ảnh palette/đen trắng như sơ đồ, GIF)
+- Tính perceptual hash (dHash 64 bit) để vision cache nhận ra ảnh chụp lại/nén lại
+
+Pillow là dependency tuỳ chọn, chỉ import ở ảnh đầu tiên: nếu chưa cài, ảnh được gửi nguyên vẹn, đọc
+thẳng từ file upload khi gửi (không nạp cả file vào RAM, xem image_upload.py).
+"""
+from image_upload import BufferMeter, in_memory_size
+import importlib.util
+import warnings
+import hashlib
+import logging
+import time
+import io
+
+# Pillow được import ở ảnh đầu tiên (load_pillow), không phải lúc khởi động server
+Image = ImageOps = UnidentifiedImageError = None
+_pillow_loaded = False
+
+logger = logging.getLogger(__name__)
+
+VISION_MAX_SIDE = 672
+MAX_IMAGE_PIXELS = 40_000_000
+JPEG_QUALITY = 85
+DHASH_SIZE = 8
+
+class ImageRejected(ValueError):
+    """Ảnh không hợp lệ hoặc nguy hiểm (hỏng, quá nhiều pixel)"""
+
+class PreparedImage:
+    """
+    Kết quả tiền xử lý: ảnh gửi cho model (bytes, hoặc stream của file upload
+    khi gửi nguyên vẹn) + số liệu trước/sau. Đặt thẳng vào payload['images'].
+    """
+
+    __slots__ = ('data', 'stream', 'format', 'width', 'height', 'original_width', 'original_height',
+                 'bytes_before', 'bytes_after', 'elapsed', 'phash', 'meter', '_digest')
+
+    def __init__(self, data, format, width, height, original_width, original_height,
+                 bytes_before, elapsed, phash=None, stream=None, meter=None):
+        self.data = data
+        self.stream = stream
+        self.format = format
+        self.width = width
+        self.height = height
+        self.original_width = original_width
+        self.original_height = original_height
+        self.bytes_before = bytes_before
+        self.bytes_after = len(data) if data is not None else bytes_before
+        self.elapsed = elapsed
+        self.phash = phash
+        self.meter = meter or BufferMeter()
+        self._digest = None
+
+    @property
+    def size(self):
+        return self.bytes_after
+
+    def open(self):
+        """File-like đọc ảnh từ đầu (BytesIO dùng chung buffer của data, không copy)"""
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        self.stream.seek(0)
+        return self.stream
+
+    def digest(self):
+        """sha256 (hex) của ảnh gửi cho model, tính theo block"""
+        if self._digest is None:
+            if self.data is not None:
+                self._digest = hashlib.sha256(self.data).hexdigest()
+            else:
+                digest = hashlib.sha256()
+                source = self.open()
+                for block in iter(lambda: source.read(64 * 1024), b''):
+                    digest.update(block)
+                self._digest = digest.hexdigest()
+        return self._digest
+
+    def stats(self):
+        return {
+            'bytes_before': self.bytes_before,
+            'bytes_after': self.bytes_after,
+            'format': self.format,
+            'size': [self.width, self.height],
+            'original_size': [self.original_width, self.original_height],
+            'preprocess_time': round(self.elapsed, 3),
+            'peak_memory': self.meter.peak
+        }
+
+def load_pillow():
+    """Import Pillow nếu chưa (gọi nhiều lần không sao); False nếu chưa cài"""
+    global Image, ImageOps, UnidentifiedImageError, _pillow_loaded
+    if not _pillow_loaded:
+        try:
+            from PIL import Image as image, ImageOps as image_ops, UnidentifiedImageError as unidentified
+            # Giới hạn pixel được kiểm tra trong preprocess_image, không cần cảnh báo của Pillow
+            warnings.filterwarnings('ignore', category=image.DecompressionBombWarning)
+            ImageOps, UnidentifiedImageError = image_ops, unidentified
+            Image = image
+        except ImportError:
+            pass
+        _pillow_loaded = True
+    return Image is not None
+
+def is_available():
+    """Pillow đã cài chưa (không import)"""
+    return Image is not None or importlib.util.find_spec('PIL') is not None
+
+def dhash(img, hash_size=DHASH_SIZE):
+    """Difference hash: so sánh độ sáng các pixel kề nhau trên ảnh xám (hash_size+1) x hash_size"""
+    small = img.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+def _stream_size(stream):
+    position = stream.tell()
+    stream.seek(0, io.SEEK_END)
+    size = stream.tell()
+    stream.seek(position)
+    return size
+
+def preprocess_image(stream, max_side=VISION_MAX_SIDE, max_pixels=MAX_IMAGE_PIXELS,
+                     jpeg_quality=JPEG_QUALITY):
+    """
+    Tiền xử lý ảnh từ file-like object (seekable). Trả về PreparedImage.
+    Raise ImageRejected nếu ảnh hỏng hoặc vượt max_pixels.
+    """
+    start = time.perf_counter()
+    bytes_before = _stream_size(stream)
+    meter = BufferMeter()
+    # File upload nhỏ nằm trong RAM (BytesIO / SpooledTemporaryFile chưa spool ra đĩa)
+    meter.hold(in_memory_size(stream))
+
+    if not load_pillow():
+        return PreparedImage(None, 'original', 0, 0, 0, 0, bytes_before, time.perf_counter() - start,
+                             stream=stream, meter=meter)
+
+    try:
+        # Image.open chỉ đọc header -> kiểm tra kích thước trước khi decode
+        img = Image.open(stream)
+    except Image.DecompressionBombError as e:
+        raise ImageRejected(f"Image has too many pixels: {e}")
+    except (UnidentifiedImageError, OSError):
+        raise ImageRejected("Cannot read image: unsupported or corrupted file")
+
+    original_width, original_height = img.size
+    if original_width * original_height > max_pixels:
+        raise ImageRejected(
+            f"Image has too many pixels ({original_width}x{original_height}, max {max_pixels})"
+        )
+
+    try:
+        if getattr(img, 'is_animated', False):
+            img.seek(0)
+        if img.format == 'JPEG':
+            img.draft('RGB', (max_side, max_side))
+        img = ImageOps.exif_transpose(img)
+        img.load()
+        # Ảnh đã decode (ở độ phân giải draft với JPEG) là buffer lớn nhất của nhánh này
+        decoded = img.width * img.height * len(img.getbands())
+        meter.hold(decoded)
+        img.thumbnail((max_side, max_side), Image.Resampling.BICUBIC, reducing_gap=2.0)
+
+        if img.mode in ('P', '1'):
+            output_format = 'PNG'
+        else:
+            output_format = 'JPEG'
+            if img.mode in ('RGBA', 'LA') or 'transparency' in img.info:
+                rgba = img.convert('RGBA')
+                img = Image.new('RGB', rgba.size, (255, 255, 255))
+                img.paste(rgba, mask=rgba.getchannel('A'))
+            elif img.mode != 'RGB':
+                img = img.convert('RGB')
+
+        phash = dhash(img)
+        output = io.BytesIO()
+        if output_format == 'JPEG':
+            img.save(output, 'JPEG', quality=jpeg_quality)
+        else:
+            img.save(output, 'PNG')
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise ImageRejected(f"Cannot decode image: {e}")
+    meter.hold(output.tell())
+    meter.release(decoded)
+
+    prepared = PreparedImage(output.getvalue(), output_format.lower(), img.width, img.height,
+                             original_width, original_height, bytes_before,
+                             time.perf_counter() - start, phash, meter=meter)
+    logger.debug("Image preprocessed: %dx%d -> %dx%d, %.1f KB -> %.1f KB in %.0f ms",
+                 original_width, original_height, img.width, img.height,
+                 bytes_before / 1024, prepared.bytes_after / 1024, prepared.elapsed * 1000)
+    return prepared
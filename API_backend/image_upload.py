@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Body JSON của /api/generate có ảnh, base64 từng block trong lúc gửi.
+
+Cách cũ: file.read() -> b64encode -> .decode() -> requests json.dumps ->
+.encode(), tức 4-5 bản sao cả ảnh cùng nằm trong bộ nhớ mỗi request.
+GenerateBody đọc ảnh (bytes đã tiền xử lý hoặc file upload spooled của
+Werkzeug/Starlette) theo block BLOCK_SIZE, base64 từng block rồi đưa thẳng
+vào socket:
+- BLOCK_SIZE là bội số của 3 nên các đoạn base64 ghép lại đúng bằng base64 của cả ảnh
+- Độ dài body tính trước -> gửi với Content-Length, không cần chunked
+- requests: truyền body (iterable có __len__); httpx: body.aiter() + Content-Length
+- Mỗi lần duyệt bắt đầu lại từ đầu ảnh -> retry / chuyển node gửi lại được
+BufferMeter đếm số byte buffer mà một request giữ cùng lúc; đỉnh được trả về
+trong image_stats['peak_memory'].
+"""
+import threading
+import base64
+import json
+
+BLOCK_SIZE = 48 * 1024
+
+def base64_length(size):
+    return (size + 2) // 3 * 4
+
+def in_memory_size(stream):
+    """Số byte file upload đang nằm trong RAM (0 nếu đã spool ra đĩa)"""
+    if getattr(stream, '_rolled', True) and not hasattr(stream, 'getbuffer'):
+        return 0
+    position = stream.tell()
+    stream.seek(0, 2)
+    size = stream.tell()
+    stream.seek(position)
+    return size
+
+class BufferMeter:
+    """Số byte buffer một request đang giữ và đỉnh của nó (thread-safe)"""
+
+    __slots__ = ('_lock', 'current', 'peak')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+
+    def hold(self, nbytes):
+        with self._lock:
+            self.current += nbytes
+            if self.current > self.peak:
+                self.peak = self.current
+
+    def release(self, nbytes):
+        with self._lock:
+            self.current -= nbytes
+
+def streams_images(payload):
+    """Payload có ảnh chưa base64 (PreparedImage) -> phải gửi bằng GenerateBody"""
+    return any(not isinstance(image, str) for image in payload.get('images') or ())
+
+class GenerateBody:
+    """
+    Body JSON của payload /api/generate; phần tử của payload['images'] là chuỗi
+    base64 hoặc object có open() / size / meter (PreparedImage).
+    """
+
+    def __init__(self, payload, block_size=BLOCK_SIZE):
+        if block_size % 3:
+            raise ValueError("block_size must be a multiple of 3")
+        fields = {key: value for key, value in payload.items() if key != 'images'}
+        head = json.dumps(fields)
+        self.head = (head[:-1] + (', ' if fields else '') + '"images": [').encode('utf-8')
+        self.tail = b']}'
+        self.images = list(payload.get('images') or ())
+        self.block_size = block_size
+        self.length = (len(self.head) + len(self.tail) + max(0, len(self.images) - 1)
+                       + sum(2 + self._encoded_length(image) for image in self.images))
+
+    @staticmethod
+    def _encoded_length(image):
+        return len(image) if isinstance(image, str) else base64_length(image.size)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        yield self.head
+        for i, image in enumerate(self.images):
+            yield b',"' if i else b'"'
+            if isinstance(image, str):
+                yield image.encode('ascii')
+            else:
+                yield from self._encode(image)
+            yield b'"'
+        yield self.tail
+
+    async def aiter(self):
+        """Cho httpx.AsyncClient (nhận async iterable); đọc block từ RAM/đĩa spool rất nhanh"""
+        for chunk in self:
+            yield chunk
+
+    def _encode(self, image):
+        meter = image.meter
+        source = image.open()
+        carry = b''
+        while True:
+            block = source.read(self.block_size)
+            if not block:
+                break
+            if carry:
+                block = carry + block
+            # read() có thể trả ít hơn block_size -> phần dư (không chia hết cho 3) để lại block sau
+            cut = len(block) - len(block) % 3
+            carry = block[cut:]
+            encoded = base64.b64encode(memoryview(block)[:cut])
+            held = len(block) + len(encoded)
+            meter.hold(held)
+            try:
+                yield encoded
+            finally:
+                meter.release(held)
+        if carry:
+            yield base64.b64encode(carry)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Phát hiện ngôn ngữ (vi / en / zh) và khớp từ khoá bằng regex biên dịch sẵn.
+
+- Bảng lớp ký tự CHAR_CLASSES: mọi chữ Việt dựng sẵn (12 nguyên âm × 5 dấu
+  thanh, hoa và thường, cùng đ), dấu kết hợp (văn bản NFD từ iOS/macOS được
+  chuẩn hoá NFC trước), chữ Hán (CJK Unified, Extension A-F, Compatibility)
+  và dấu câu CJK. Mỗi lớp là một character class của regex -> đếm trong C,
+  không lặp từng ký tự bằng Python
+- Chấm điểm thay vì dừng ở ký tự đầu tiên:
+    zh: số chữ Hán nhiều hơn số từ chữ Latin (bằng nhau mà không có từ tiếng Anh)
+    vi: số từ có chữ Việt + từ tiếng Việt không dấu ("la", "gi", "cua"...)
+    en: số từ chức năng tiếng Anh ("what", "who", "the"...) × EN_WEIGHT
+  nên "Who was Trần Hưng Đạo?" là en, "Nguyen Trai la ai" là vi; hoà điểm vi / en
+  thì theo default (ứng dụng mặc định tiếng Việt)
+- Từ khoá: mỗi danh sách thành một regex (alternation) biên dịch một lần;
+  từ khoá chữ Latin phải khớp trọn từ ("giá" không khớp "giáo dục")
+"""
+import unicodedata
+import re
+
+TONE_MARKS = '\u0300\u0301\u0309\u0303\u0323'      # huyền, sắc, hỏi, ngã, nặng
+VOWELS = 'aăâeêioôơuưy'
+
+def _vietnamese_letters():
+    letters = set('đĐ')
+    for vowel in VOWELS + VOWELS.upper():
+        if vowel not in 'aeiouyAEIOUY':
+            letters.add(vowel)
+        for tone in TONE_MARKS:
+            letters.add(unicodedata.normalize('NFC', vowel + tone))
+    return ''.join(sorted(letters))
+
+CHAR_CLASSES = {
+    # Chữ cái Latin (cả có dấu) và dấu kết hợp còn sót sau NFC
+    'latin': 'a-z0-9\u00c0-\u024f\u1e00-\u1eff\u0300-\u036f',
+    # Chữ Việt dựng sẵn và dấu riêng của tiếng Việt (móc, trăng, hỏi, nặng) ở dạng kết hợp
+    'vietnamese': _vietnamese_letters() + '\u0306\u0309\u031b\u0323',
+    'cjk': ('\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\U00020000-\U0002ebef'
+            '\u3000-\u303f\uff01-\uff0f\uff1a-\uff20')
+}
+
+_CJK = re.compile(f"[{CHAR_CLASSES['cjk']}]")
+_WORD = re.compile(f"[{CHAR_CLASSES['latin']}]+")
+# Từ chữ ký tự Việt đầu tiên tới hết từ -> mỗi từ có chữ Việt khớp đúng một lần, không backtrack
+_VIETNAMESE_WORD = re.compile(f"[{CHAR_CLASSES['vietnamese']}][{CHAR_CLASSES['latin']}]*")
+
+# Chỉ xét đầu tin nhắn: đủ để nhận ngôn ngữ, đoạn văn dài dán vào không làm chậm
+SAMPLE_CHARS = 256
+
+# Từ tiếng Việt hay gặp khi gõ không dấu (không trùng với từ tiếng Anh thông dụng)
+VIETNAMESE_PLAIN_WORDS = frozenset((
+    'la', 'gi', 'nao', 'cua', 'khong', 'duoc', 'nhung', 'trong', 'nguoi', 'voi', 'cho',
+    'nam', 'bao', 'nhieu', 'vua', 'nha', 'tai', 'sao', 'ai', 'va', 'cac', 'nhu', 'thoi',
+    'ky', 'chien', 'tranh', 'lich', 'su', 'viet', 'hay', 'ke', 've', 'lanh', 'dao', 'vuong',
+    'chuc', 'lap'
+))
+# Không có các từ trùng với tiếng Việt gõ không dấu: a, an (ăn/an), do, to (tổ/to),
+# me (mẹ), in, on (ôn), it (ít)
+ENGLISH_WORDS = frozenset((
+    'the', 'is', 'are', 'was', 'were', 'what', 'who', 'whom', 'when', 'where',
+    'why', 'how', 'which', 'did', 'does', 'of', 'at', 'and', 'for',
+    'about', 'tell', 'with', 'from', 'by', 'this', 'that', 'you', 'please',
+    'explain', 'describe', 'happened', 'during', 'after', 'before', 'history', 'war'
+))
+EN_WEIGHT = 2
+
+def nfc(text):
+    """Chuẩn hoá NFC (chỉ tạo chuỗi mới khi text chưa ở dạng NFC)"""
+    if text.isascii() or unicodedata.is_normalized('NFC', text):
+        return text
+    return unicodedata.normalize('NFC', text)
+
+def language_scores(text):
+    """(điểm vi, điểm en, số chữ Hán, số từ chữ Latin) của text"""
+    sample = text[:SAMPLE_CHARS]
+    ascii_only = sample.isascii()
+    lowered = (sample if ascii_only else nfc(sample)).lower()
+    words = _WORD.findall(lowered)
+    if ascii_only:
+        cjk = vi = 0
+    else:
+        cjk = len(_CJK.findall(lowered))
+        vi = len(_VIETNAMESE_WORD.findall(lowered))
+    vi += sum(map(VIETNAMESE_PLAIN_WORDS.__contains__, words))
+    en = EN_WEIGHT * sum(map(ENGLISH_WORDS.__contains__, words))
+    return vi, en, cjk, len(words)
+
+def detect_language(text, default='vi'):
+    """'vi' / 'en' / 'zh' theo điểm; text rỗng -> default, hoà điểm vi / en -> default"""
+    if not text or text.isspace():
+        return default
+    vi, en, cjk, words = language_scores(text)
+    if cjk > words or (cjk == words and cjk and not en):
+        return 'zh'
+    if vi > en:
+        return 'vi'
+    if vi and vi == en:
+        return 'en' if default == 'en' else 'vi'
+    if cjk and not en:
+        return 'zh'
+    return 'en'
+
+def compile_keywords(keywords):
+    """
+    Một regex cho cả danh sách từ khoá, dùng trên text đã nfc() và lower()
+    (lower() một lần rẻ hơn nhiều so với re.IGNORECASE trên Unicode).
+    """
+    latin_class = CHAR_CLASSES['latin']
+    latin, cjk = [], []
+    # Từ khoá dài trước để alternation ưu tiên cụm dài
+    for keyword in sorted({nfc(k).lower() for k in keywords}, key=len, reverse=True):
+        (cjk if _CJK.match(keyword) else latin).append(re.escape(keyword))
+    parts = []
+    if latin:
+        parts.append(f"(?<![{latin_class}])(?:{'|'.join(latin)})(?![{latin_class}])")
+    if cjk:
+        parts.append('|'.join(cjk))
+    return re.compile('|'.join(parts) or r'(?!)')
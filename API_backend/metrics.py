@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics cho /metrics theo định dạng text của Prometheus (không cần prometheus_client).
+
+- Counter / Gauge / Histogram có label, thread-safe
+- RequestTimer chia thời gian một request chat thành các bước (parse, image_encode,
+  image, cache, retrieval, search, prompt_build, ollama_queue, time_to_first_token,
+  generation, serialization). Timer của request hiện tại nằm trong ContextVar nên
+  các hàm sâu bên trong (admission, stream) gọi lap() mà không cần truyền tham số
+- Tốc độ sinh token lấy từ eval_count / eval_duration Ollama trả về
+- Số liệu đã có sẵn trong stats() (cache, admission, router...) được đọc lúc scrape
+"""
+import contextvars
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+TOKEN_RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 40, 60, 80, 120, 200)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+def render_family(name, kind, help_text, samples):
+    """Một metric family: samples là list (tên đầy đủ, dict label, giá trị)"""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    for sample_name, labels, value in samples:
+        lines.append(f"{sample_name}{_format_labels(labels)} {_format_value(value)}")
+    return '\n'.join(lines)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def render(self):
+        return render_family(self.name, self.kind, self.help, self.samples())
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name, dict(zip(self.labels, key)), value) for key, value in items]
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+        samples = []
+        for key, counts, total, count in items:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                samples.append((f"{self.name}_bucket", {**labels, 'le': _format_value(float(bound))}, cumulative))
+            samples.append((f"{self.name}_bucket", {**labels, 'le': '+Inf'}, count))
+            samples.append((f"{self.name}_sum", labels, round(total, 6)))
+            samples.append((f"{self.name}_count", labels, count))
+        return samples
+
+class RequestTimer:
+    """Thời gian từng bước của một request: lap(stage) cộng thời gian kể từ lap trước vào stage"""
+
+    __slots__ = ('endpoint', 'start', 'last', 'stages', 'labels', 'fields', 'finished')
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.start = self.last = time.perf_counter()
+        self.stages = {}
+        self.labels = {}
+        # Chỉ cho request log (request_id, kích thước, số token...), không thành label Prometheus
+        self.fields = {}
+        self.finished = False
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        if not self.finished:
+            self.stages[stage] = self.stages.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def note(self, **fields):
+        self.fields.update(fields)
+
+_current_timer = contextvars.ContextVar('request_timer', default=None)
+
+def current_timer():
+    return _current_timer.get()
+
+def lap(stage):
+    """Kết thúc bước `stage` của request hiện tại (không có request được đo thì bỏ qua)"""
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.lap(stage)
+
+def label(**labels):
+    """Gắn label (mode, language) cho request hiện tại"""
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.labels.update(labels)
+
+def note(**fields):
+    """Gắn field cho bản ghi request log của request hiện tại"""
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.fields.update(fields)
+
+class ChatMetrics:
+    """Các metric của API chat; render() xuất toàn bộ cho /metrics"""
+
+    def __init__(self):
+        self.requests = Counter('chat_requests_total',
+                                'Chat requests by endpoint, mode, language and HTTP status',
+                                ('endpoint', 'mode', 'language', 'status'))
+        self.duration = Histogram('chat_request_duration_seconds',
+                                  'End-to-end chat request latency', ('endpoint', 'mode'))
+        self.stages = Histogram('chat_stage_duration_seconds',
+                                'Chat request latency by processing stage', ('mode', 'stage'))
+        self.in_flight = Gauge('chat_requests_in_flight', 'Chat requests being processed', ('endpoint',))
+        self.eval_tokens = Counter('ollama_eval_tokens_total', 'Tokens generated by Ollama', ('model',))
+        self.eval_seconds = Counter('ollama_eval_seconds_total', 'Time Ollama spent generating tokens',
+                                    ('model',))
+        self.prompt_tokens = Counter('ollama_prompt_eval_tokens_total', 'Prompt tokens evaluated by Ollama',
+                                     ('model',))
+        self.prompt_seconds = Counter('ollama_prompt_eval_seconds_total',
+                                      'Time Ollama spent evaluating prompts', ('model',))
+        self.tokens_per_second = Histogram('ollama_tokens_per_second',
+                                           'Generation speed of each Ollama call (eval_count / eval_duration)',
+                                           ('model',), buckets=TOKEN_RATE_BUCKETS)
+        self._metrics = [self.requests, self.duration, self.stages, self.in_flight, self.eval_tokens,
+                         self.eval_seconds, self.prompt_tokens, self.prompt_seconds, self.tokens_per_second]
+
+    def begin(self, endpoint):
+        """Bắt đầu đo một request; timer thành timer hiện tại của context"""
+        timer = RequestTimer(endpoint)
+        _current_timer.set(timer)
+        self.in_flight.inc(endpoint=endpoint)
+        return timer
+
+    def finish(self, timer, status):
+        if timer.finished:
+            return
+        timer.finished = True
+        mode = timer.labels.get('mode', 'unknown')
+        self.in_flight.dec(endpoint=timer.endpoint)
+        self.requests.inc(endpoint=timer.endpoint, mode=mode,
+                          language=timer.labels.get('language', 'unknown'), status=status)
+        self.duration.observe(time.perf_counter() - timer.start, endpoint=timer.endpoint, mode=mode)
+        for stage, seconds in timer.stages.items():
+            self.stages.observe(seconds, mode=mode, stage=stage)
+
+    def observe_ollama(self, model, data):
+        """Đọc eval_count/eval_duration, prompt_eval_count/prompt_eval_duration (ns) của Ollama"""
+        eval_count = data.get('eval_count') or 0
+        eval_seconds = (data.get('eval_duration') or 0) / 1e9
+        if eval_count and eval_seconds:
+            self.eval_tokens.inc(eval_count, model=model)
+            self.eval_seconds.inc(eval_seconds, model=model)
+            self.tokens_per_second.observe(eval_count / eval_seconds, model=model)
+        prompt_count = data.get('prompt_eval_count') or 0
+        if prompt_count:
+            self.prompt_tokens.inc(prompt_count, model=model)
+            self.prompt_seconds.inc((data.get('prompt_eval_duration') or 0) / 1e9, model=model)
+
+    def render(self, families=()):
+        """Text exposition; families: (name, kind, help, samples) lấy từ stats() lúc scrape"""
+        blocks = [metric.render() for metric in self._metrics]
+        blocks += [render_family(*family) for family in families]
+        return '\n'.join(blocks) + '\n'
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Giữ model nằm sẵn trong RAM/VRAM của Ollama, tránh swap text <-> vision.
+
+Trên máy ít RAM, xen kẽ gemma2:9b và llava:7b làm Ollama unload/reload model,
+mỗi lần thêm 20-60 giây. ModelResidency:
+- Preload lúc khởi động bằng một prompt warm-up ngắn (vision trước, text sau
+  để model text - đường nóng - là model còn nằm lại nếu chỉ đủ chỗ cho một)
+- keep_alive của từng lời gọi theo tỉ lệ traffic gần đây: model chiếm phần
+  lớn traffic được giữ lâu, model hiếm được nhả sớm để nhường bộ nhớ
+- Ghi nhận load_duration Ollama trả về -> số lần cold load, thời gian load gần nhất
+- Khi model vision chưa được nạp, giữ request vision lại tối đa hold_seconds
+  (hoặc tới khi đủ hold_batch request) rồi thả cùng lúc: chi phí nạp model
+  chỉ trả một lần cho cả nhóm thay vì swap qua lại với text
+"""
+from collections import deque
+from batching import BatchGate
+import threading
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+TRAFFIC_WINDOW = 10 * 60
+# load_duration lớn hơn ngưỡng này nghĩa là Ollama thực sự phải nạp model
+COLD_LOAD_THRESHOLD = 1.0
+WARMUP_PROMPT = "Xin chào"
+
+class ModelResidency:
+    """Quản lý preload, keep_alive và hold request cho các model của một OllamaRouter"""
+
+    def __init__(self, router, models, min_keep_alive=60, max_keep_alive=30 * 60,
+                 hold_models=(), hold_seconds=2.0, hold_batch=4, window=TRAFFIC_WINDOW):
+        self.router = router
+        self.models = list(models)
+        self.min_keep_alive = min_keep_alive
+        self.max_keep_alive = max_keep_alive
+        self.hold_models = set(hold_models)
+        self.hold_seconds = hold_seconds
+        self.hold_batch = hold_batch
+        self.window = window
+
+        self._lock = threading.Lock()
+        self._traffic = deque()
+        self._gate = BatchGate(hold_seconds, hold_batch)
+        self._models = {
+            model: {
+                'preloaded': False,
+                'preload_time': None,
+                'last_load_duration': None,
+                'last_loaded_at': None,
+                'cold_loads': 0,
+                'held': 0,
+                'total_hold_time': 0.0
+            }
+            for model in self.models
+        }
+
+    # ---- Traffic / keep_alive ----
+
+    def record(self, model):
+        """Ghi nhận một request cho model (gọi khi tạo payload)"""
+        now = time.monotonic()
+        with self._lock:
+            self._traffic.append((now, model))
+            self._prune(now)
+
+    def _prune(self, now):
+        while self._traffic and self._traffic[0][0] < now - self.window:
+            self._traffic.popleft()
+
+    def share(self, model):
+        """Tỉ lệ request của model trong cửa sổ gần đây (None nếu chưa có traffic)"""
+        with self._lock:
+            self._prune(time.monotonic())
+            if not self._traffic:
+                return None
+            return sum(1 for _, m in self._traffic if m == model) / len(self._traffic)
+
+    def keep_alive(self, model):
+        """keep_alive cho lời gọi tiếp theo: model chiếm >= 50% traffic được giữ tối đa"""
+        share = self.share(model)
+        if share is None:
+            return f"{self.max_keep_alive}s"
+        seconds = self.min_keep_alive + (self.max_keep_alive - self.min_keep_alive) * min(1.0, share * 2)
+        return f"{int(seconds)}s"
+
+    def prepare(self, payload):
+        """Ghi nhận traffic và gắn keep_alive vào payload /api/generate"""
+        self.record(payload['model'])
+        payload['keep_alive'] = self.keep_alive(payload['model'])
+        return payload
+
+    # ---- Load state ----
+
+    def observe(self, model, data):
+        """Đọc load_duration (ns) từ response/chunk cuối của Ollama"""
+        load_duration = (data.get('load_duration') or 0) / 1e9
+        if model not in self._models or load_duration < COLD_LOAD_THRESHOLD:
+            return
+        with self._lock:
+            state = self._models[model]
+            state['cold_loads'] += 1
+            state['last_load_duration'] = round(load_duration, 2)
+            state['last_loaded_at'] = time.time()
+        logger.warning("Cold load of %s: %.1fs", model, load_duration)
+
+    def is_loaded(self, model):
+        """Model đang được nạp trên ít nhất một node khoẻ (theo /api/ps + lời gọi gần nhất)"""
+        return any(backend.healthy and model in backend.loaded_models
+                   for backend in self.router.backends)
+
+    # ---- Preload ----
+
+    def preload(self, timeout=300):
+        """Nạp sẵn mọi model trên mọi node phục vụ nó bằng prompt warm-up ngắn"""
+        for model in self.models:
+            for backend in self.router.backends:
+                if not backend.serves(model):
+                    continue
+                payload = {
+                    'model': model,
+                    'prompt': WARMUP_PROMPT,
+                    'stream': False,
+                    'keep_alive': self.keep_alive(model),
+                    'options': {'num_predict': 1}
+                }
+                start = time.perf_counter()
+                try:
+                    response = self.router.clients[backend.host].generate(payload, timeout=timeout)
+                except Exception as e:
+                    logger.error("Preload of %s on %s failed: %s", model, backend.host, e)
+                    continue
+                elapsed = time.perf_counter() - start
+                if response.status_code != 200:
+                    logger.error("Preload of %s on %s failed: %s", model, backend.host, response.status_code)
+                    continue
+                with self._lock:
+                    backend.loaded_models.add(model)
+                    state = self._models[model]
+                    state['preloaded'] = True
+                    state['preload_time'] = round(elapsed, 2)
+                self.observe(model, response.json())
+                logger.info("Preloaded %s on %s in %.1fs", model, backend.host, elapsed)
+
+    def start_preload(self):
+        thread = threading.Thread(target=self.preload, name='model-preload', daemon=True)
+        thread.start()
+        return thread
+
+    # ---- Hold ----
+
+    def _should_hold(self, model):
+        return model in self.hold_models and not self.is_loaded(model)
+
+    def _record_hold(self, model, waited):
+        with self._lock:
+            state = self._models[model]
+            state['held'] += 1
+            state['total_hold_time'] += waited
+
+    def hold(self, model):
+        """Chờ (tối đa hold_seconds) để các request vision cold đi cùng một đợt"""
+        if self._should_hold(model):
+            self._record_hold(model, self._gate.wait(model))
+
+    async def hold_async(self, model):
+        """Bản asyncio của hold()"""
+        if self._should_hold(model):
+            self._record_hold(model, await self._gate.wait_async(model))
+
+    def stats(self):
+        with self._lock:
+            self._prune(time.monotonic())
+            total = len(self._traffic)
+            counts = {}
+            for _, model in self._traffic:
+                counts[model] = counts.get(model, 0) + 1
+            models = {model: dict(state) for model, state in self._models.items()}
+
+        result = {}
+        for model, state in models.items():
+            share = counts.get(model, 0) / total if total else None
+            held = state.pop('held')
+            total_hold_time = state.pop('total_hold_time')
+            result[model] = {
+                'loaded': self.is_loaded(model),
+                **state,
+                'recent_requests': counts.get(model, 0),
+                'traffic_share': round(share, 3) if share is not None else None,
+                'keep_alive': self.keep_alive(model),
+                'held_requests': held,
+                'avg_hold_time': round(total_hold_time / held, 3) if held else 0.0
+            }
+        return result
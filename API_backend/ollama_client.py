@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP client dùng chung cho mọi lời gọi tới Ollama.
+
+- Connection pool keep-alive (không mở TCP mới cho mỗi request)
+- Timeout connect và read tách riêng
+- Retry có giới hạn + backoff khi kết nối bị reset/refused (không retry khi
+  read timeout, vì lúc đó model vẫn đang sinh token). POST (không idempotent)
+  chỉ retry lỗi ở bước kết nối: body đã gửi đi thì Ollama có thể đang sinh
+  câu trả lời, gửi lại sẽ chạy model hai lần
+- Thống kê độ trễ theo từng endpoint
+- Payload có ảnh PreparedImage được gửi bằng GenerateBody (base64 từng block)
+"""
+from image_upload import GenerateBody, streams_images
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+import requests
+import threading
+import logging
+import asyncio
+import time
+
+try:
+    import httpx
+except ImportError:  # chỉ cần cho asgi_app.py
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_MAX_RETRIES = 2
+DEFAULT_BACKOFF = 0.2
+JSON_HEADERS = {'Content-Type': 'application/json'}
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS'})
+
+def connect_failed(error):
+    """Lỗi requests xảy ra trước khi gửi request (chưa kết nối được): retry an toàn cho cả POST"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+class CallStats:
+    """Đếm số lần gọi, lỗi, retry và độ trễ theo endpoint (thread-safe)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, endpoint, latency, ok, retries=0):
+        with self._lock:
+            stats = self._stats.setdefault(endpoint, {
+                'calls': 0,
+                'errors': 0,
+                'retries': 0,
+                'total_latency': 0.0,
+                'max_latency': 0.0,
+                'last_latency': 0.0
+            })
+            stats['calls'] += 1
+            stats['retries'] += retries
+            if not ok:
+                stats['errors'] += 1
+            stats['total_latency'] += latency
+            stats['max_latency'] = max(stats['max_latency'], latency)
+            stats['last_latency'] = latency
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                endpoint: {
+                    'calls': s['calls'],
+                    'errors': s['errors'],
+                    'retries': s['retries'],
+                    'avg_latency': round(s['total_latency'] / s['calls'], 4) if s['calls'] else 0.0,
+                    'max_latency': round(s['max_latency'], 4),
+                    'last_latency': round(s['last_latency'], 4)
+                }
+                for endpoint, s in self._stats.items()
+            }
+
+class OllamaClient:
+    """
+    Client đồng bộ (Flask/Waitress).
+
+    Mỗi thread có requests.Session riêng nhưng tất cả mount chung một
+    HTTPAdapter, nên connection pool (urllib3, thread-safe) được chia sẻ.
+    pool_size nên bằng số worker thread của server.
+    """
+
+    def __init__(self, host, pool_size=8, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF):
+        self.host = host.rstrip('/')
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.call_stats = CallStats()
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self._adapter)
+            session.mount('https://', self._adapter)
+            self._local.session = session
+        return session
+
+    def request(self, method, path, timeout, stream=False, **kwargs):
+        """
+        Gửi request tới Ollama, trả về requests.Response.
+        Với stream=True, latency được tính tới lúc nhận header.
+        """
+        url = self.host + path
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                response = self._session().request(
+                    method, url, timeout=(self.connect_timeout, timeout), stream=stream, **kwargs
+                )
+            except requests.exceptions.ConnectionError as e:
+                retryable = method in IDEMPOTENT_METHODS or connect_failed(e)
+                if not retryable or attempt >= self.max_retries:
+                    self.call_stats.record(path, time.perf_counter() - start, False, attempt)
+                    raise
+                delay = self.backoff * (2 ** attempt)
+                attempt += 1
+                logger.warning("Ollama connection error on %s (%s), retry %d/%d in %.2fs",
+                               path, e, attempt, self.max_retries, delay)
+                time.sleep(delay)
+                continue
+            except Exception:
+                self.call_stats.record(path, time.perf_counter() - start, False, attempt)
+                raise
+
+            self.call_stats.record(path, time.perf_counter() - start, response.status_code < 500, attempt)
+            return response
+
+    def generate(self, payload, timeout, stream=False):
+        """POST /api/generate"""
+        if streams_images(payload):
+            return self.request('POST', '/api/generate', timeout, stream=stream,
+                                data=GenerateBody(payload), headers=JSON_HEADERS)
+        return self.request('POST', '/api/generate', timeout, stream=stream, json=payload)
+
+    def tags(self, timeout=5):
+        """GET /api/tags - danh sách model đã pull"""
+        return self.request('GET', '/api/tags', timeout)
+
+    def ps(self, timeout=5):
+        """GET /api/ps - các model đang được nạp"""
+        return self.request('GET', '/api/ps', timeout)
+
+    def stats(self):
+        return {
+            'pool_size': self.pool_size,
+            'endpoints': self.call_stats.snapshot()
+        }
+
+    def close(self):
+        self._adapter.close()
+
+class AsyncOllamaClient:
+    """Bản asyncio của OllamaClient (httpx.AsyncClient), dùng cho asgi_app.py"""
+
+    def __init__(self, host, max_connections=256, max_keepalive=32,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF):
+        if httpx is None:
+            raise RuntimeError("httpx is required for the async client: pip install httpx")
+        self.host = host.rstrip('/')
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.call_stats = CallStats()
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive
+            )
+        )
+
+    async def request(self, method, path, timeout, stream=False, content_factory=None, **kwargs):
+        """
+        Giống OllamaClient.request; stream=True trả response chưa đọc body.
+        content_factory() tạo body (async iterator, chỉ duyệt được một lần) cho mỗi lần thử.
+        """
+        url = self.host + path
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                if content_factory is not None:
+                    kwargs['content'] = content_factory()
+                upstream_request = self._client.build_request(
+                    method, url, timeout=httpx.Timeout(timeout, connect=self.connect_timeout), **kwargs
+                )
+                response = await self._client.send(upstream_request, stream=stream)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError) as e:
+                # RemoteProtocolError: kết nối đứt sau khi đã gửi body -> chỉ retry request idempotent
+                retryable = method in IDEMPOTENT_METHODS or not isinstance(e, httpx.RemoteProtocolError)
+                if not retryable or attempt >= self.max_retries:
+                    self.call_stats.record(path, time.perf_counter() - start, False, attempt)
+                    raise
+                delay = self.backoff * (2 ** attempt)
+                attempt += 1
+                logger.warning("Ollama connection error on %s (%s), retry %d/%d in %.2fs",
+                               path, e, attempt, self.max_retries, delay)
+                await asyncio.sleep(delay)
+                continue
+            except Exception:
+                self.call_stats.record(path, time.perf_counter() - start, False, attempt)
+                raise
+
+            self.call_stats.record(path, time.perf_counter() - start, response.status_code < 500, attempt)
+            return response
+
+    async def generate(self, payload, timeout, stream=False):
+        """POST /api/generate"""
+        if streams_images(payload):
+            body = GenerateBody(payload)
+            # content là async iterator -> request mới cho mỗi lần retry
+            return await self.request('POST', '/api/generate', timeout, stream=stream,
+                                      content_factory=body.aiter,
+                                      headers={**JSON_HEADERS, 'Content-Length': str(len(body))})
+        return await self.request('POST', '/api/generate', timeout, stream=stream, json=payload)
+
+    async def tags(self, timeout=5):
+        """GET /api/tags - danh sách model đã pull"""
+        return await self.request('GET', '/api/tags', timeout)
+
+    async def ps(self, timeout=5):
+        """GET /api/ps - các model đang được nạp"""
+        return await self.request('GET', '/api/ps', timeout)
+
+    def stats(self):
+        return {
+            'pool_size': self.max_connections,
+            'endpoints': self.call_stats.snapshot()
+        }
+
+    async def close(self):
+        await self._client.aclose()
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+Điều phối request tới nhiều máy Ollama.
+
+OLLAMA_BACKENDS khai báo các node và model mà mỗi node phục vụ:
+    OLLAMA_BACKENDS="http://gpu1:11434=gemma2:9b,llava:7b http://gpu2:11434=gemma2:9b"
+Node không ghi model thì phục vụ mọi model; không khai báo thì chỉ có một
+node là OLLAMA_HOST (giống trước đây).
+
+- Chọn node: ít request đang chạy nhất ('least_outstanding') hoặc
+  EWMA latency x (số request đang chạy + 1) ('ewma')
+- Model trong prefer_loaded (VISION_MODEL) ưu tiên node đang nạp sẵn model đó
+  (theo /api/ps), tránh phải swap model mất hàng chục giây
+- Request có affinity (id phiên hội thoại) luôn về cùng một node khoẻ
+  (rendezvous hashing) để dùng lại prompt cache của node đó
+- Node lỗi kết nối bị loại ngay và request chuyển sang node khác; prober nền
+  gọi /api/tags định kỳ để loại node chết và nhận lại node đã hồi phục.
+  Node không có model trong /api/tags (chưa pull) không nhận request model đó.
+  /health đọc kết quả probe gần nhất (probe_age cho biết dữ liệu cũ bao lâu);
+  refresh_if_stale() probe lại ở thread nền, không bắt request chờ Ollama.
+"""
+from ollama_client import OllamaClient, AsyncOllamaClient, DEFAULT_MAX_RETRIES, connect_failed, httpx
+import requests
+import threading
+import logging
+import zlib
+import time
+import re
+
+logger = logging.getLogger(__name__)
+
+EWMA_ALPHA = 0.3
+STRATEGIES = ('least_outstanding', 'ewma')
+
+def parse_backends(spec, default_host):
+    """'url[=model,model] url2 ...' -> list (host, set model hoặc None)"""
+    backends = []
+    for item in re.split(r'[\s;]+', spec or ''):
+        if not item:
+            continue
+        host, _, models = item.partition('=')
+        models = {model_name(m) for m in models.split(',') if m.strip()}
+        backends.append((host.rstrip('/'), models or None))
+    return backends or [(default_host.rstrip('/'), None)]
+
+def model_name(name):
+    """'llava' và 'llava:latest' là cùng một model"""
+    name = name.strip()
+    return name if ':' in name else f"{name}:latest"
+
+class Backend:
+    """Trạng thái một node Ollama: sức khoẻ, tải, model đã pull/đang nạp"""
+
+    def __init__(self, host, models=None):
+        self.host = host
+        self.models = models
+        self.healthy = True
+        self.outstanding = 0
+        self.ewma_latency = None
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+        self.available_models = None
+        self.loaded_models = set()
+        self.last_probe = None
+        self.last_error = None
+
+    def serves(self, model):
+        model = model_name(model)
+        if self.models is not None and model not in self.models:
+            return False
+        return self.available_models is None or model in self.available_models
+
+    def snapshot(self):
+        return {
+            'host': self.host,
+            'models': sorted(self.models) if self.models is not None else 'all',
+            'healthy': self.healthy,
+            'outstanding': self.outstanding,
+            'ewma_latency': round(self.ewma_latency, 3) if self.ewma_latency is not None else None,
+            'requests': self.requests,
+            'failures': self.failures,
+            'ejections': self.ejections,
+            'loaded_models': sorted(self.loaded_models),
+            'last_probe': self.last_probe,
+            'last_error': self.last_error
+        }
+
+class OllamaRouter:
+    """Router đồng bộ (Flask/Waitress); giữ trạng thái node và chạy prober nền"""
+
+    def __init__(self, backends, pool_size=8, strategy='least_outstanding', prefer_loaded=()):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown routing strategy: {strategy}")
+        self.strategy = strategy
+        self.prefer_loaded = {model_name(m) for m in prefer_loaded}
+        self.backends = [Backend(host, models) for host, models in backends]
+        self.clients = {
+            backend.host: OllamaClient(backend.host, pool_size=pool_size, max_retries=self.client_retries)
+            for backend in self.backends
+        }
+        self._lock = threading.Lock()
+        # Chỉ một lượt probe chạy tại một thời điểm (prober định kỳ hoặc refresh_if_stale)
+        self._probing = threading.Lock()
+        self.probed_at = None
+
+    @property
+    def client_retries(self):
+        """Nhiều node -> không retry trên node lỗi, chuyển ngay sang node khác"""
+        return DEFAULT_MAX_RETRIES if len(self.backends) == 1 else 0
+
+    @property
+    def host(self):
+        return self.backends[0].host
+
+    def capacity(self, model):
+        """Số node được khai báo phục vụ model"""
+        return sum(1 for b in self.backends if b.models is None or model_name(model) in b.models)
+
+    def acquire(self, model, exclude=(), affinity=None):
+        """Chọn node cho model và tăng outstanding; None nếu không còn node nào"""
+        with self._lock:
+            serving = [b for b in self.backends if b not in exclude and b.serves(model)]
+            # Không còn node khoẻ -> vẫn thử node đã bị loại (có thể đã hồi phục)
+            candidates = [b for b in serving if b.healthy] or serving
+            if model_name(model) in self.prefer_loaded:
+                candidates = [b for b in candidates if model_name(model) in b.loaded_models] or candidates
+            if not candidates:
+                return None
+            if affinity is not None:
+                backend = max(candidates, key=lambda b: zlib.crc32(f"{affinity}|{b.host}".encode()))
+            else:
+                backend = min(candidates, key=self._load_key)
+            backend.outstanding += 1
+            return backend
+
+    def _load_key(self, backend):
+        ewma = backend.ewma_latency or 0.0
+        if self.strategy == 'ewma':
+            return ((backend.outstanding + 1) * ewma, backend.outstanding)
+        return (backend.outstanding, ewma)
+
+    def release(self, backend, model, latency, ok):
+        with self._lock:
+            backend.outstanding -= 1
+            backend.requests += 1
+            if ok:
+                if backend.ewma_latency is None:
+                    backend.ewma_latency = latency
+                else:
+                    backend.ewma_latency += EWMA_ALPHA * (latency - backend.ewma_latency)
+                # Ollama giữ model trong RAM/VRAM sau khi chạy (keep_alive)
+                backend.loaded_models.add(model_name(model))
+
+    def mark_failed(self, backend, error):
+        with self._lock:
+            backend.failures += 1
+            backend.last_error = str(error)
+            if backend.healthy:
+                backend.healthy = False
+                backend.ejections += 1
+                logger.warning("Ollama backend %s ejected: %s", backend.host, error)
+
+    def _send(self, payload, timeout, stream, affinity=None):
+        model = payload.get('model', '')
+        tried, last_error = [], None
+        while True:
+            backend = self.acquire(model, tried, affinity)
+            if backend is None:
+                raise last_error or requests.exceptions.ConnectionError(
+                    f"No Ollama backend serves {model}")
+            start = time.perf_counter()
+            try:
+                response = self.clients[backend.host].generate(payload, timeout=timeout, stream=stream)
+            except requests.exceptions.ConnectionError as e:
+                self.release(backend, model, time.perf_counter() - start, False)
+                self.mark_failed(backend, e)
+                # Body đã tới node (kết nối đứt giữa chừng) -> không gửi lại sang node khác
+                if not connect_failed(e):
+                    raise
+                tried.append(backend)
+                last_error = e
+                continue
+            except Exception:
+                self.release(backend, model, time.perf_counter() - start, False)
+                raise
+            return backend, response, start
+
+    def generate(self, payload, timeout, affinity=None):
+        """POST /api/generate (không stream) trên node được chọn"""
+        backend, response, start = self._send(payload, timeout, stream=False, affinity=affinity)
+        self.release(backend, payload.get('model', ''), time.perf_counter() - start,
+                     response.status_code == 200)
+        return response
+
+    def open_stream(self, payload, timeout, affinity=None):
+        """Mở luồng /api/generate; trả về (response, release) - gọi release() khi luồng kết thúc"""
+        backend, response, start = self._send({**payload, 'stream': True}, timeout, stream=True,
+                                              affinity=affinity)
+        released = threading.Event()
+
+        def release():
+            if not released.is_set():
+                released.set()
+                self.release(backend, payload.get('model', ''), time.perf_counter() - start,
+                             response.status_code == 200)
+        return response, release
+
+    def probe(self, timeout=5):
+        """Gọi /api/tags + /api/ps trên mọi node, loại/nhận lại node. Trả về số node khoẻ"""
+        for backend in self.backends:
+            client = self.clients[backend.host]
+            try:
+                response = client.tags(timeout=timeout)
+                response.raise_for_status()
+                available = {model_name(m['name']) for m in response.json().get('models', [])}
+                loaded = None
+                try:
+                    ps = client.ps(timeout=timeout)
+                    if ps.status_code == 200:
+                        loaded = {model_name(m['name']) for m in ps.json().get('models', [])}
+                except requests.exceptions.RequestException:
+                    pass
+                self._probe_ok(backend, available, loaded)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                with self._lock:
+                    backend.last_probe = time.time()
+                self.mark_failed(backend, e)
+        self.probed_at = time.time()
+        return sum(1 for b in self.backends if b.healthy)
+
+    def probe_age(self):
+        """Số giây từ lượt probe gần nhất (None nếu chưa probe lần nào)"""
+        return None if self.probed_at is None else time.time() - self.probed_at
+
+    def refresh_if_stale(self, max_age):
+        """Kết quả probe cũ hơn max_age giây -> probe lại ở thread nền, không chờ"""
+        age = self.probe_age()
+        if (age is None or age > max_age) and self._probing.acquire(blocking=False):
+            def run():
+                try:
+                    self.probe()
+                except Exception as e:
+                    logger.error("Ollama probe failed: %s", e)
+                finally:
+                    self._probing.release()
+            threading.Thread(target=run, name='ollama-probe', daemon=True).start()
+        return age
+
+    def _probe_ok(self, backend, available, loaded):
+        with self._lock:
+            backend.last_probe = time.time()
+            backend.available_models = available
+            if loaded is not None:
+                backend.loaded_models = loaded
+            if not backend.healthy:
+                backend.healthy = True
+                backend.last_error = None
+                logger.info("Ollama backend %s recovered", backend.host)
+
+    def start_probing(self, interval):
+        """Thread nền gọi probe() ngay và sau mỗi `interval` giây"""
+        def loop():
+            while True:
+                try:
+                    with self._probing:
+                        self.probe()
+                except Exception as e:
+                    logger.error("Ollama probe failed: %s", e)
+                time.sleep(interval)
+
+        thread = threading.Thread(target=loop, name='ollama-prober', daemon=True)
+        thread.start()
+        return thread
+
+    def available_models(self):
+        """Các model đã pull trên những node đang khoẻ"""
+        with self._lock:
+            models = set()
+            for backend in self.backends:
+                if backend.healthy and backend.available_models:
+                    models |= backend.available_models
+            return sorted(models)
+
+    def has_model(self, model):
+        """Model đã pull trên ít nhất một node khoẻ (so đúng tên, 'llava' = 'llava:latest')"""
+        return model_name(model) in self.available_models()
+
+    def status(self):
+        """'running' (mọi node khoẻ) / 'degraded' / 'not running'"""
+        healthy = sum(1 for b in self.backends if b.healthy)
+        if healthy == len(self.backends):
+            return 'running'
+        return 'degraded' if healthy else 'not running'
+
+    def stats(self, clients=None):
+        clients = clients or self.clients
+        with self._lock:
+            backends = [
+                {**backend.snapshot(), 'client': clients[backend.host].stats()}
+                for backend in self.backends
+            ]
+        return {
+            'strategy': self.strategy,
+            'prefer_loaded': sorted(self.prefer_loaded),
+            'backends': backends
+        }
+
+class AsyncOllamaRouter:
+    """
+    Bản asyncio (asgi_app.py): dùng chung trạng thái node và prober với một
+    OllamaRouter, chỉ thay client bằng httpx.AsyncClient.
+    """
+
+    def __init__(self, router, max_connections=256):
+        self.router = router
+        self.clients = {
+            backend.host: AsyncOllamaClient(backend.host, max_connections=max_connections,
+                                            max_retries=router.client_retries)
+            for backend in router.backends
+        }
+
+    async def _send(self, payload, timeout, stream, affinity=None):
+        router = self.router
+        model = payload.get('model', '')
+        tried, last_error = [], None
+        while True:
+            backend = router.acquire(model, tried, affinity)
+            if backend is None:
+                raise last_error or httpx.ConnectError(f"No Ollama backend serves {model}")
+            start = time.perf_counter()
+            try:
+                response = await self.clients[backend.host].generate(payload, timeout=timeout, stream=stream)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError) as e:
+                router.release(backend, model, time.perf_counter() - start, False)
+                router.mark_failed(backend, e)
+                if isinstance(e, httpx.RemoteProtocolError):
+                    raise
+                tried.append(backend)
+                last_error = e
+                continue
+            except BaseException:
+                router.release(backend, model, time.perf_counter() - start, False)
+                raise
+            return backend, response, start
+
+    async def generate(self, payload, timeout, affinity=None):
+        backend, response, start = await self._send(payload, timeout, stream=False, affinity=affinity)
+        self.router.release(backend, payload.get('model', ''), time.perf_counter() - start,
+                            response.status_code == 200)
+        return response
+
+    async def open_stream(self, payload, timeout, affinity=None):
+        backend, response, start = await self._send({**payload, 'stream': True}, timeout, stream=True,
+                                                     affinity=affinity)
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                self.router.release(backend, payload.get('model', ''), time.perf_counter() - start,
+                                    response.status_code == 200)
+        return response, release
+
+    def stats(self):
+        return self.router.stats(self.clients)
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.close()
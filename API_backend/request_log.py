@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Log có cấu trúc: mỗi request chat đúng một bản ghi, ghi qua queue không chặn.
+
+- configure(): handler của root logger là QueueHandler -> thread xử lý request chỉ
+  put_nowait() record vào queue; QueueListener format và ghi ra stderr trong thread
+  riêng. Queue đầy thì bỏ record (đếm dropped) chứ không chặn request
+- LOG_FORMAT=json: mỗi record một dòng JSON (ts, level, logger, msg + các field);
+  text: định dạng cũ của basicConfig
+- RequestLog.record(timer, status) khi request kết thúc: request_id, endpoint, mode,
+  language, status, duration_ms, stages_ms và các field gắn bằng metrics.note()
+  (kích thước request/response/ảnh, số token, cache...). Request thành công được
+  lấy mẫu theo sample_rate; lỗi (status >= 400 hoặc stream báo lỗi) và request chậm
+  (>= slow_seconds) luôn được ghi
+- Format lười: record bị lọc theo level / lấy mẫu không tạo dict, không format gì
+"""
+from datetime import datetime, timezone
+import logging.handlers
+import logging
+import random
+import threading
+import atexit
+import queue
+import json
+import time
+import uuid
+import re
+
+TEXT_FORMAT = '%(levelname)s:%(name)s:%(message)s'
+
+_listener = None
+
+# X-Request-ID của client / proxy được dùng lại nếu hợp lệ
+_REQUEST_ID = re.compile(r'[A-Za-z0-9._:-]{1,64}')
+
+def request_id(header=None):
+    """Request id: X-Request-ID hợp lệ của client, nếu không thì sinh mới"""
+    if header and _REQUEST_ID.fullmatch(header):
+        return header
+    return uuid.uuid4().hex
+
+class JsonFormatter(logging.Formatter):
+    """Một dòng JSON cho mỗi record; field trong extra={'fields': {...}} nằm ở mức trên cùng"""
+
+    def format(self, record):
+        data = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            data.update(fields)
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Không chặn: queue đầy -> bỏ record; không format ở thread gọi log"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Cùng process -> không cần pickle; getMessage() chạy ở thread của listener
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def configure(level='INFO', log_format='text', queue_size=10000):
+    """Thay handler của root logger bằng QueueHandler + listener ghi stderr; trả về QueueHandler"""
+    global _listener
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter() if log_format == 'json' else logging.Formatter(TEXT_FORMAT))
+    log_queue = queue.Queue(queue_size)
+    handler = QueueHandler(log_queue)
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+
+    stop()
+    _listener = logging.handlers.QueueListener(log_queue, output)
+    _listener.start()
+    # Ghi nốt các record còn trong queue khi thoát
+    atexit.register(stop)
+    return handler
+
+def stop():
+    """Dừng listener sau khi ghi hết queue (gọi nhiều lần không sao)"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+class RequestLog:
+    """Bản ghi một dòng cho mỗi request chat, lấy mẫu request thành công"""
+
+    def __init__(self, logger, sample_rate=1.0, slow_seconds=10.0, handler=None, log_format='text'):
+        self.logger = logger
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.handler = handler
+        self.log_format = log_format
+        self._lock = threading.Lock()
+        self.logged = 0
+        self.sampled_out = 0
+
+    def record(self, timer, status):
+        """Ghi bản ghi của request vừa kết thúc (timer: metrics.RequestTimer)"""
+        duration = time.perf_counter() - timer.start
+        error = status >= 400 or 'error' in timer.fields
+        slow = duration >= self.slow_seconds
+        level = logging.WARNING if error or slow else logging.INFO
+        if not self.logger.isEnabledFor(level):
+            return
+        if level == logging.INFO and (self.sample_rate <= 0 or random.random() >= self.sample_rate):
+            with self._lock:
+                self.sampled_out += 1
+            return
+        with self._lock:
+            self.logged += 1
+
+        fields = {
+            'request_id': timer.fields.get('request_id'),
+            'endpoint': timer.endpoint,
+            'mode': timer.labels.get('mode'),
+            'language': timer.labels.get('language'),
+            'status': status,
+            'duration_ms': round(duration * 1000, 1),
+            'stages_ms': {stage: round(seconds * 1000, 1) for stage, seconds in timer.stages.items()},
+            **{key: value for key, value in timer.fields.items() if key != 'request_id'}
+        }
+        if slow:
+            fields['slow'] = True
+        self.logger.log(level, '%s %s %s %.0fms', fields['request_id'], timer.endpoint, status,
+                        fields['duration_ms'], extra={'fields': fields})
+
+    def stats(self):
+        return {
+            'format': self.log_format,
+            'level': logging.getLevelName(logging.getLogger().getEffectiveLevel()),
+            'sample_rate': self.sample_rate,
+            'slow_seconds': self.slow_seconds,
+            'logged': self.logged,
+            'sampled_out': self.sampled_out,
+            'dropped': self.handler.dropped if self.handler else 0
+        }
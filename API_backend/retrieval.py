@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+"""
+Tìm kiếm cục bộ (BM25) trên kho tài liệu lịch sử: chương SGK, bài giảng...
+
+Thay cho việc gọi Google trong từng request: trả về top-k đoạn văn trong vài
+ms và đưa nội dung thật vào {search_context} của system prompt.
+
+- Tách từ: âm tiết tiếng Việt (chữ thường, bỏ dấu, đ -> d) + bigram âm tiết
+  liền kề ("dien_bien", "bien_phu"), nên câu hỏi gõ không dấu vẫn khớp và cụm
+  từ nhiều âm tiết được ưu tiên
+- Chỉ mục build offline bằng build_index.py thành một thư mục "generation";
+  file CURRENT trỏ tới bản mới nhất. Server mmap các file nhị phân nên khởi
+  động nhanh và nhiều process dùng chung page cache
+- Refresh tăng dần không cần restart: nạp generation mới nếu có, rồi đánh chỉ
+  mục các file corpus mới/sửa vào segment delta trong RAM (file sửa/xoá được
+  đánh dấu xoá ở segment cũ). Chạy lại build_index.py để gộp lại.
+
+Cấu trúc một generation (số nguyên theo byte order của máy build):
+    manifest.json   số đoạn, tổng độ dài, danh sách file (mtime, size, đoạn)
+    vocab.json      term -> [offset, df] trong postings.bin
+    postings.bin    uint32 xen kẽ (passage_id, tf), sắp theo passage_id
+    lengths.bin     uint32 độ dài (số token) từng đoạn
+    records.bin     JSON (source, title, text) từng đoạn, nối liền
+    offsets.bin     uint64 vị trí đầu/cuối của từng record
+"""
+from array import array
+import unicodedata
+import threading
+import logging
+import shutil
+import importlib.util
+import heapq
+import mmap
+import json
+import math
+import time
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+PASSAGE_WORDS = 120
+PASSAGE_OVERLAP = 30
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# pypdf chỉ được import khi đọc file .pdf (build / refresh chỉ mục), không làm chậm khởi động server
+CORPUS_EXTENSIONS = {'.txt', '.md'} | ({'.pdf'} if importlib.util.find_spec('pypdf') else set())
+
+_TOKEN_RE = re.compile(r'\w+')
+_COMBINING_RE = re.compile('[\u0300-\u036f]')
+_PARAGRAPH_RE = re.compile(r'\n\s*\n')
+_FOLD_TABLE = str.maketrans({'đ': 'd', 'Đ': 'D'})
+
+def fold_diacritics(text):
+    """Bỏ dấu tiếng Việt: 'Điện Biên Phủ' -> 'Dien Bien Phu'"""
+    return _COMBINING_RE.sub('', unicodedata.normalize('NFD', text.translate(_FOLD_TABLE)))
+
+def tokenize(text):
+    """Âm tiết đã bỏ dấu + bigram âm tiết liền kề"""
+    syllables = _TOKEN_RE.findall(fold_diacritics(text.lower()))
+    return syllables + [f"{a}_{b}" for a, b in zip(syllables, syllables[1:])]
+
+def split_passages(text, max_words=PASSAGE_WORDS, overlap=PASSAGE_OVERLAP):
+    """Gộp các đoạn văn ngắn tới max_words từ; đoạn dài được cắt cửa sổ trượt có chồng lấn"""
+    passages, current = [], []
+    for paragraph in _PARAGRAPH_RE.split(text):
+        words = paragraph.split()
+        if not words:
+            continue
+        if current and len(current) + len(words) > max_words:
+            passages.append(' '.join(current))
+            current = []
+        if len(words) > max_words:
+            step = max_words - overlap
+            for i in range(0, len(words) - overlap, step):
+                passages.append(' '.join(words[i:i + max_words]))
+            continue
+        current.extend(words)
+    if current:
+        passages.append(' '.join(current))
+    return passages
+
+def read_document(path):
+    """Đọc một tài liệu -> (title, text). Title là dòng '# ...' đầu tiên hoặc tên file"""
+    if path.lower().endswith('.pdf'):
+        from pypdf import PdfReader
+        text = '\n\n'.join(page.extract_text() or '' for page in PdfReader(path).pages)
+    else:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            text = f.read()
+
+    title = os.path.splitext(os.path.basename(path))[0].replace('_', ' ')
+    first_line, _, rest = text.lstrip().partition('\n')
+    if first_line.startswith('#'):
+        title, text = first_line.lstrip('#').strip(), rest
+    return title, text
+
+def iter_corpus(corpus_dir):
+    """(relpath, path, stat) của các tài liệu trong corpus, theo thứ tự ổn định"""
+    for root, dirs, files in os.walk(corpus_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() not in CORPUS_EXTENSIONS:
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            yield os.path.relpath(path, corpus_dir).replace(os.sep, '/'), path, st
+
+def prepare_document(relpath, path):
+    """Đọc + cắt đoạn + tách từ (chạy ngoài lock). Trả về list (record, tokens)"""
+    title, text = read_document(path)
+    return [
+        ({'source': relpath, 'title': title, 'text': passage}, tokenize(f"{title} {passage}"))
+        for passage in split_passages(text)
+    ]
+
+class _MemorySegment:
+    """Segment trong RAM: dùng khi build và làm segment delta lúc refresh"""
+
+    def __init__(self, first_id=0):
+        self.first_id = first_id
+        self.postings = {}
+        self.lengths = array('I')
+        self.records = []
+
+    @property
+    def size(self):
+        return len(self.lengths)
+
+    def add(self, record, tokens):
+        pid = self.first_id + len(self.lengths)
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, tf in counts.items():
+            self.postings.setdefault(token, array('I')).extend((pid, tf))
+        self.lengths.append(len(tokens))
+        self.records.append(record)
+        return pid
+
+    def postings_for(self, term):
+        return self.postings.get(term, ())
+
+    def record(self, pid):
+        return self.records[pid - self.first_id]
+
+class _MappedSegment:
+    """Segment chỉ đọc từ một generation đã build, các file nhị phân được mmap"""
+
+    first_id = 0
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'manifest.json'), encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        if self.manifest.get('version') != INDEX_VERSION:
+            raise ValueError(f"Unsupported index version: {self.manifest.get('version')}")
+        with open(os.path.join(path, 'vocab.json'), encoding='utf-8') as f:
+            self.vocab = json.load(f)
+        self._postings = self._map(path, 'postings.bin', 'I')
+        self.lengths = self._map(path, 'lengths.bin', 'I')
+        self._offsets = self._map(path, 'offsets.bin', 'Q')
+        self._records = self._map(path, 'records.bin')
+
+    @staticmethod
+    def _map(path, name, fmt=None):
+        with open(os.path.join(path, name), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                view = memoryview(b'')
+            else:
+                view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        return view.cast(fmt) if fmt else view
+
+    @property
+    def size(self):
+        return len(self.lengths)
+
+    def postings_for(self, term):
+        entry = self.vocab.get(term)
+        if entry is None:
+            return ()
+        offset, df = entry
+        return self._postings[offset:offset + 2 * df]
+
+    def record(self, pid):
+        return json.loads(bytes(self._records[self._offsets[pid]:self._offsets[pid + 1]]))
+
+def write_generation(segment, files, index_dir, keep=2):
+    """Ghi segment thành một generation mới, đổi CURRENT (nguyên tử), xoá các bản cũ"""
+    generation = time.strftime('%Y%m%d-%H%M%S') + f"-{time.time_ns() % 1_000_000:06d}"
+    path = os.path.join(index_dir, generation)
+    os.makedirs(path)
+
+    vocab, postings = {}, array('I')
+    for term in sorted(segment.postings):
+        term_postings = segment.postings[term]
+        vocab[term] = [len(postings), len(term_postings) // 2]
+        postings.extend(term_postings)
+
+    offsets, records = array('Q', [0]), bytearray()
+    for record in segment.records:
+        records += json.dumps(record, ensure_ascii=False).encode('utf-8')
+        offsets.append(len(records))
+
+    with open(os.path.join(path, 'postings.bin'), 'wb') as f:
+        postings.tofile(f)
+    with open(os.path.join(path, 'lengths.bin'), 'wb') as f:
+        segment.lengths.tofile(f)
+    with open(os.path.join(path, 'offsets.bin'), 'wb') as f:
+        offsets.tofile(f)
+    with open(os.path.join(path, 'records.bin'), 'wb') as f:
+        f.write(records)
+    with open(os.path.join(path, 'vocab.json'), 'w', encoding='utf-8') as f:
+        json.dump(vocab, f, ensure_ascii=False, separators=(',', ':'))
+    with open(os.path.join(path, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump({
+            'version': INDEX_VERSION,
+            'generation': generation,
+            'passages': segment.size,
+            'total_length': sum(segment.lengths),
+            'terms': len(vocab),
+            'files': files
+        }, f, ensure_ascii=False, indent=1)
+
+    current = os.path.join(index_dir, 'CURRENT')
+    with open(current + '.tmp', 'w') as f:
+        f.write(generation)
+    os.replace(current + '.tmp', current)
+
+    # Process đang chạy có thể vẫn mmap bản cũ -> giữ lại `keep` bản gần nhất
+    generations = sorted(name for name in os.listdir(index_dir)
+                         if os.path.isdir(os.path.join(index_dir, name)))
+    for old in generations[:-keep]:
+        shutil.rmtree(os.path.join(index_dir, old), ignore_errors=True)
+    return generation
+
+def build_index(corpus_dir, index_dir, keep=2):
+    """Build toàn bộ chỉ mục từ corpus_dir. Trả về (generation, số file, số đoạn)"""
+    segment, files = _MemorySegment(), {}
+    for relpath, path, st in iter_corpus(corpus_dir):
+        try:
+            prepared = prepare_document(relpath, path)
+        except (OSError, ValueError) as e:
+            logger.error("Cannot index %s: %s", relpath, e)
+            continue
+        first = segment.size
+        for record, tokens in prepared:
+            segment.add(record, tokens)
+        files[relpath] = {'mtime_ns': st.st_mtime_ns, 'size': st.st_size,
+                          'first': first, 'count': len(prepared)}
+    os.makedirs(index_dir, exist_ok=True)
+    generation = write_generation(segment, files, index_dir, keep=keep)
+    return generation, len(files), segment.size
+
+def read_current(index_dir):
+    try:
+        with open(os.path.join(index_dir, 'CURRENT')) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+class Retriever:
+    """BM25 trên generation đã build (mmap) + segment delta trong RAM, thread-safe"""
+
+    def __init__(self, index_dir, corpus_dir=None, k1=BM25_K1, b=BM25_B, min_score=0.0):
+        self.index_dir = index_dir
+        self.corpus_dir = corpus_dir
+        self.k1 = k1
+        self.b = b
+        self.min_score = min_score
+
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self.generation = None
+        self._base = None
+        self._delta = _MemorySegment()
+        self._deleted = set()
+        self._files = {}
+        self._live_count = 0
+        self._live_length = 0
+
+        self.searches = 0
+        self.total_search_time = 0.0
+        self.last_refresh = None
+        self.load()
+
+    def load(self):
+        """Nạp generation mới nhất nếu khác bản đang dùng; trả về True nếu đã đổi"""
+        generation = read_current(self.index_dir)
+        if generation is None or generation == self.generation:
+            return False
+        try:
+            base = _MappedSegment(os.path.join(self.index_dir, generation))
+        except (OSError, ValueError) as e:
+            logger.error("Cannot load retrieval index %s: %s", generation, e)
+            return False
+
+        with self._lock:
+            self._base = base
+            self.generation = generation
+            self._delta = _MemorySegment(base.size)
+            self._deleted = set()
+            self._files = {relpath: dict(info) for relpath, info in base.manifest['files'].items()}
+            self._live_count = base.size
+            self._live_length = base.manifest['total_length']
+        logger.info("Retrieval index loaded: %s (%d passages, %d terms)",
+                    generation, base.size, len(base.vocab))
+        return True
+
+    def refresh(self):
+        """
+        Nạp generation mới (nếu build_index.py vừa chạy) rồi đánh chỉ mục tăng dần
+        các file corpus mới/sửa/xoá. Trả về True nếu nội dung chỉ mục thay đổi.
+        """
+        with self._refresh_lock:
+            changed = self.load()
+            if self.corpus_dir and os.path.isdir(self.corpus_dir):
+                seen = set()
+                for relpath, path, st in iter_corpus(self.corpus_dir):
+                    seen.add(relpath)
+                    info = self._files.get(relpath)
+                    if info and info['mtime_ns'] == st.st_mtime_ns and info['size'] == st.st_size:
+                        continue
+                    try:
+                        prepared = prepare_document(relpath, path)
+                    except (OSError, ValueError) as e:
+                        logger.error("Cannot index %s: %s", relpath, e)
+                        continue
+                    with self._lock:
+                        self._drop(relpath)
+                        first = self._delta.first_id + self._delta.size
+                        for record, tokens in prepared:
+                            self._delta.add(record, tokens)
+                            self._live_count += 1
+                            self._live_length += len(tokens)
+                        self._files[relpath] = {'mtime_ns': st.st_mtime_ns, 'size': st.st_size,
+                                                'first': first, 'count': len(prepared)}
+                    logger.info("Indexed %s (%d passages)", relpath, len(prepared))
+                    changed = True
+
+                for relpath in set(self._files) - seen:
+                    with self._lock:
+                        self._drop(relpath)
+                        del self._files[relpath]
+                    logger.info("Removed %s from retrieval index", relpath)
+                    changed = True
+
+            self.last_refresh = time.time()
+            return changed
+
+    def _drop(self, relpath):
+        info = self._files.get(relpath)
+        if info is None:
+            return
+        for pid in range(info['first'], info['first'] + info['count']):
+            if pid not in self._deleted:
+                segment = self._segment(pid)
+                self._deleted.add(pid)
+                self._live_count -= 1
+                self._live_length -= segment.lengths[pid - segment.first_id]
+
+    def _segment(self, pid):
+        return self._delta if pid >= self._delta.first_id else self._base
+
+    def start_auto_refresh(self, interval, on_change=None):
+        """Thread nền gọi refresh() ngay và sau mỗi `interval` giây; on_change() khi chỉ mục đổi"""
+        def loop():
+            while True:
+                try:
+                    if self.refresh() and on_change:
+                        on_change()
+                except Exception as e:
+                    logger.error("Retrieval index refresh failed: %s", e)
+                time.sleep(interval)
+
+        thread = threading.Thread(target=loop, name='retrieval-refresh', daemon=True)
+        thread.start()
+        return thread
+
+    def search(self, query, top_k=3):
+        """Top-k đoạn văn theo BM25: list dict (source, title, text, score)"""
+        start = time.perf_counter()
+        terms = set(tokenize(query))
+        k1, b = self.k1, self.b
+
+        with self._lock:
+            n = self._live_count
+            if not n or not terms:
+                return []
+            avgdl = self._live_length / n
+            segments = [s for s in (self._base, self._delta) if s is not None and s.size]
+
+            scores = {}
+            for term in terms:
+                term_postings = [(s, s.postings_for(term)) for s in segments]
+                df = sum(len(p) // 2 for _, p in term_postings)
+                if not df:
+                    continue
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                for segment, postings in term_postings:
+                    lengths, first = segment.lengths, segment.first_id
+                    for pid, tf in zip(postings[::2], postings[1::2]):
+                        norm = k1 * (1 - b + b * lengths[pid - first] / avgdl)
+                        scores[pid] = scores.get(pid, 0.0) + idf * tf * (k1 + 1) / (tf + norm)
+
+            best = heapq.nlargest(top_k, (
+                (score, pid) for pid, score in scores.items()
+                if score >= self.min_score and pid not in self._deleted
+            ))
+            results = [{**self._segment(pid).record(pid), 'score': round(score, 3)}
+                       for score, pid in best]
+
+            self.searches += 1
+            self.total_search_time += time.perf_counter() - start
+        return results
+
+    def stats(self):
+        with self._lock:
+            return {
+                'generation': self.generation,
+                'passages': self._live_count,
+                'files': len(self._files),
+                'delta_passages': self._delta.size,
+                'deleted_passages': len(self._deleted),
+                'searches': self.searches,
+                'avg_search_ms': round(self.total_search_time / self.searches * 1000, 2) if self.searches else 0.0,
+                'last_refresh': self.last_refresh
+            }
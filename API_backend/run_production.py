@@ -1,27 +1,93 @@
-
-from waitress import serve
-from app import app
+import argparse
+import logging
+import signal
 import socket
+import os
+
+# Worker nhận SIGTERM (reload / dừng) -> chờ request đang chạy tối đa bấy nhiêu giây
+GRACEFUL_TIMEOUT = float(os.environ.get('GRACEFUL_TIMEOUT', '60'))
+
+def local_ip():
+    """IP mạng LAN của máy để in ra; UDP connect chỉ chọn route, không gửi gói nào, không tra DNS"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        try:
+            probe.connect(('10.255.255.255', 1))
+            return probe.getsockname()[0]
+        except OSError:
+            return '127.0.0.1'
+
+def serve_production(host='0.0.0.0', port=5000):
+    """Chạy app bằng Waitress với cấu hình production (dùng chung với benchmark.py)"""
+    from waitress import serve
+    from app import app, SERVER_THREADS
+    serve(
+        app,
+        host=host,
+        port=port,
+        threads=SERVER_THREADS,
+        connection_limit=1000,
+        channel_timeout=120,
+        cleanup_interval=30,
+        url_scheme='http'
+    )
+
+def serve_worker(sock, index, notify_ready):
+    """Một worker của Supervisor: Waitress trên socket kế thừa, dừng êm khi nhận SIGTERM"""
+    from waitress import create_server
+    from workers import ActiveRequests, drain_on_sigterm
+    from app import app, SERVER_THREADS
+    import request_log
+
+    active = ActiveRequests(app)
+    server = create_server(
+        active,
+        sockets=[sock],
+        threads=SERVER_THREADS,
+        connection_limit=1000,
+        channel_timeout=120,
+        cleanup_interval=30,
+        url_scheme='http'
+    )
+
+    # Hết request đang chạy -> SIGUSR1 -> SystemExit trong vòng lặp của Waitress
+    def exit_loop(signum, frame):
+        raise SystemExit
+    signal.signal(signal.SIGUSR1, exit_loop)
+    drain_on_sigterm(lambda: setattr(server, 'accepting', False), active, GRACEFUL_TIMEOUT,
+                     lambda: os.kill(os.getpid(), signal.SIGUSR1))
+
+    notify_ready()
+    server.run()
+    request_log.stop()
+
+def serve_workers(host='0.0.0.0', port=5000, workers=2):
+    """Supervisor + `workers` process Waitress, cache / session / giới hạn Ollama dùng chung"""
+    from workers import Supervisor
+    # Trước khi fork: mọi worker thấy cùng thư mục state dùng chung
+    os.environ.setdefault('SHARED_STATE_DIR', os.path.join('/tmp', f'history-chat-{port}'))
+    logging.basicConfig(level=logging.INFO)
+    Supervisor(serve_worker, workers, host, port, graceful_timeout=GRACEFUL_TIMEOUT).run()
 
 if __name__ == '__main__':
-    hostname = socket.gethostname()
-    local_ip = socket.gethostbyname(hostname)    
+    parser = argparse.ArgumentParser(description="AI Chat API Server (production)")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', '5000')))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_WORKERS', '1')),
+                        help="Số worker process (0 = số CPU); 1 = một process như trước")
+    args = parser.parse_args()
+    workers = args.workers or os.cpu_count() or 1
+
     print("\n" + "="*60)
     print("AI Chat API Server (PRODUCTION MODE)")
     print("="*60)
-    print(f"Using Waitress WSGI Server (Production-ready)")
-    print(f"Local:  http://localhost:5000")
-    print(f"Network: http://{local_ip}:5000")
-    print(f"Multi-threaded: YES")
-    print(f"Connection handling: STABLE")
+    print("Using Waitress WSGI Server (Production-ready)")
+    print(f"Local:  http://localhost:{args.port}")
+    print(f"Network: http://{local_ip()}:{args.port}")
+    print("Multi-threaded: YES")
+    print(f"Worker processes: {workers}")
+    print("Connection handling: STABLE")
     print("="*60 + "\n")
-    serve(
-        app,
-        host='0.0.0.0',
-        port=5000,
-        threads=8,  
-        connection_limit=1000,  
-        channel_timeout=120,  
-        cleanup_interval=30, 
-        url_scheme='http'
-    )
+    if workers > 1:
+        serve_workers(args.host, args.port, workers)
+    else:
+        serve_production(args.host, args.port)
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Phiên hội thoại nhiều lượt giữ trạng thái ở server.
+
+- Mỗi lượt gửi kèm mảng `context` (token) Ollama trả về ở lượt trước: Ollama
+  chỉ đánh giá phần prompt mới, phần đầu đã có sẵn trong prompt cache của node
+- `context` vượt token_budget -> bỏ context, lượt sau dựng lại prompt từ các
+  lượt gần nhất vừa history_tokens (chỉ lượt đó phải đánh giá lại từ đầu)
+- Context lưu bằng array('i') (4 byte/token); phiên không dùng quá idle_ttl
+  giây bị xoá, vượt max_sessions / max_bytes thì xoá phiên ít dùng nhất
+- Mỗi phiên chỉ chạy một lượt tại một thời điểm (begin/finish)
+"""
+from collections import OrderedDict, deque
+from array import array
+import threading
+import secrets
+import time
+
+# Ước lượng số token của câu hỏi (ký tự / token) khi Ollama không trả về số chính xác
+CHARS_PER_TOKEN = 3
+
+def estimate_tokens(text):
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+class Session:
+    """Trạng thái một phiên: ngôn ngữ, context token của Ollama và các lượt gần nhất"""
+
+    __slots__ = ('id', 'language', 'context', 'turns', 'turn_count', 'created_at', 'last_used',
+                 'busy', 'nbytes')
+
+    def __init__(self, session_id, language):
+        self.id = session_id
+        self.language = language
+        self.context = None
+        self.turns = deque()
+        self.turn_count = 0
+        self.created_at = time.time()
+        self.last_used = time.monotonic()
+        self.busy = False
+        self.nbytes = 0
+
+    def history(self):
+        """Các lượt (câu hỏi, trả lời) còn giữ, cũ nhất trước"""
+        return [(message, reply) for message, reply, _ in self.turns]
+
+    def info(self):
+        return {
+            'session_id': self.id,
+            'language': self.language,
+            'turns': self.turn_count,
+            'context_tokens': len(self.context) if self.context is not None else 0
+        }
+
+class SessionStore:
+    """Kho phiên hội thoại trong bộ nhớ, LRU theo lần dùng cuối"""
+
+    def __init__(self, max_sessions=1000, max_bytes=64 * 1024 * 1024, idle_ttl=30 * 60,
+                 token_budget=1536, history_tokens=600):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.token_budget = token_budget
+        self.history_tokens = history_tokens
+
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self._bytes = 0
+
+        self.created = 0
+        self.ended = 0
+        self.expired = 0
+        self.evicted = 0
+        self.turns = 0
+        self.reused_turns = 0
+        self.rebuilds = 0
+        self.prompt_tokens = 0
+
+    def create(self, language=None):
+        session = Session(secrets.token_urlsafe(16), language)
+        with self._lock:
+            self._prune(time.monotonic())
+            self._sessions[session.id] = session
+            self.created += 1
+            self._enforce_limits()
+        return session
+
+    def get(self, session_id):
+        """Phiên còn sống (và đánh dấu vừa dùng), None nếu không có / đã hết hạn"""
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.last_used = now
+                self._sessions.move_to_end(session_id)
+            return session
+
+    def end(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session is None:
+                return False
+            self._bytes -= session.nbytes
+            self.ended += 1
+            return True
+
+    def begin(self, session):
+        """Giữ phiên cho một lượt; False nếu phiên đang có lượt khác chạy"""
+        with self._lock:
+            if session.busy:
+                return False
+            session.busy = True
+            return True
+
+    def finish(self, session):
+        with self._lock:
+            session.busy = False
+            session.last_used = time.monotonic()
+            if session.id in self._sessions:
+                self._sessions.move_to_end(session.id)
+
+    def context_for(self, session):
+        """
+        Context cho lượt tiếp theo (list token) hoặc None nếu phải dựng lại prompt
+        từ session.history(); context quá token_budget bị bỏ ở đây.
+        """
+        with self._lock:
+            if session.context is not None and len(session.context) > self.token_budget:
+                session.context = None
+                self.rebuilds += 1
+                self._resize(session)
+            return session.context.tolist() if session.context is not None else None
+
+    def record(self, session, message, reply, context=None, prompt_eval_count=None, eval_count=None):
+        """Ghi một lượt đã hoàn tất cùng context Ollama trả về"""
+        with self._lock:
+            previous = len(session.context) if session.context is not None else None
+            if context:
+                session.context = array('i', context)
+                tokens = len(context) - previous if previous is not None else None
+            else:
+                session.context = None
+                tokens = None
+            if tokens is None or tokens <= 0:
+                tokens = estimate_tokens(message) + (eval_count or estimate_tokens(reply))
+
+            session.turns.append((message, reply, tokens))
+            session.turn_count += 1
+            # Chỉ giữ các lượt gần nhất vừa history_tokens (luôn giữ lượt cuối)
+            while len(session.turns) > 1 and sum(t for _, _, t in session.turns) > self.history_tokens:
+                session.turns.popleft()
+
+            self.turns += 1
+            if previous is not None:
+                self.reused_turns += 1
+            self.prompt_tokens += prompt_eval_count or 0
+            if session.id in self._sessions:
+                self._resize(session)
+                self._enforce_limits()
+
+    def _resize(self, session):
+        nbytes = sum(len(m.encode('utf-8')) + len(r.encode('utf-8')) for m, r, _ in session.turns)
+        if session.context is not None:
+            nbytes += session.context.itemsize * len(session.context)
+        if session.id in self._sessions:
+            self._bytes += nbytes - session.nbytes
+        session.nbytes = nbytes
+
+    def _remove(self, session_id):
+        session = self._sessions.pop(session_id)
+        self._bytes -= session.nbytes
+
+    def _prune(self, now):
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if session.last_used >= now - self.idle_ttl or session.busy:
+                break
+            self._remove(session_id)
+            self.expired += 1
+
+    def _enforce_limits(self):
+        while self._sessions and (len(self._sessions) > self.max_sessions or self._bytes > self.max_bytes):
+            session_id = next(iter(self._sessions))
+            self._remove(session_id)
+            self.evicted += 1
+
+    def stats(self):
+        with self._lock:
+            self._prune(time.monotonic())
+            return {
+                'sessions': len(self._sessions),
+                'bytes': self._bytes,
+                'max_sessions': self.max_sessions,
+                'max_bytes': self.max_bytes,
+                'idle_ttl': self.idle_ttl,
+                'token_budget': self.token_budget,
+                'created': self.created,
+                'ended': self.ended,
+                'expired': self.expired,
+                'evicted': self.evicted,
+                'turns': self.turns,
+                'context_reuse_ratio': round(self.reused_turns / self.turns, 4) if self.turns else 0.0,
+                'rebuilds': self.rebuilds,
+                'avg_prompt_tokens': round(self.prompt_tokens / self.turns, 1) if self.turns else 0.0
+            }
@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""
+Trạng thái dùng chung giữa các worker process (run_production.py --workers N,
+hoặc uvicorn --workers N với cùng SHARED_STATE_DIR).
+
+- SharedStore: một file SQLite (WAL) trong SHARED_STATE_DIR, mỗi thread một
+  connection; lỗi SQLite chỉ được log, request vẫn chạy như không có cache
+- SharedAnswerCache: AnswerCache trong process (exact + gần giống) đứng trước
+  bảng answers dùng chung (chỉ khớp exact). Worker này trả lời rồi thì worker
+  khác hỏi cùng câu cũng trúng cache
+- SharedSessionStore: phiên /sessions lưu trong SQLite, lượt tiếp theo rơi vào
+  worker nào cũng tiếp tục được; "đang có lượt chạy" khoá bằng UPDATE nguyên tử
+- SharedSlots: tổng số lời gọi Ollama đồng thời của mọi worker cho một model.
+  Slot i là flock trên file <model>.<i>.lock: worker chết thì kernel tự nhả
+  khoá, không có slot bị kẹt
+"""
+from answer_cache import AnswerCache, normalize_message
+from sessions import SessionStore, Session
+from collections import deque
+from array import array
+import threading
+import logging
+import sqlite3
+import hashlib
+import asyncio
+import random
+import json
+import time
+import os
+import re
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: không có flock -> chỉ giới hạn trong từng process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Lượt của phiên giữ khoá lâu hơn thế này thì coi như worker đã chết giữa chừng
+SESSION_BUSY_TIMEOUT = 600
+# Số lần put giữa hai lần dọn bảng answers (hết hạn + vượt max_entries)
+PRUNE_EVERY = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS answers (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    written_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS answers_written ON answers (written_at);
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    language TEXT,
+    context BLOB,
+    turns TEXT NOT NULL,
+    turn_count INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL,
+    busy_since REAL
+);
+CREATE INDEX IF NOT EXISTS sessions_last_used ON sessions (last_used);
+"""
+
+class SharedStore:
+    """File SQLite dùng chung; connection riêng cho từng thread (mở lười, sau fork)"""
+
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self.errors = 0
+        with self.connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def execute(self, sql, params=(), fetch=None):
+        """Chạy một câu lệnh; fetch='one' / 'all' để đọc. Lỗi SQLite -> log, trả về None"""
+        try:
+            cursor = self.connection().execute(sql, params)
+            if fetch == 'one':
+                return cursor.fetchone()
+            if fetch == 'all':
+                return cursor.fetchall()
+            return cursor.rowcount
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.warning("Shared store error: %s", e)
+            return None
+
+def _answer_key(scope, norm):
+    return hashlib.sha256(json.dumps([*scope, norm], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+class SharedAnswerCache(AnswerCache):
+    """AnswerCache trong process + bảng answers trong SharedStore (khớp exact, TTL theo giờ thật)"""
+
+    def __init__(self, store, **kwargs):
+        super().__init__(**kwargs)
+        self.store = store
+        self.shared_hits = 0
+        self._puts = 0
+
+    def lookup(self, message, language, model, options=None):
+        value, match = super().lookup(message, language, model, options)
+        if value is not None:
+            return value, match
+        key = _answer_key(self._scope(language, model, options), normalize_message(message))
+        now = time.time()
+        row = self.store.execute('SELECT value, expires_at FROM answers WHERE key = ? AND expires_at > ?',
+                                 (key, now), fetch='one')
+        if row is None:
+            return None, None
+        value = json.loads(row[0])
+        # Chép về cache của process; lần sau trúng ngay trong bộ nhớ (cả khớp gần giống)
+        super().put(message, language, model, options, value, ttl=row[1] - now)
+        with self._lock:
+            self.misses -= 1
+            self.shared_hits += 1
+        return value, 'exact'
+
+    def put(self, message, language, model, options, value, ttl=None):
+        super().put(message, language, model, options, value, ttl)
+        key = _answer_key(self._scope(language, model, options), normalize_message(message))
+        now = time.time()
+        self.store.execute('INSERT OR REPLACE INTO answers (key, value, expires_at, written_at) VALUES (?, ?, ?, ?)',
+                           (key, json.dumps(value, ensure_ascii=False), now + (self.ttl if ttl is None else ttl), now))
+        with self._lock:
+            self._puts += 1
+            prune = self._puts % PRUNE_EVERY == 0
+        if prune:
+            self.store.execute('DELETE FROM answers WHERE expires_at <= ?', (now,))
+            self.store.execute('DELETE FROM answers WHERE key IN (SELECT key FROM answers '
+                               'ORDER BY written_at DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def clear(self):
+        super().clear()
+        self.store.execute('DELETE FROM answers')
+
+    def stats(self):
+        stats = super().stats()
+        with self._lock:
+            hits = self.hits + self.similar_hits + self.shared_hits
+            lookups = hits + self.misses
+            stats.update(shared_hits=self.shared_hits,
+                         hit_ratio=round(hits / lookups, 4) if lookups else 0.0)
+        row = self.store.execute('SELECT COUNT(*) FROM answers', fetch='one')
+        stats['shared_entries'] = row[0] if row else None
+        return stats
+
+class SharedSessionStore(SessionStore):
+    """
+    SessionStore với SQLite là nguồn chính: get() đọc lại phiên khi worker khác đã
+    ghi thêm lượt (so turn_count), record() ghi ngay, begin() khoá giữa các worker.
+    """
+
+    def __init__(self, store, **kwargs):
+        super().__init__(**kwargs)
+        self.store = store
+        self.loaded = 0
+
+    def create(self, language=None):
+        session = super().create(language)
+        now = time.time()
+        self.store.execute('DELETE FROM sessions WHERE last_used < ? AND busy_since IS NULL',
+                           (now - self.idle_ttl,))
+        self.store.execute('INSERT INTO sessions (id, language, context, turns, turn_count, created_at, last_used) '
+                           'VALUES (?, ?, NULL, ?, 0, ?, ?)',
+                           (session.id, language, '[]', session.created_at, now))
+        self.store.execute('DELETE FROM sessions WHERE id IN (SELECT id FROM sessions '
+                           'ORDER BY last_used DESC LIMIT -1 OFFSET ?)', (self.max_sessions,))
+        return session
+
+    def get(self, session_id):
+        row = self.store.execute('SELECT language, context, turns, turn_count, created_at FROM sessions '
+                                 'WHERE id = ? AND last_used >= ?',
+                                 (session_id, time.time() - self.idle_ttl), fetch='one')
+        if row is None:
+            return None
+        session = super().get(session_id)
+        if session is not None and session.turn_count == row[3]:
+            return session
+        return self._load(session_id, row)
+
+    def _load(self, session_id, row):
+        """Dựng lại Session từ hàng SQLite (phiên do worker khác tạo hoặc đã có lượt mới)"""
+        language, context, turns, turn_count, created_at = row
+        session = Session(session_id, language)
+        session.created_at = created_at
+        session.turn_count = turn_count
+        session.turns = deque(tuple(turn) for turn in json.loads(turns))
+        if context is not None:
+            session.context = array('i')
+            session.context.frombytes(context)
+        with self._lock:
+            if session_id in self._sessions:
+                self._remove(session_id)
+            self._sessions[session_id] = session
+            self._resize(session)
+            self._enforce_limits()
+            self.loaded += 1
+        return session
+
+    def end(self, session_id):
+        ended = super().end(session_id)
+        deleted = self.store.execute('DELETE FROM sessions WHERE id = ?', (session_id,))
+        return ended or bool(deleted)
+
+    def begin(self, session):
+        if not super().begin(session):
+            return False
+        now = time.time()
+        claimed = self.store.execute('UPDATE sessions SET busy_since = ? WHERE id = ? '
+                                     'AND (busy_since IS NULL OR busy_since < ?)',
+                                     (now, session.id, now - SESSION_BUSY_TIMEOUT))
+        if claimed == 0:
+            super().finish(session)
+            return False
+        return True
+
+    def finish(self, session):
+        super().finish(session)
+        self.store.execute('UPDATE sessions SET busy_since = NULL, last_used = ? WHERE id = ?',
+                           (time.time(), session.id))
+
+    def record(self, session, message, reply, context=None, prompt_eval_count=None, eval_count=None):
+        super().record(session, message, reply, context, prompt_eval_count, eval_count)
+        with self._lock:
+            blob = session.context.tobytes() if session.context is not None else None
+            turns = json.dumps(list(session.turns), ensure_ascii=False)
+            turn_count = session.turn_count
+        self.store.execute('UPDATE sessions SET language = ?, context = ?, turns = ?, turn_count = ?, last_used = ? '
+                           'WHERE id = ?', (session.language, blob, turns, turn_count, time.time(), session.id))
+
+    def stats(self):
+        stats = super().stats()
+        row = self.store.execute('SELECT COUNT(*) FROM sessions WHERE last_used >= ?',
+                                 (time.time() - self.idle_ttl,), fetch='one')
+        stats['shared_sessions'] = row[0] if row else None
+        stats['loaded_from_shared'] = self.loaded
+        return stats
+
+class SharedSlots:
+    """Semaphore liên process: tối đa `limit` slot cho mọi worker cộng lại, mỗi slot một file flock"""
+
+    # Thời gian chờ giữa hai lần thử khi mọi slot đều bận (tăng dần tới MAX)
+    POLL_INTERVAL = 0.005
+    MAX_POLL_INTERVAL = 0.05
+
+    def __init__(self, directory, name, limit):
+        if fcntl is None:
+            raise RuntimeError("Shared Ollama slots need fcntl.flock (Linux / macOS)")
+        safe = re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+        self.limit = limit
+        self.paths = [os.path.join(directory, f"{safe}.{i}.lock") for i in range(limit)]
+        self._lock = threading.Lock()
+        self._held = []
+        self.acquired = 0
+        self.contended = 0
+        self.timed_out = 0
+
+    def try_acquire(self):
+        """Chiếm một slot còn trống (không chờ); True nếu được"""
+        start = random.randrange(self.limit)
+        for i in range(self.limit):
+            fd = os.open(self.paths[(start + i) % self.limit], os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            with self._lock:
+                self._held.append(fd)
+                self.acquired += 1
+            return True
+        return False
+
+    def acquire(self, timeout):
+        """Chờ tối đa timeout giây; False nếu hết giờ"""
+        if self.try_acquire():
+            return True
+        deadline = time.monotonic() + timeout
+        interval = self.POLL_INTERVAL
+        with self._lock:
+            self.contended += 1
+        while time.monotonic() < deadline:
+            time.sleep(interval)
+            if self.try_acquire():
+                return True
+            interval = min(interval * 2, self.MAX_POLL_INTERVAL)
+        with self._lock:
+            self.timed_out += 1
+        return False
+
+    async def acquire_async(self, timeout):
+        """Như acquire() nhưng chờ bằng asyncio.sleep (không chặn event loop)"""
+        if self.try_acquire():
+            return True
+        deadline = time.monotonic() + timeout
+        interval = self.POLL_INTERVAL
+        with self._lock:
+            self.contended += 1
+        while time.monotonic() < deadline:
+            await asyncio.sleep(interval)
+            if self.try_acquire():
+                return True
+            interval = min(interval * 2, self.MAX_POLL_INTERVAL)
+        with self._lock:
+            self.timed_out += 1
+        return False
+
+    def release(self):
+        """Nhả một slot process này đang giữ (các slot tương đương nhau)"""
+        with self._lock:
+            fd = self._held.pop()
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'limit': self.limit,
+                'held': len(self._held),
+                'acquired': self.acquired,
+                'contended': self.contended,
+                'timed_out': self.timed_out
+            }
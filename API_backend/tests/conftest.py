@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+"""Test chạy từ API_backend/ hoặc thư mục gốc repo: python -m pytest API_backend/tests"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""Admission control: 429 khi hàng đợi đầy, 503 khi chờ quá max_wait"""
+import asyncio
+import threading
+
+import pytest
+
+from admission import AdmissionController, AsyncAdmissionController, Overloaded
+
+def test_queue_full_is_429():
+    admission = AdmissionController('test', max_concurrent=1, max_queue=0, max_wait=1.0)
+    admission.acquire()
+    with pytest.raises(Overloaded) as error:
+        admission.acquire()
+    assert error.value.status_code == 429
+    assert error.value.reason == 'queue full'
+    assert int(error.value.retry_after_header) >= 1
+    assert admission.stats()['rejected'] == 1
+
+def test_wait_timeout_is_503():
+    admission = AdmissionController('test', max_concurrent=1, max_queue=1, max_wait=0.05)
+    admitted_at = admission.acquire()
+    with pytest.raises(Overloaded) as error:
+        admission.acquire()
+    assert error.value.status_code == 503
+    assert error.value.reason == 'queue wait timeout'
+
+    # Request hết giờ không giữ chỗ trong hàng đợi hay slot
+    admission.release(admitted_at)
+    stats = admission.stats()
+    assert stats['active'] == 0 and stats['queue_depth'] == 0
+
+def test_waiter_gets_released_slot():
+    admission = AdmissionController('test', max_concurrent=1, max_queue=1, max_wait=2.0)
+    admitted_at = admission.acquire()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(admission.acquire()))
+    waiter.start()
+    while admission.stats()['queue_depth'] == 0:
+        threading.Event().wait(0.001)
+    admission.release(admitted_at)
+    waiter.join(2.0)
+    assert got and admission.stats()['active'] == 1
+
+def test_async_queue_full_and_timeout():
+    async def scenario():
+        admission = AsyncAdmissionController('test', max_concurrent=1, max_queue=1, max_wait=0.05)
+        await admission.acquire()
+        waiting = asyncio.ensure_future(admission.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded) as full:
+            await admission.acquire()
+        assert full.value.status_code == 429
+        with pytest.raises(Overloaded) as timeout:
+            await waiting
+        assert timeout.value.status_code == 503
+        assert admission.stats()['queue_depth'] == 0
+
+    asyncio.run(scenario())
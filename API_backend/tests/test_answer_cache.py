@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""Answer cache: mặc định chỉ khớp exact; khớp gần giống (tuỳ chọn) không gộp câu khác số"""
+import pytest
+
+from answer_cache import AnswerCache
+
+MODEL = 'gemma2:2b'
+SIMILARITY = 0.9
+
+def cache_with(message, language='vi', **options):
+    cache = AnswerCache(**options)
+    cache.put(message, language, MODEL, None, {'reply': 'cached'})
+    return cache
+
+def test_exact_match_after_normalizing():
+    cache = cache_with('Chiến thắng Điện Biên Phủ năm nào?')
+    value, match = cache.lookup('  chiến thắng điện biên phủ   năm nào ', 'vi', MODEL)
+    assert match == 'exact' and value == {'reply': 'cached'}
+
+# Khác một từ là khác câu trả lời, dù điểm Dice trigram >= 0.9
+@pytest.mark.parametrize('cached, asked, language', [
+    ('Ai là vua đầu tiên của nhà Lý', 'Ai là vua đầu tiên của nhà Lê', 'vi'),
+    ('Who was the first emperor of the Nguyen dynasty',
+     'Who was the last emperor of the Nguyen dynasty', 'en'),
+    ('Hai Bà Trưng khởi nghĩa chống quân nào', 'Hai Bà Trưng khởi nghĩa chống quân Hán khi nào', 'vi'),
+])
+def test_near_duplicates_miss_by_default(cached, asked, language):
+    cache = cache_with(cached, language)
+    assert cache.lookup(asked, language, MODEL) == (None, None)
+    assert cache.stats()['similar_hits'] == 0
+
+def test_similar_question_is_merged_when_enabled():
+    cache = cache_with('Ai là người lãnh đạo khởi nghĩa Lam Sơn', similarity_threshold=SIMILARITY)
+    value, match = cache.lookup('Ai là người lãnh đạo cuộc khởi nghĩa Lam Sơn', 'vi', MODEL)
+    assert match == 'similar' and value == {'reply': 'cached'}
+
+def test_questions_differing_in_numbers_are_not_merged():
+    cache = cache_with('Sự kiện quan trọng nào diễn ra năm 1945 ở Việt Nam', similarity_threshold=SIMILARITY)
+    assert cache.lookup('Sự kiện quan trọng nào diễn ra năm 1954 ở Việt Nam', 'vi', MODEL) == (None, None)
+    assert cache.lookup('Sự kiện quan trọng nào diễn ra năm 945 ở Việt Nam', 'vi', MODEL) == (None, None)
+
+    cache = cache_with('Tóm tắt lịch sử Việt Nam thế kỷ 10', similarity_threshold=SIMILARITY)
+    assert cache.lookup('Tóm tắt lịch sử Việt Nam thế kỷ 11', 'vi', MODEL) == (None, None)
+
+def test_scope_separates_language_and_model():
+    cache = cache_with('What happened in 1945 in Vietnam', similarity_threshold=SIMILARITY)
+    assert cache.lookup('What happened in 1945 in Vietnam', 'en', MODEL) == (None, None)
+    assert cache.lookup('What happened in 1945 in Vietnam', 'vi', 'llava:7b') == (None, None)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""Luồng dùng chung (SingleFlight.stream): slot admission được trả khi subscriber rời đi"""
+import asyncio
+
+from admission import AdmissionController, AsyncAdmissionController
+from coalescing import SingleFlight, AsyncSingleFlight
+
+LINES = [b'{"response": "Nam", "done": false}', b'{"response": "1945", "done": true}']
+
+class FakeResponse:
+    status_code = 200
+    text = ''
+
+    def __init__(self, lines=LINES):
+        self._lines = list(lines)
+        self.closed = False
+        self.read = 0
+
+    def iter_lines(self):
+        for line in self._lines:
+            self.read += 1
+            yield line
+
+    def close(self):
+        self.closed = True
+
+class AsyncFakeResponse(FakeResponse):
+    async def aiter_lines(self):
+        for line in self._lines:
+            self.read += 1
+            yield line
+
+    async def aclose(self):
+        self.closed = True
+
+def controller():
+    return AdmissionController('test', max_concurrent=1, max_queue=4, max_wait=1.0)
+
+def opener(admission, response):
+    def open_fn():
+        admitted_at = admission.acquire()
+        return response, lambda: admission.release(admitted_at)
+    return open_fn
+
+def test_close_before_first_chunk_releases_slot():
+    admission, response = controller(), FakeResponse()
+    flights = SingleFlight()
+    subscription, shared = flights.stream('k', opener(admission, response))
+    assert not shared
+    assert admission.stats()['active'] == 1
+
+    # Client ngắt kết nối trước khi generator lines() chạy: chỉ có close() của response
+    subscription.close()
+    subscription.close()
+
+    assert admission.stats()['active'] == 0
+    assert response.closed and response.read == 0
+    assert flights.stats()['streams'] == 0
+
+def test_slot_held_until_last_subscriber_leaves():
+    admission, response = controller(), FakeResponse()
+    flights = SingleFlight()
+    first, _ = flights.stream('k', opener(admission, response))
+    second, shared = flights.stream('k', opener(admission, FakeResponse()))
+    assert shared
+
+    first.close()
+    assert admission.stats()['active'] == 1
+    assert list(second.lines()) == LINES
+    assert admission.stats()['active'] == 0
+
+def test_cancelled_stream_is_not_joined():
+    admission = controller()
+    flights = SingleFlight()
+    subscription, _ = flights.stream('k', opener(admission, FakeResponse()))
+    subscription.close()
+
+    fresh = FakeResponse()
+    again, shared = flights.stream('k', opener(admission, fresh))
+    assert not shared
+    assert list(again.lines()) == LINES
+    assert fresh.read == len(LINES)
+    assert admission.stats()['active'] == 0
+
+def test_async_close_before_first_chunk_releases_slot():
+    async def scenario():
+        admission = AsyncAdmissionController('test', max_concurrent=1, max_queue=4, max_wait=1.0)
+        response = AsyncFakeResponse()
+        flights = AsyncSingleFlight()
+
+        async def open_fn():
+            admitted_at = await admission.acquire()
+            return response, lambda: admission.release(admitted_at)
+
+        subscription, shared = await flights.stream('k', open_fn)
+        assert not shared
+        assert admission.stats()['active'] == 1
+        await subscription.close()
+        assert admission.stats()['active'] == 0
+        assert response.closed and response.read == 0
+
+    asyncio.run(scenario())
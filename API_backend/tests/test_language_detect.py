@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""Nhận diện ngôn ngữ, gồm tiếng Việt gõ không dấu"""
+import pytest
+
+from language_detect import detect_language
+
+@pytest.mark.parametrize('text', [
+    'Ai la vua dau tien cua nha Tran',
+    'chien tranh the gioi thu hai ket thuc nam nao',
+    'ke ve lich su nha Ly',
+    'Hai Ba Trung khoi nghia nam bao nhieu',
+    # Có từ trùng với từ chức năng tiếng Anh (do, to, an)
+    'nha Nguyen do ai lap ra',
+    'to chuc nao lanh dao',
+    'an duong vuong la ai',
+])
+def test_unaccented_vietnamese(text):
+    assert detect_language(text, default='en') == 'vi'
+
+@pytest.mark.parametrize('text, expected', [
+    ('Trận Bạch Đằng năm 938 diễn ra như thế nào?', 'vi'),
+    ('What happened during the Battle of Dien Bien Phu?', 'en'),
+    ('Tell me about the history of the Tran dynasty', 'en'),
+    ('越南历史上最重要的战役是什么？', 'zh'),
+    ('Hồ Chí Minh 是谁？', 'zh'),
+])
+def test_languages(text, expected):
+    assert detect_language(text) == expected
+
+def test_empty_text_uses_default():
+    assert detect_language('   ', default='en') == 'en'
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""Phiên trong SQLite dùng chung: một lượt tại một thời điểm trên mọi worker"""
+import pytest
+
+from shared_state import SharedStore, SharedSessionStore
+
+@pytest.fixture
+def stores(tmp_path):
+    """Hai SessionStore trên cùng file SQLite, như hai worker process"""
+    path = str(tmp_path / 'state.sqlite3')
+    return SharedSessionStore(SharedStore(path)), SharedSessionStore(SharedStore(path))
+
+def test_session_busy_in_another_worker(stores):
+    first, second = stores
+    session = first.create('vi')
+    assert first.begin(session)
+
+    other = second.get(session.id)
+    assert other is not None
+    assert not second.begin(other)
+    # Lượt bị từ chối không để phiên ở trạng thái busy trong worker của nó
+    assert not other.busy
+
+    first.finish(session)
+    assert second.begin(other)
+    second.finish(other)
+
+def test_session_busy_in_same_worker(stores):
+    first, _ = stores
+    session = first.create('vi')
+    assert first.begin(session)
+    assert not first.begin(session)
+    first.finish(session)
+    assert first.begin(session)
+
+def test_turn_recorded_by_other_worker_is_loaded(stores):
+    first, second = stores
+    session = first.create('vi')
+    assert first.begin(session)
+    first.record(session, 'Ai lập nhà Lý?', 'Lý Công Uẩn.')
+    first.finish(session)
+
+    loaded = second.get(session.id)
+    assert loaded.turn_count == 1
+    assert list(loaded.history())[0][0] == 'Ai lập nhà Lý?'
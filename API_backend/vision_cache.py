@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Cache câu trả lời cho VISION_MODEL (lời gọi đắt nhất, tới 180s).
+
+Học sinh thường chụp cùng một hình trong SGK hay cùng một hiện vật bảo tàng.
+Hai lớp:
+- Exact: key = sha256 của ảnh đã tiền xử lý (image_pipeline đã xoay EXIF, bỏ
+  metadata, thu nhỏ) + câu hỏi đã chuẩn hoá + language + model + options
+- Perceptual (tuỳ chọn, mặc định tắt - max_distance=0): cùng câu hỏi, ảnh có
+  dHash cách nhau không quá max_distance bit (ảnh nén lại, chụp lệch/cắt nhẹ
+  vẫn trúng). Hai ảnh khác nhau có thể có dHash gần nhau (cùng bố cục trang
+  SGK, khác hình) và nhận nhầm câu trả lời, nên chỉ bật khi đã chấp nhận rủi ro đó
+
+Giới hạn theo số entry, tổng bytes (ước lượng) và TTL; loại bỏ theo LRU.
+"""
+from collections import OrderedDict
+from answer_cache import normalize_message
+import threading
+import hashlib
+import json
+import time
+
+# Ước lượng overhead bộ nhớ cho mỗi entry (key, dict, hash...)
+_ENTRY_OVERHEAD = 256
+# dHash gần như toàn 0 hoặc toàn 1 (ảnh trơn, gần một màu) không đủ thông tin để so khớp
+_MIN_PHASH_BITS = 4
+
+def image_digest(data):
+    """sha256 của bytes ảnh (đã chuẩn hoá bởi image_pipeline)"""
+    return hashlib.sha256(data).hexdigest()
+
+def hamming_distance(a, b):
+    return (a ^ b).bit_count()
+
+def _informative(phash):
+    return phash is not None and _MIN_PHASH_BITS <= phash.bit_count() <= 64 - _MIN_PHASH_BITS
+
+class VisionCache:
+    """LRU + TTL cache cho câu trả lời vision, thread-safe, dùng chung cho Flask và ASGI"""
+
+    def __init__(self, max_entries=500, max_bytes=8 * 1024 * 1024, ttl=7 * 24 * 3600,
+                 max_distance=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_distance = max_distance
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # scope (câu hỏi + language + model + options) -> {key: phash}
+        self._phash_index = {}
+        self._bytes = 0
+
+        self.hits = 0
+        self.perceptual_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def _scope(message, language, model, options):
+        return (normalize_message(message), language, model, json.dumps(options or {}, sort_keys=True))
+
+    def lookup(self, digest, phash, message, language, model, options=None):
+        """
+        Tìm câu trả lời đã cache cho ảnh + câu hỏi.
+        Trả về (value, match) với match là 'exact' / 'perceptual', hoặc (None, None).
+        """
+        scope = self._scope(message, language, model, options)
+        key = (scope, digest)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry['expires_at'] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry['value'], 'exact'
+                self._remove(key)
+                self.expirations += 1
+
+            if self.max_distance and _informative(phash):
+                similar = self._find_similar(scope, phash, now)
+                if similar is not None:
+                    self._entries.move_to_end(similar)
+                    self.perceptual_hits += 1
+                    return self._entries[similar]['value'], 'perceptual'
+
+            self.misses += 1
+            return None, None
+
+    def put(self, digest, phash, message, language, model, options, value, ttl=None):
+        """Lưu câu trả lời; ttl=None dùng TTL mặc định"""
+        scope = self._scope(message, language, model, options)
+        key = (scope, digest)
+        size = (len(json.dumps(value, ensure_ascii=False).encode('utf-8'))
+                + len(scope[0].encode('utf-8')) + _ENTRY_OVERHEAD)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = {
+                'value': value,
+                'expires_at': time.monotonic() + (self.ttl if ttl is None else ttl),
+                'size': size,
+                'phash': phash
+            }
+            self._bytes += size
+            if _informative(phash):
+                self._phash_index.setdefault(scope, {})[key] = phash
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _find_similar(self, scope, phash, now):
+        best_key, best_distance = None, self.max_distance
+        for key, other in self._phash_index.get(scope, {}).items():
+            distance = hamming_distance(phash, other)
+            if distance <= best_distance and self._entries[key]['expires_at'] > now:
+                best_key, best_distance = key, distance
+        return best_key
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry['size']
+        scope = key[0]
+        keys = self._phash_index.get(scope)
+        if keys is not None:
+            keys.pop(key, None)
+            if not keys:
+                del self._phash_index[scope]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._phash_index.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.perceptual_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'perceptual_hits': self.perceptual_hits,
+                'misses': self.misses,
+                'hit_ratio': round((self.hits + self.perceptual_hits) / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
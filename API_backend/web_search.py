@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Bước web search cho các câu hỏi cần thông tin mới (should_search).
+
+- Ngân sách thời gian cứng: quá hạn thì trả lời không có context; lượt search
+  vẫn chạy tiếp ở nền và kết quả được cache cho lần hỏi sau
+- Cache TTL theo câu hỏi đã chuẩn hoá + language (kết quả rỗng/lỗi cache ngắn
+  hơn để không gọi lại liên tục khi Google đang chặn)
+- Gộp các lượt search giống nhau đang chạy
+- Backend thay được: 'google' (googlesearch, chỉ import khi search lần đầu), 'stub' (kết quả giả, dùng khi
+  test/benchmark) hoặc 'module:function' với chữ ký fn(query, num_results, lang, timeout)
+- submit() trả về Future ngay để request chuẩn bị prompt song song
+"""
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import OrderedDict
+from answer_cache import normalize_message
+import concurrent.futures
+import importlib
+import threading
+import logging
+import asyncio
+import time
+
+logger = logging.getLogger(__name__)
+
+SEARCH_LANGUAGE = 'vi'
+
+def google_backend(query, num_results, lang, timeout):
+    """Backend mặc định: googlesearch-python (import ở lần search đầu, kéo theo bs4 / lxml)"""
+    try:
+        from googlesearch import search
+    except ImportError:
+        raise RuntimeError("googlesearch-python is not installed") from None
+    results = []
+    for url in search(query, num_results=num_results, lang=lang, timeout=timeout):
+        results.append(url)
+        if len(results) >= num_results:
+            break
+    return results
+
+def stub_backend(query, num_results, lang, timeout):
+    """Backend giả cho test/benchmark: trả về URL cố định, không gọi mạng"""
+    slug = '-'.join(normalize_message(query).split())[:60]
+    return [f"https://example.org/{lang}/{slug}/{i}" for i in range(1, num_results + 1)]
+
+BACKENDS = {
+    'google': google_backend,
+    'stub': stub_backend
+}
+
+def load_backend(name):
+    """'google' / 'stub' hoặc đường dẫn 'module:function'"""
+    if name in BACKENDS:
+        return BACKENDS[name]
+    module_name, _, attr = name.partition(':')
+    if not attr:
+        raise ValueError(f"Unknown web search backend: {name}")
+    return getattr(importlib.import_module(module_name), attr)
+
+class SearchStage:
+    """Web search có cache, gộp request và giới hạn thời gian; dùng chung cho Flask và ASGI"""
+
+    def __init__(self, backend, budget=2.5, ttl=10 * 60, empty_ttl=60, max_entries=1000,
+                 max_workers=4, lang=SEARCH_LANGUAGE):
+        self.backend = backend
+        self.budget = budget
+        self.ttl = ttl
+        self.empty_ttl = empty_ttl
+        self.max_entries = max_entries
+        self.lang = lang
+
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._in_flight = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='web-search')
+
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.searches = 0
+        self.total_search_time = 0.0
+
+    def submit(self, query, language, num_results=3):
+        """Bắt đầu search (hoặc lấy từ cache / lượt đang chạy). Trả về Future -> list URL"""
+        key = (normalize_message(query), language, num_results)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                if entry['expires_at'] > time.monotonic():
+                    self._cache.move_to_end(key)
+                    self.hits += 1
+                    future = Future()
+                    future.set_result(entry['results'])
+                    return future
+                del self._cache[key]
+
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.shared += 1
+                return future
+            self.misses += 1
+            future = self._executor.submit(self._run, key, query, num_results)
+            self._in_flight[key] = future
+            return future
+
+    def _run(self, key, query, num_results):
+        logger.debug("web search: %s", query)
+        start = time.perf_counter()
+        try:
+            results = list(self.backend(query, num_results, self.lang, self.budget))
+            logger.debug("web search: %d results", len(results))
+        except Exception as e:
+            logger.warning("web search failed: %s", e)
+            results = []
+            with self._lock:
+                self.errors += 1
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            self.searches += 1
+            self.total_search_time += elapsed
+            self._in_flight.pop(key, None)
+            self._cache[key] = {
+                'results': results,
+                'expires_at': time.monotonic() + (self.ttl if results else self.empty_ttl)
+            }
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return results
+
+    def result(self, future, deadline=None):
+        """Chờ kết quả tới deadline (time.monotonic()); quá hạn -> [] và search chạy tiếp ở nền"""
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            return future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            return self._timed_out()
+
+    async def result_async(self, future, deadline=None):
+        """Bản asyncio của result()"""
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout)
+        except asyncio.TimeoutError:
+            return self._timed_out()
+
+    def _timed_out(self):
+        with self._lock:
+            self.timeouts += 1
+        logger.warning("Web search exceeded %ss budget, answering without web context", self.budget)
+        return []
+
+    def deadline(self):
+        return time.monotonic() + self.budget
+
+    def search(self, query, language, num_results=3):
+        """submit() + result() trong ngân sách thời gian"""
+        return self.result(self.submit(query, language, num_results), self.deadline())
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.shared
+            return {
+                'backend': getattr(self.backend, '__name__', str(self.backend)),
+                'budget': self.budget,
+                'entries': len(self._cache),
+                'in_flight': len(self._in_flight),
+                'hits': self.hits,
+                'misses': self.misses,
+                'shared': self.shared,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'timeouts': self.timeouts,
+                'errors': self.errors,
+                'avg_search_time': round(self.total_search_time / self.searches, 3) if self.searches else 0.0
+            }
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Chạy nhiều worker process (pre-fork) trên cùng một socket đang listen.
+
+    python run_production.py --workers 4
+    kill -HUP <pid supervisor>      # reload code, không làm rơi chat đang chạy
+
+- Supervisor chỉ bind socket rồi fork; mỗi worker import app sau khi fork
+  (thread nền của app không đi qua fork, reload là import lại code mới).
+  Kernel chia kết nối cho các worker đang accept trên socket chung
+- Worker báo "sẵn sàng" qua pipe sau khi import xong app
+- SIGHUP: fork lứa worker mới, chờ chúng sẵn sàng rồi mới SIGTERM lứa cũ;
+  socket không lúc nào thiếu người accept
+- SIGTERM ở worker: ngừng accept, chờ các request đang chạy (kể cả stream)
+  xong, tối đa graceful_timeout giây, rồi thoát
+- Worker chết bất thường -> fork lại; SIGTERM / SIGINT ở supervisor -> dừng
+  mọi worker theo cách trên
+Chỉ chạy trên Linux / macOS (os.fork).
+"""
+import threading
+import logging
+import signal
+import socket
+import select
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+# Worker chết ngay sau khi fork liên tục (lỗi import...) -> chờ trước khi fork lại
+RESPAWN_DELAY = 1.0
+
+def listen(host, port, backlog=2048):
+    """Socket TCP đang listen, các worker kế thừa qua fork"""
+    sock = socket.create_server((host, port), backlog=backlog)
+    sock.set_inheritable(True)
+    return sock
+
+class ActiveRequests:
+    """WSGI middleware đếm request đang chạy; response stream tính tới khi đóng"""
+
+    def __init__(self, app):
+        self.app = app
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self.count = 0
+
+    def __call__(self, environ, start_response):
+        with self._lock:
+            self.count += 1
+        try:
+            body = self.app(environ, start_response)
+        except BaseException:
+            self._done()
+            raise
+        return _ClosingBody(body, self._done)
+
+    def _done(self):
+        with self._lock:
+            self.count -= 1
+            if not self.count:
+                self._idle.notify_all()
+
+    def wait_idle(self, timeout):
+        """Chờ tới khi không còn request nào; False nếu hết giờ"""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while self.count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+            return True
+
+class _ClosingBody:
+    __slots__ = ('body', 'on_close')
+
+    def __init__(self, body, on_close):
+        self.body = body
+        self.on_close = on_close
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.on_close()
+
+class _Worker:
+    __slots__ = ('pid', 'index', 'generation', 'ready_fd', 'ready', 'stopping')
+
+    def __init__(self, pid, index, generation, ready_fd):
+        self.pid = pid
+        self.index = index
+        self.generation = generation
+        self.ready_fd = ready_fd
+        self.ready = False
+        self.stopping = False
+
+class Supervisor:
+    """
+    Fork `workers` process chạy target(sock, index, notify_ready) và giữ đủ số
+    worker; target trả về khi worker dừng xong.
+    """
+
+    def __init__(self, target, workers, host='0.0.0.0', port=5000, graceful_timeout=60.0,
+                 ready_timeout=120.0):
+        if not hasattr(os, 'fork'):
+            raise RuntimeError("Multi-process mode needs os.fork (Linux / macOS)")
+        self.target = target
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.graceful_timeout = graceful_timeout
+        self.ready_timeout = ready_timeout
+        self.generation = 0
+        self.children = {}
+        self.reloads = 0
+        self._signals = []
+
+    def run(self):
+        self.sock = listen(self.host, self.port)
+        for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda signum, frame: self._signals.append(signum))
+        logger.info("Supervisor %d listening on %s:%d with %d workers",
+                    os.getpid(), self.host, self.port, self.workers)
+        self._spawn_generation()
+        try:
+            while True:
+                while self._signals:
+                    signum = self._signals.pop(0)
+                    if signum == signal.SIGHUP:
+                        self._reload()
+                    else:
+                        return
+                self._reap()
+                self._poll_ready(0.2)
+        finally:
+            self._stop_all()
+            self.sock.close()
+
+    # ---- Worker ----
+
+    def _spawn(self, index):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            code = 0
+            try:
+                # Ctrl+C gửi SIGINT cho cả nhóm process: để supervisor dừng worker êm
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                self.target(self.sock, index, lambda: _notify(write_fd))
+            except BaseException:
+                logger.exception("Worker %d crashed", index)
+                code = 1
+            finally:
+                os._exit(code)
+        os.close(write_fd)
+        self.children[pid] = _Worker(pid, index, self.generation, read_fd)
+        return pid
+
+    def _spawn_generation(self):
+        self.generation += 1
+        for index in range(self.workers):
+            self._spawn(index)
+
+    def _reload(self):
+        """Lứa worker mới sẵn sàng rồi mới dừng lứa cũ"""
+        old = [w for w in self.children.values() if not w.stopping]
+        self._spawn_generation()
+        deadline = time.monotonic() + self.ready_timeout
+        while time.monotonic() < deadline and not all(
+                w.ready for w in self.children.values() if w.generation == self.generation):
+            self._poll_ready(0.2)
+            self._reap()
+        for worker in old:
+            self._terminate(worker)
+        self.reloads += 1
+        logger.info("Reloaded: generation %d, stopping %d old workers", self.generation, len(old))
+
+    def _terminate(self, worker):
+        if not worker.stopping:
+            worker.stopping = True
+            try:
+                os.kill(worker.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _poll_ready(self, timeout):
+        pending = {w.ready_fd: w for w in self.children.values() if not w.ready and w.ready_fd is not None}
+        if not pending:
+            time.sleep(timeout)
+            return
+        try:
+            readable, _, _ = select.select(list(pending), [], [], timeout)
+        except InterruptedError:
+            return
+        for fd in readable:
+            worker = pending[fd]
+            worker.ready = bool(os.read(fd, 1))
+            os.close(fd)
+            worker.ready_fd = None
+
+    def _reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            worker = self.children.pop(pid, None)
+            if worker is None:
+                continue
+            if worker.ready_fd is not None:
+                os.close(worker.ready_fd)
+            if worker.stopping or worker.generation != self.generation:
+                continue
+            logger.error("Worker %d (pid %d) exited with status %d, restarting", worker.index, pid, status)
+            time.sleep(RESPAWN_DELAY)
+            self._spawn(worker.index)
+
+    def _stop_all(self):
+        for worker in list(self.children.values()):
+            self._terminate(worker)
+        deadline = time.monotonic() + self.graceful_timeout + 5
+        while self.children and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in list(self.children):
+            logger.warning("Worker pid %d did not stop in time, killing", pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        self.children.clear()
+
+def _notify(fd):
+    os.write(fd, b'1')
+    os.close(fd)
+
+def drain_on_sigterm(stop_accepting, active, graceful_timeout, on_drained):
+    """
+    Cài SIGTERM cho worker: stop_accepting() ngay, on_drained() khi hết request
+    đang chạy hoặc sau graceful_timeout giây.
+    """
+    def handle(signum, frame):
+        stop_accepting()
+
+        def drain():
+            if not active.wait_idle(graceful_timeout):
+                logger.warning("Stopping worker %d with %d requests still running", os.getpid(), active.count)
+            on_drained()
+        threading.Thread(target=drain, name='worker-drain', daemon=True).start()
+
+    signal.signal(signal.SIGTERM, handle)